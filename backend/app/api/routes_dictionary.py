@@ -1,8 +1,12 @@
 from __future__ import annotations
 
 from fastapi import APIRouter, File, UploadFile, HTTPException
+from starlette.concurrency import run_in_threadpool
 
+from app.config import UPLOAD_CHUNK_SIZE
 from app.models.schemas import UploadFilterResponse
+from app.services.executors import parse_executor
+from app.services.jobs import QueueFullError
 from app.services.mapping_reader import load_mapping_csv
 from app.store import store
 
@@ -12,13 +16,17 @@ router = APIRouter()
 @router.post("/upload-dictionary", response_model=UploadFilterResponse)
 async def upload_dictionary(file: UploadFile = File(...)) -> UploadFilterResponse:
     try:
-        content = await file.read()
-        stored = store.save_upload(file.filename or "diccionario.csv", content, suffix=".csv")
-        info = load_mapping_csv(str(stored.path))
+        with store.begin_upload(file.filename or "diccionario.csv", suffix=".csv") as upload:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await run_in_threadpool(upload.write, chunk)
+            stored = await parse_executor.run(upload.commit)
+        info = await parse_executor.run(load_mapping_csv, str(stored.path))
         return UploadFilterResponse(
             filter_id=stored.file_id,
             rows=int(len(info.index)),
             columns=list(info.columns),
         )
+    except QueueFullError as exc:
+        raise HTTPException(status_code=503, detail=str(exc)) from exc
     except Exception as exc:
         raise HTTPException(status_code=400, detail=str(exc)) from exc
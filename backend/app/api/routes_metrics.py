@@ -0,0 +1,19 @@
+from __future__ import annotations
+
+from typing import Dict
+
+from fastapi import APIRouter
+
+from app.services.executors import parse_executor
+from app.services.report_pipeline import report_jobs
+
+router = APIRouter()
+
+
+@router.get("/metrics")
+def metrics() -> Dict[str, Dict[str, int]]:
+    # counters of the worker process that answers
+    return {
+        "parse": parse_executor.stats(),
+        "report_jobs": {"pending": report_jobs.pending, "max_pending": report_jobs.max_pending},
+    }
@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+from fastapi import APIRouter, HTTPException, Response
+
+from app.services.catalog import catalog
+from app.services.filter_reader import read_filter
+from app.services.preview import filter_geojson, layer_tile
+from app.store import store
+
+router = APIRouter()
+
+GEOJSON_TYPE = "application/geo+json"
+
+
+def _check_layer(layer: str) -> None:
+    if layer not in catalog.layers():
+        raise KeyError(f"Capa no encontrada: {layer}")
+
+
+@router.get("/preview/{layer}/{z}/{x}/{y}.geojson")
+def preview_tile(layer: str, z: int, x: int, y: int) -> Response:
+    try:
+        _check_layer(layer)
+        content = layer_tile(layer, z, x, y)
+    except KeyError as exc:
+        raise HTTPException(status_code=404, detail=str(exc)) from exc
+    except Exception as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    # a new GPKG version changes the tiles, so browsers keep them only for a while
+    return Response(content, media_type=GEOJSON_TYPE, headers={"Cache-Control": "max-age=3600"})
+
+
+@router.get("/preview/{layer}/filter/{filter_id}.geojson")
+def preview_filter(layer: str, filter_id: str, zoom: int | None = None) -> Response:
+    try:
+        _check_layer(layer)
+        parsed = store.get_parsed(filter_id)
+        if parsed is None:
+            parsed = store.save_parsed(filter_id, read_filter(str(store.get(filter_id).path)))
+        content = filter_geojson(
+            layer,
+            filter_ids=list(parsed.ids) or None,
+            names=None if parsed.ids else list(parsed.names),
+            zoom=zoom,
+        )
+    except KeyError as exc:
+        raise HTTPException(status_code=404, detail=str(exc)) from exc
+    except Exception as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    return Response(content, media_type=GEOJSON_TYPE, headers={"Cache-Control": "no-store"})
@@ -1,24 +1,79 @@
 from __future__ import annotations
 
+from pathlib import Path
+from typing import Tuple
+
 from fastapi import APIRouter, File, UploadFile, HTTPException
+from starlette.concurrency import run_in_threadpool
 
-from app.models.schemas import UploadFilterResponse
-from app.services.filter_reader import read_filter_excel
+from app.config import UPLOAD_CHUNK_SIZE
+from app.models.schemas import SpatialFilterRequest, UploadFilterResponse
+from app.services.catalog import catalog
+from app.services.executors import parse_executor
+from app.services.filter_reader import FILTER_SUFFIXES, read_filter
+from app.services.jobs import QueueFullError
+from app.services.spatial import parse_query_geometry, spatial_entities
 from app.store import store
+from app.store.session_store import ParsedFilter, StoredFile, UploadWriter
 
 router = APIRouter()
 
 
+def _store_filter(upload: UploadWriter) -> Tuple[StoredFile, ParsedFilter]:
+    stored = upload.commit()
+    parsed = store.get_parsed(stored.file_id)
+    if parsed is None:
+        parsed = store.save_parsed(stored.file_id, read_filter(str(stored.path)))
+    return stored, parsed
+
+
 @router.post("/upload-filter", response_model=UploadFilterResponse)
 async def upload_filter(file: UploadFile = File(...)) -> UploadFilterResponse:
     try:
-        content = await file.read()
-        stored = store.save_upload(file.filename or "filtro.xlsx", content, suffix=".xlsx")
-        info = read_filter_excel(str(stored.path))
+        suffix = Path(file.filename or "").suffix.lower()
+        if suffix not in FILTER_SUFFIXES:
+            suffix = ".xlsx"
+        with store.begin_upload(file.filename or "filtro.xlsx", suffix=suffix) as upload:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                # the disk write (and the hashing) runs off the event loop
+                await run_in_threadpool(upload.write, chunk)
+            stored, parsed = await parse_executor.run(_store_filter, upload)
+        return UploadFilterResponse(
+            filter_id=stored.file_id,
+            rows=parsed.rows,
+            columns=list(parsed.columns),
+        )
+    except QueueFullError as exc:
+        raise HTTPException(status_code=503, detail=str(exc)) from exc
+    except Exception as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+
+
+def _spatial_filter(req: SpatialFilterRequest) -> Tuple[StoredFile, ParsedFilter]:
+    # the selected entities become an ordinary CSV filter, usable by /report and /report/batch
+    if req.layer not in catalog.layers():
+        raise KeyError(f"Capa no encontrada: {req.layer}")
+    query = parse_query_geometry(req.bbox, req.geojson, req.wkt)
+    entities = spatial_entities(req.layer, query, req.predicate)
+    if entities.empty:
+        raise ValueError("Ninguna entidad de la capa coincide con el área indicada")
+    with store.begin_upload(f"filtro_espacial_{req.layer}.csv", suffix=".csv") as upload:
+        upload.write(entities.to_csv(index=False).encode("utf-8"))
+        return _store_filter(upload)
+
+
+@router.post("/spatial-filter", response_model=UploadFilterResponse)
+async def spatial_filter(req: SpatialFilterRequest) -> UploadFilterResponse:
+    try:
+        stored, parsed = await parse_executor.run(_spatial_filter, req)
         return UploadFilterResponse(
             filter_id=stored.file_id,
-            rows=info["rows"],
-            columns=info["columns"],
+            rows=parsed.rows,
+            columns=list(parsed.columns),
         )
+    except KeyError as exc:
+        raise HTTPException(status_code=404, detail=str(exc)) from exc
+    except QueueFullError as exc:
+        raise HTTPException(status_code=503, detail=str(exc)) from exc
     except Exception as exc:
         raise HTTPException(status_code=400, detail=str(exc)) from exc
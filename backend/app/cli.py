@@ -0,0 +1,214 @@
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from app.config import VARIABLES_DICT_PATH
+from app.services.aggregation import aggregate_entities, aggregate_entities_grouped
+from app.services.catalog import catalog
+from app.services.filter_reader import read_filter
+from app.services.group_rules import load_group_plan, select_groups
+from app.services.reporting import REPORT_FORMATS, build_batch_reports, build_reports
+from app.services.rollups import reference_sums, reference_sums_grouped, validate_references
+
+# Builds the reports listed in a manifest with the same services as the API, without
+# HTTP, uploads or the report cache, one manifest row per worker process:
+#
+#   python -m app.cli report --manifest lote.csv --out Resultados/lote --workers 8
+#
+# Manifest columns (CSV, or a JSON list of objects with the same keys):
+#   filter        filter spreadsheet, relative to the manifest
+#   localidad     name shown in the report (not used with group_column)
+#   layer         GPKG layer, --layer by default
+#   groups        group titles separated by "|", all of them by default
+#   formats       formats separated by "|", --formats by default
+#   group_column  one report per value of this filter column (as /report/batch)
+#   combined      with group_column, a single file with every group (1/true/si)
+#   references    comuna|region|pais: extra percentage columns for those areas
+
+
+@dataclass(frozen=True)
+class Task:
+    number: int
+    filter_path: str
+    localidad: str
+    layer: str
+    groups: Tuple[str, ...]
+    formats: Tuple[str, ...]
+    group_column: str = ""
+    combined: bool = False
+    references: Tuple[str, ...] = ()
+
+
+def _split(value: object) -> Tuple[str, ...]:
+    if isinstance(value, (list, tuple)):
+        return tuple(str(v).strip() for v in value if str(v).strip())
+    return tuple(part.strip() for part in str(value or "").split("|") if part.strip())
+
+
+def _flag(value: object) -> bool:
+    return str(value or "").strip().lower() in {"1", "true", "yes", "si", "sí", "x"}
+
+
+def read_manifest(path: Path, layer: str, formats: Tuple[str, ...]) -> List[Task]:
+    if path.suffix.lower() == ".json":
+        rows = json.loads(path.read_text(encoding="utf-8"))
+    else:
+        with path.open("r", encoding="utf-8-sig", newline="") as fh:
+            sample = fh.read(64 * 1024)
+            fh.seek(0)
+            try:
+                delimiter = csv.Sniffer().sniff(sample, delimiters=",;\t|").delimiter
+            except csv.Error:
+                delimiter = ","
+            rows = list(csv.DictReader(fh, delimiter=delimiter))
+
+    tasks = []
+    for number, row in enumerate(rows, start=1):
+        row = {str(k).strip().lower(): v for k, v in row.items() if k is not None}
+        filter_path = str(row.get("filter") or "").strip()
+        if not filter_path:
+            raise ValueError(f"Fila {number} del manifiesto sin filtro")
+        task = Task(
+            number=number,
+            filter_path=str((path.parent / filter_path).resolve()),
+            localidad=str(row.get("localidad") or "").strip(),
+            layer=str(row.get("layer") or "").strip() or layer,
+            groups=_split(row.get("groups")),
+            formats=_split(row.get("formats")) or formats,
+            group_column=str(row.get("group_column") or "").strip().upper(),
+            combined=_flag(row.get("combined")),
+            references=_split(row.get("references")),
+        )
+        if not task.localidad and not task.group_column:
+            raise ValueError(f"Fila {number} del manifiesto sin localidad ni group_column")
+        unknown = [fmt for fmt in task.formats if fmt not in REPORT_FORMATS]
+        if unknown:
+            raise ValueError(f"Fila {number}: formato no soportado: {', '.join(unknown)}")
+        try:
+            validate_references(task.references)
+        except ValueError as exc:
+            raise ValueError(f"Fila {number}: {exc}") from exc
+        tasks.append(task)
+    return tasks
+
+
+def run_task(task: Task, out_dir: str) -> List[str]:
+    # returns the files written
+    if not VARIABLES_DICT_PATH.exists():
+        raise ValueError("No se encontró data/diccionario_variables.csv")
+    plan = load_group_plan(VARIABLES_DICT_PATH, catalog.variable_fields(task.layer))
+    selected_groups, columns = select_groups(plan, task.groups or list(plan.group_specs))
+    info = read_filter(task.filter_path, group_column=task.group_column or None)
+    by_ids = bool(info["ids"])
+    prefix = f"{task.number:03d}_"
+
+    if not task.group_column:
+        filter_ids = list(info["ids"]) or None
+        names = None if by_ids else list(info["names"])
+        var_sum, _ = aggregate_entities(task.layer, columns, filter_ids=filter_ids, names=names)
+        references = reference_sums(task.layer, columns, task.references, filter_ids=filter_ids, names=names)
+        result = build_reports(
+            var_sum,
+            selected_groups,
+            dict(plan.labels),
+            task.localidad,
+            prefix,
+            task.formats,
+            Path(out_dir),
+            references,
+        )
+        return [str(result[f"combined_{fmt}"]) for fmt in REPORT_FORMATS if result[f"combined_{fmt}"]]
+
+    groups: Dict[str, Dict[str, object]] = info["groups"]
+    group_ids = [list(g["ids"]) for g in groups.values()] if by_ids else None
+    group_names = None if by_ids else [list(g["names"]) for g in groups.values()]
+    sums = aggregate_entities_grouped(task.layer, columns, group_ids=group_ids, group_names=group_names)
+    references = reference_sums_grouped(
+        task.layer, columns, task.references, group_ids=group_ids, group_names=group_names
+    )
+    result = build_batch_reports(
+        {group: var_sum for group, (var_sum, _) in zip(groups, sums)},
+        selected_groups,
+        dict(plan.labels),
+        prefix,
+        task.formats,
+        combined=task.combined,
+        title=task.localidad or f"Consolidado {task.group_column.lower()}",
+        output_dir=Path(out_dir),
+        group_references=dict(zip(groups, references)),
+    )
+    outputs = [result["combined"]] if result["combined"] else list(result["groups"].values())
+    return [str(out[f"combined_{fmt}"]) for out in outputs for fmt in REPORT_FORMATS if out.get(f"combined_{fmt}")]
+
+
+def run_manifest(tasks: List[Task], out_dir: Path, workers: int) -> int:
+    # returns the number of failed rows
+    out_dir.mkdir(parents=True, exist_ok=True)
+    failed = 0
+    start = time.time()
+
+    def report(task: Task, files: List[str] | None, error: Exception | None) -> None:
+        nonlocal failed
+        name = task.localidad or task.group_column
+        if error is not None:
+            failed += 1
+            print(f"[{task.number:03d}] {name}: error: {error}", file=sys.stderr)
+        else:
+            print(f"[{task.number:03d}] {name}: {len(files or [])} archivos")
+
+    if workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            try:
+                report(task, run_task(task, str(out_dir)), None)
+            except Exception as exc:
+                report(task, None, exc)
+    else:
+        # each worker renders its own files; a nested render pool would only oversubscribe
+        os.environ["CENSO_RENDER_WORKERS"] = "0"
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            futures = {pool.submit(run_task, task, str(out_dir)): task for task in tasks}
+            for future in as_completed(futures):
+                try:
+                    report(futures[future], future.result(), None)
+                except Exception as exc:
+                    report(futures[future], None, exc)
+
+    print(f"{len(tasks) - failed}/{len(tasks)} reportes en {time.time() - start:.1f} s -> {out_dir}")
+    return failed
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.cli")
+    commands = parser.add_subparsers(dest="command", required=True)
+    report = commands.add_parser("report", help="genera los reportes de un manifiesto")
+    report.add_argument("--manifest", required=True, type=Path, help="CSV o JSON con un reporte por fila")
+    report.add_argument("--out", required=True, type=Path, help="carpeta de salida")
+    report.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="procesos en paralelo")
+    report.add_argument("--layer", default="Entidades_CPV24", help="capa por defecto")
+    report.add_argument(
+        "--formats", default="docx", help="formatos por defecto separados por | (csv, xlsx, html, docx)"
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        tasks = read_manifest(args.manifest, args.layer, _split(args.formats))
+    except (OSError, ValueError) as exc:
+        print(f"Manifiesto inválido: {exc}", file=sys.stderr)
+        return 2
+    return 1 if run_manifest(tasks, args.out, args.workers) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
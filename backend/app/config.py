@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import os
 from pathlib import Path
 
 ROOT_DIR = Path(__file__).resolve().parents[2]
@@ -9,3 +10,25 @@ DICT_PATH = CARTO_DIR / "Diccionario_variables_geograficas_CPV24.xlsx"
 RESULTS_DIR = ROOT_DIR / "Resultados"
 RESULTS_DIR.mkdir(parents=True, exist_ok=True)
 VARIABLES_DICT_PATH = ROOT_DIR / "data" / "diccionario_variables.csv"
+CACHE_DIR = ROOT_DIR / "Cache"
+CACHE_DIR.mkdir(parents=True, exist_ok=True)
+GPKG_INDEX_PATH = CACHE_DIR / "gpkg_index.sqlite"
+GPKG_MMAP_SIZE = int(os.getenv("CENSO_GPKG_MMAP_SIZE", str(2 * 1024**3)))
+GPKG_CACHE_SIZE_KB = int(os.getenv("CENSO_GPKG_CACHE_KB", str(64 * 1024)))
+GPKG_POOL_SIZE = int(os.getenv("CENSO_GPKG_POOL_SIZE", "8"))
+COLUMNAR_ENGINE = os.getenv("CENSO_COLUMNAR", "0").lower() in {"1", "true", "yes"}
+COLUMNAR_DIR = CACHE_DIR / "columnar"
+UPLOAD_TTL_SECONDS = float(os.getenv("CENSO_UPLOAD_TTL_HOURS", "168")) * 3600
+UPLOAD_MAX_BYTES = int(float(os.getenv("CENSO_UPLOAD_MAX_MB", "2048")) * 1024 * 1024)
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+REPORT_CACHE_PATH = CACHE_DIR / "reports.sqlite"
+REPORT_CACHE_MAX_ENTRIES = int(os.getenv("CENSO_REPORT_CACHE_ENTRIES", "500"))
+REPORT_CACHE_MAX_BYTES = int(float(os.getenv("CENSO_REPORT_CACHE_MAX_MB", "1024")) * 1024 * 1024)
+RENDER_WORKERS = int(os.getenv("CENSO_RENDER_WORKERS", str(min(4, os.cpu_count() or 1))))
+JOBS_PATH = CACHE_DIR / "jobs.sqlite"
+REPORT_JOB_WORKERS = int(os.getenv("CENSO_REPORT_JOB_WORKERS", "2"))
+REPORT_JOB_QUEUE_MAX = int(os.getenv("CENSO_REPORT_JOB_QUEUE_MAX", "32"))
+JOB_TTL_SECONDS = 24 * 3600
+PARSE_WORKERS = int(os.getenv("CENSO_PARSE_WORKERS", "2"))
+PARSE_QUEUE_MAX = int(os.getenv("CENSO_PARSE_QUEUE_MAX", "16"))
+PREVIEW_DIR = CACHE_DIR / "preview"
@@ -11,6 +11,8 @@ from app.api.routes_layers import router as layers_router
 from app.api.routes_upload import router as upload_router
 from app.api.routes_variables import router as variables_router
 from app.api.routes_report import router as report_router
+from app.api.routes_metrics import router as metrics_router
+from app.api.routes_preview import router as preview_router
 
 app = FastAPI(title="Censo 2024 Localidades Tablas (local)")
 
@@ -26,6 +28,8 @@ app.include_router(layers_router)
 app.include_router(upload_router)
 app.include_router(variables_router)
 app.include_router(report_router)
+app.include_router(metrics_router)
+app.include_router(preview_router)
 
 ROOT_DIR = Path(__file__).resolve().parents[2]
 FRONTEND_DIR = ROOT_DIR / "frontend"
@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 from pydantic import BaseModel
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Union
 
 
 class LayerInfo(BaseModel):
@@ -18,6 +18,16 @@ class UploadFilterResponse(BaseModel):
     columns: List[str]
 
 
+class SpatialFilterRequest(BaseModel):
+    layer: str
+    # one of: [minx, miny, maxx, maxy], a GeoJSON Polygon/MultiPolygon/Feature(Collection), or WKT
+    bbox: Optional[List[float]] = None
+    geojson: Optional[Dict[str, Any]] = None
+    wkt: Optional[str] = None
+    # intersects: any overlap with the area; centroid: the centroid falls inside it
+    predicate: str = "intersects"
+
+
 class VariableField(BaseModel):
     name: str
     description: str
@@ -41,6 +51,9 @@ class ReportRequest(BaseModel):
     filter_id: str
     groups: List[str]
     localidad: str
+    formats: List[str] = ["csv", "xlsx", "html", "docx"]
+    # extra percentage columns against the whole comuna, region or country
+    references: List[str] = []
 
 
 class ReportRow(BaseModel):
@@ -66,7 +79,57 @@ class ReportResponse(BaseModel):
     layer: str
     entities_count: int
     reports: List[ReportResult]
-    combined_csv: str
-    combined_html: str
-    combined_docx: str
-    combined_xlsx: str
+    report_id: str
+    downloads: Dict[str, str] = {}
+    combined_csv: Optional[str] = None
+    combined_html: Optional[str] = None
+    combined_docx: Optional[str] = None
+    combined_xlsx: Optional[str] = None
+
+
+class BatchRequest(BaseModel):
+    layer: str
+    filter_id: str
+    groups: List[str]
+    group_column: str = "LOCALIDAD"
+    formats: List[str] = ["docx"]
+    combined: bool = False
+    references: List[str] = []
+
+
+class BatchGroupResult(BaseModel):
+    group: str
+    entities_count: int
+    reports: List[ReportResult]
+    report_id: str
+    downloads: Dict[str, str] = {}
+    combined_csv: Optional[str] = None
+    combined_html: Optional[str] = None
+    combined_docx: Optional[str] = None
+    combined_xlsx: Optional[str] = None
+
+
+class BatchCombinedResult(BaseModel):
+    report_id: str
+    downloads: Dict[str, str] = {}
+    combined_csv: Optional[str] = None
+    combined_html: Optional[str] = None
+    combined_docx: Optional[str] = None
+    combined_xlsx: Optional[str] = None
+
+
+class BatchResponse(BaseModel):
+    layer: str
+    group_column: str
+    groups: List[BatchGroupResult]
+    combined: Optional[BatchCombinedResult] = None
+
+
+class JobStatus(BaseModel):
+    job_id: str
+    status: str
+    stage: Optional[str] = None
+    stage_label: Optional[str] = None
+    progress: float = 0.0
+    result: Optional[Union[ReportResponse, BatchResponse]] = None
+    error: Optional[str] = None
@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import logging
+from typing import Dict, List, Tuple
+
+from app.config import COLUMNAR_ENGINE
+from app.services.gpkg_reader import aggregate_layer, aggregate_layer_grouped
+
+logger = logging.getLogger(__name__)
+
+
+def aggregate_entities(
+    layer: str,
+    columns: List[str],
+    filter_ids: List[int] | None = None,
+    names: List[Tuple[str, str, str]] | None = None,
+) -> Tuple[Dict[str, float], int]:
+    if COLUMNAR_ENGINE:
+        from app.services.columnar import aggregate_columnar
+
+        try:
+            result = aggregate_columnar(layer, columns, filter_ids=filter_ids, names=names)
+        except Exception:
+            logger.exception("Motor columnar no disponible para %s; se usa SQLite", layer)
+            result = None
+        if result is not None:
+            return result
+    return aggregate_layer(layer, columns, filter_ids=filter_ids, names=names)
+
+
+def aggregate_entities_grouped(
+    layer: str,
+    columns: List[str],
+    group_ids: List[List[int]] | None = None,
+    group_names: List[List[Tuple[str, str, str]]] | None = None,
+) -> List[Tuple[Dict[str, float], int]]:
+    # one (var_sum, entities_count) per group, in input order, from a single pass
+    if COLUMNAR_ENGINE:
+        from app.services.columnar import aggregate_columnar_grouped
+
+        try:
+            result = aggregate_columnar_grouped(layer, columns, group_ids=group_ids, group_names=group_names)
+        except Exception:
+            logger.exception("Motor columnar no disponible para %s; se usa SQLite", layer)
+            result = None
+        if result is not None:
+            return result
+    return aggregate_layer_grouped(layer, columns, group_ids=group_ids, group_names=group_names)
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from app.config import GPKG_PATH
+from app.services.gpkg_index import gpkg_stamp
+from app.services.gpkg_reader import NUMERIC_TYPES, get_table_columns, list_layers
+
+
+@dataclass(frozen=True)
+class LayerSchema:
+    columns: Tuple[Tuple[str, str], ...]
+    numeric_fields: Tuple[str, ...]
+    variable_fields: Tuple[str, ...]
+
+
+def _schema_from_columns(columns: List[Tuple[str, str]]) -> LayerSchema:
+    numeric = tuple(
+        name for name, dtype in columns if str(dtype).lower().strip() in NUMERIC_TYPES
+    )
+    return LayerSchema(
+        columns=tuple((str(name), str(dtype)) for name, dtype in columns),
+        numeric_fields=numeric,
+        variable_fields=tuple(name for name in numeric if str(name).startswith("n_")),
+    )
+
+
+# Layer names and schemas of the GPKG, cached until its size/mtime change.
+class LayerCatalog:
+    def __init__(self, gpkg_path: Path = GPKG_PATH) -> None:
+        self.gpkg_path = gpkg_path
+        self._lock = threading.Lock()
+        self._stamp: str | None = None
+        self._layers: List[str] | None = None
+        self._schemas: Dict[str, LayerSchema] = {}
+
+    def version(self) -> str:
+        stamp = gpkg_stamp(self.gpkg_path)
+        if stamp != self._stamp:
+            with self._lock:
+                if stamp != self._stamp:
+                    self._stamp = stamp
+                    self._layers = None
+                    self._schemas = {}
+        return stamp
+
+    def layers(self) -> List[str]:
+        self.version()
+        layers = self._layers
+        if layers is None:
+            layers = list_layers(self.gpkg_path)
+            with self._lock:
+                self._layers = layers
+        return list(layers)
+
+    def schema(self, layer: str) -> LayerSchema:
+        self.version()
+        schema = self._schemas.get(layer)
+        if schema is None:
+            schema = _schema_from_columns(get_table_columns(layer, self.gpkg_path))
+            # only real layers are cached, so arbitrary names cannot grow the cache
+            if layer in self.layers():
+                with self._lock:
+                    self._schemas[layer] = schema
+        return schema
+
+    def columns(self, layer: str) -> List[Tuple[str, str]]:
+        return list(self.schema(layer).columns)
+
+    def numeric_fields(self, layer: str) -> List[str]:
+        return list(self.schema(layer).numeric_fields)
+
+    def variable_fields(self, layer: str) -> List[str]:
+        return list(self.schema(layer).variable_fields)
+
+
+catalog = LayerCatalog()
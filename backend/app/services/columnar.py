@@ -0,0 +1,269 @@
+from __future__ import annotations
+
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from app.config import COLUMNAR_DIR, GPKG_PATH
+from app.services.gpkg_index import gpkg_stamp
+from app.services.catalog import LayerCatalog, catalog
+from app.services.gpkg_reader import connection, resolve_rowids, resolve_rowids_grouped
+
+# Column store for the numeric n_ variables of a layer, extracted once per GPKG
+# version into .npy files that are opened as read-only memmaps (pages are shared by
+# every worker process through the OS page cache).
+#
+#   values.npy   float64 (n_columns, n_rows), one contiguous block per column
+#   fids.npy     int64 layer rowid of each row, ascending
+#   ids.npy      int64 CAST(ID_ENTIDAD AS INTEGER) of the rows that have one, sorted
+#   id_rows.npy  int64 row offset for each entry of ids.npy
+#   columns.json column names in values.npy order
+#
+# _FORMAT is part of the directory name, so stores written in another layout are
+# rebuilt and then dropped like those of an earlier GPKG version.
+_FORMAT = 2
+
+_stores: Dict[Tuple[str, str], "ColumnStore"] = {}
+_lock = threading.Lock()
+
+
+def _store_dir(layer: str, stamp: str, base_dir: Path = COLUMNAR_DIR) -> Path:
+    return base_dir / f'{re.sub(r"[^0-9A-Za-z_-]+", "_", stamp)}_v{_FORMAT}' / layer
+
+
+class ColumnStore:
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.columns: List[str] = json.loads((path / "columns.json").read_text(encoding="utf-8"))
+        self._col_idx = {c: i for i, c in enumerate(self.columns)}
+        self.values = np.load(path / "values.npy", mmap_mode="r")
+        self.fids = np.load(path / "fids.npy", mmap_mode="r")
+        self.ids = np.load(path / "ids.npy", mmap_mode="r")
+        self.id_rows = np.load(path / "id_rows.npy", mmap_mode="r")
+
+    def has_columns(self, columns: List[str]) -> bool:
+        return all(c in self._col_idx for c in columns)
+
+    def rows_for_ids(self, filter_ids: List[int]) -> np.ndarray:
+        query = np.unique(np.asarray(filter_ids, dtype=np.int64))
+        left = np.searchsorted(self.ids, query, side="left")
+        right = np.searchsorted(self.ids, query, side="right")
+        counts = right - left
+        total = int(counts.sum())
+        if total == 0:
+            return np.empty(0, dtype=np.int64)
+        # expand every [left, right) range without a Python loop
+        starts = np.repeat(left, counts)
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        return np.sort(self.id_rows[starts + offsets])
+
+    def rows_for_id_groups(self, group_ids: List[List[int]]) -> Tuple[np.ndarray, np.ndarray]:
+        # rows of every group and, aligned with them, the position of their group
+        queries = [np.unique(np.asarray(ids, dtype=np.int64)) for ids in group_ids]
+        query = np.concatenate(queries) if queries else np.empty(0, dtype=np.int64)
+        query_grp = np.repeat(np.arange(len(queries)), [len(q) for q in queries])
+        left = np.searchsorted(self.ids, query, side="left")
+        counts = np.searchsorted(self.ids, query, side="right") - left
+        total = int(counts.sum())
+        if total == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        starts = np.repeat(left, counts)
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        return self.id_rows[starts + offsets], np.repeat(query_grp, counts)
+
+    def rows_for_fids(self, fids: List[int]) -> np.ndarray:
+        query = np.unique(np.asarray(fids, dtype=np.int64))
+        pos = np.searchsorted(self.fids, query)
+        found = pos < len(self.fids)
+        pos, query = pos[found], query[found]
+        return pos[self.fids[pos] == query]
+
+    def aggregate_rows(self, columns: List[str], rows: np.ndarray) -> Tuple[Dict[str, float], int]:
+        sum_cols = list(dict.fromkeys(columns))
+        if len(rows) == 0 or not sum_cols:
+            return {c: 0.0 for c in sum_cols}, int(len(rows))
+        col_idx = np.array([self._col_idx[c] for c in sum_cols], dtype=np.int64)
+        sums = self.values[np.ix_(col_idx, rows)].sum(axis=1)
+        return {c: float(v) for c, v in zip(sum_cols, sums)}, int(len(rows))
+
+    def aggregate_groups(
+        self, columns: List[str], rows: np.ndarray, labels: np.ndarray, n_groups: int
+    ) -> List[Tuple[Dict[str, float], int]]:
+        sum_cols = list(dict.fromkeys(columns))
+        counts = np.bincount(labels, minlength=n_groups)
+        sums = np.zeros((len(sum_cols), n_groups), dtype=np.float64)
+        if len(rows) and sum_cols:
+            # gather in row order (sequential reads of the memmap), then one bincount per column
+            order = np.argsort(rows, kind="stable")
+            rows, labels = rows[order], labels[order]
+            col_idx = np.array([self._col_idx[c] for c in sum_cols], dtype=np.int64)
+            block = self.values[np.ix_(col_idx, rows)]
+            for i in range(len(sum_cols)):
+                sums[i] = np.bincount(labels, weights=block[i], minlength=n_groups)
+        return [
+            ({c: float(sums[i, grp]) for i, c in enumerate(sum_cols)}, int(counts[grp]))
+            for grp in range(n_groups)
+        ]
+
+
+def build_store(layer: str, gpkg_path: Path = GPKG_PATH, base_dir: Path = COLUMNAR_DIR) -> Path:
+    stamp = gpkg_stamp(gpkg_path)
+    target = _store_dir(layer, stamp, base_dir)
+    if (target / "columns.json").exists():
+        return target
+
+    layer_catalog = catalog if gpkg_path == catalog.gpkg_path else LayerCatalog(gpkg_path)
+    columns = layer_catalog.variable_fields(layer)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(prefix=f".{layer}_", dir=target.parent))
+    try:
+        with connection(gpkg_path) as con:
+            n_rows = int(con.execute(f"SELECT COUNT(*) FROM {layer}").fetchone()[0])
+            values = np.lib.format.open_memmap(
+                tmp_dir / "values.npy", mode="w+", dtype=np.float64, shape=(len(columns), n_rows)
+            )
+            fids = np.empty(n_rows, dtype=np.int64)
+            ids = np.zeros(n_rows, dtype=np.int64)
+            has_id = np.zeros(n_rows, dtype=bool)
+            cols_sql = "".join([f', COALESCE("{c}", 0)' for c in columns])
+            cur = con.execute(f"SELECT rowid, CAST(ID_ENTIDAD AS INTEGER){cols_sql} FROM {layer} ORDER BY rowid")
+            offset = 0
+            while True:
+                batch = cur.fetchmany(20000)
+                if not batch:
+                    break
+                end = offset + len(batch)
+                # rowids and ids stay int64; only the variables go through float64
+                fid_col, id_col, *value_cols = zip(*batch)
+                fids[offset:end] = fid_col
+                present = np.fromiter((i is not None for i in id_col), dtype=bool, count=len(batch))
+                has_id[offset:end] = present
+                ids[offset:end] = [0 if i is None else i for i in id_col]
+                if value_cols:
+                    values[:, offset:end] = np.asarray(value_cols, dtype=np.float64)
+                offset = end
+        values.flush()
+        del values
+
+        # rows without ID_ENTIDAD are left out of the id lookup
+        id_rows = np.flatnonzero(has_id[:offset])
+        id_rows = id_rows[np.argsort(ids[id_rows], kind="stable")]
+        np.save(tmp_dir / "fids.npy", fids[:offset])
+        np.save(tmp_dir / "ids.npy", ids[id_rows])
+        np.save(tmp_dir / "id_rows.npy", id_rows.astype(np.int64))
+        (tmp_dir / "columns.json").write_text(json.dumps(columns), encoding="utf-8")
+        try:
+            os.replace(tmp_dir, target)
+        except OSError:
+            # another process finished the same build first
+            if not (target / "columns.json").exists():
+                raise
+    finally:
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    _drop_old_versions(layer, target)
+    return target
+
+
+def _drop_old_versions(layer: str, target: Path) -> None:
+    # stores of this layer built from earlier GPKG versions are never read again
+    for version_dir in target.parent.parent.iterdir():
+        old = version_dir / layer
+        if version_dir == target.parent or not old.is_dir():
+            continue
+        shutil.rmtree(old, ignore_errors=True)
+        try:
+            version_dir.rmdir()
+        except OSError:
+            # other layers of that version are still there
+            pass
+
+
+def get_store(layer: str, gpkg_path: Path = GPKG_PATH, build: bool = True) -> ColumnStore | None:
+    stamp = gpkg_stamp(gpkg_path)
+    key = (layer, stamp)
+    store = _stores.get(key)
+    if store is not None:
+        return store
+    with _lock:
+        store = _stores.get(key)
+        if store is not None:
+            return store
+        path = _store_dir(layer, stamp)
+        if not (path / "columns.json").exists():
+            if not build:
+                return None
+            path = build_store(layer, gpkg_path)
+        store = ColumnStore(path)
+        for old_key in [k for k in _stores if k[0] == layer]:
+            del _stores[old_key]
+        _stores[key] = store
+        return store
+
+
+def aggregate_columnar(
+    layer: str,
+    columns: List[str],
+    filter_ids: List[int] | None = None,
+    names: List[Tuple[str, str, str]] | None = None,
+    gpkg_path: Path = GPKG_PATH,
+) -> Tuple[Dict[str, float], int] | None:
+    store = get_store(layer, gpkg_path)
+    if store is None or not store.has_columns(columns):
+        return None
+    if filter_ids:
+        rows = store.rows_for_ids(filter_ids)
+    elif names:
+        rows = store.rows_for_fids(resolve_rowids(layer, names=names, gpkg_path=gpkg_path))
+    else:
+        rows = np.empty(0, dtype=np.int64)
+    return store.aggregate_rows(columns, rows)
+
+
+def aggregate_columnar_grouped(
+    layer: str,
+    columns: List[str],
+    group_ids: List[List[int]] | None = None,
+    group_names: List[List[Tuple[str, str, str]]] | None = None,
+    gpkg_path: Path = GPKG_PATH,
+) -> List[Tuple[Dict[str, float], int]] | None:
+    store = get_store(layer, gpkg_path)
+    if store is None or not store.has_columns(columns):
+        return None
+    if group_ids:
+        rows, labels = store.rows_for_id_groups(group_ids)
+        n_groups = len(group_ids)
+    else:
+        group_rows = [
+            store.rows_for_fids(fids)
+            for fids in resolve_rowids_grouped(layer, group_names=group_names, gpkg_path=gpkg_path)
+        ]
+        n_groups = len(group_rows)
+        rows = np.concatenate(group_rows) if group_rows else np.empty(0, dtype=np.int64)
+        labels = np.repeat(np.arange(n_groups), [len(r) for r in group_rows])
+    return store.aggregate_groups(columns, rows, labels, n_groups)
+
+
+def main(argv: List[str]) -> None:
+    from app.services.gpkg_reader import list_layers
+
+    layers = argv or list_layers()
+    for layer in layers:
+        try:
+            path = build_store(layer)
+        except Exception as exc:
+            print(f"{layer}: sin almacén columnar ({exc})")
+            continue
+        print(f"{layer}: {path}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,23 +1,34 @@
 from __future__ import annotations
 
+import pickle
+import threading
 from pathlib import Path
 from typing import Dict
 
 import pandas as pd
 
-from app.config import DICT_PATH
+from app.config import CACHE_DIR, DICT_PATH
+from app.services.fingerprint import file_sha256
 
+FieldMeta = Dict[str, object]
+SheetMap = Dict[str, FieldMeta]
 
-def load_dictionary(layer: str, dict_path: Path = DICT_PATH) -> pd.DataFrame:
-    raw = pd.read_excel(dict_path, sheet_name=layer, header=None, engine="openpyxl")
+# Parsed workbooks keyed by content hash: {sheet: {field: meta}}, or None for sheets
+# without a "Nombre de campo" header row.
+_parsed: Dict[str, Dict[str, SheetMap | None]] = {}
+_lock = threading.Lock()
+
+
+def _parse_sheet(raw: pd.DataFrame) -> SheetMap | None:
     header_row = raw.index[
         raw.iloc[:, 0].astype(str).str.strip().str.lower() == "nombre de campo"
     ]
     if len(header_row) == 0:
-        raise ValueError("No se encontró fila de encabezados en el diccionario")
-    header_idx = int(header_row[0])
+        return None
+    header_pos = raw.index.get_loc(header_row[0])
 
-    df = pd.read_excel(dict_path, sheet_name=layer, header=header_idx, engine="openpyxl")
+    df = raw.iloc[header_pos + 1 :].copy()
+    df.columns = [str(c) for c in raw.iloc[header_pos].tolist()]
     df = df.rename(
         columns={
             "Nombre de campo": "field",
@@ -31,11 +42,6 @@ def load_dictionary(layer: str, dict_path: Path = DICT_PATH) -> pd.DataFrame:
     df["field"] = df["field"].astype(str).str.strip()
     df["dtype"] = df["dtype"].astype(str).str.strip()
     df["description"] = df["description"].astype(str).str.strip()
-    return df
-
-
-def dictionary_map(layer: str) -> Dict[str, Dict[str, str]]:
-    df = load_dictionary(layer)
     return {
         row.field: {
             "dtype": row.dtype,
@@ -44,3 +50,56 @@ def dictionary_map(layer: str) -> Dict[str, Dict[str, str]]:
         }
         for row in df.itertuples(index=False)
     }
+
+
+def _load_workbook(dict_path: Path) -> Dict[str, SheetMap | None]:
+    digest = file_sha256(dict_path)
+    parsed = _parsed.get(digest)
+    if parsed is not None:
+        return parsed
+
+    with _lock:
+        parsed = _parsed.get(digest)
+        if parsed is not None:
+            return parsed
+
+        cache_path = CACHE_DIR / f"diccionario_{digest[:32]}.pkl"
+        if cache_path.exists():
+            try:
+                parsed = pickle.loads(cache_path.read_bytes())
+            except Exception:
+                parsed = None
+
+        if parsed is None:
+            # every sheet in a single workbook open
+            sheets = pd.read_excel(dict_path, sheet_name=None, header=None, engine="openpyxl")
+            parsed = {name: _parse_sheet(raw) for name, raw in sheets.items()}
+            tmp_path = cache_path.with_suffix(".tmp")
+            tmp_path.write_bytes(pickle.dumps(parsed, protocol=pickle.HIGHEST_PROTOCOL))
+            tmp_path.replace(cache_path)
+
+        _parsed.clear()
+        _parsed[digest] = parsed
+        return parsed
+
+
+def _sheet_map(layer: str, dict_path: Path) -> SheetMap:
+    parsed = _load_workbook(dict_path)
+    if layer not in parsed:
+        raise ValueError(f"No existe la hoja {layer} en el diccionario")
+    sheet = parsed[layer]
+    if sheet is None:
+        raise ValueError("No se encontró fila de encabezados en el diccionario")
+    return sheet
+
+
+def load_dictionary(layer: str, dict_path: Path = DICT_PATH) -> pd.DataFrame:
+    sheet = _sheet_map(layer, dict_path)
+    return pd.DataFrame(
+        [{"field": field, **meta} for field, meta in sheet.items()],
+        columns=["field", "dtype", "description", "visual"],
+    )
+
+
+def dictionary_map(layer: str, dict_path: Path = DICT_PATH) -> Dict[str, Dict[str, str]]:
+    return _sheet_map(layer, dict_path)
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, TypeVar
+
+from app.config import PARSE_QUEUE_MAX, PARSE_WORKERS
+from app.services.jobs import QueueFullError
+
+T = TypeVar("T")
+
+
+# Runs blocking work (openpyxl/pandas parsing, SQLite) off the event loop on a fixed
+# number of threads, rejecting new work once max_queue calls are already waiting.
+class BoundedExecutor:
+    def __init__(self, name: str, max_workers: int, max_queue: int) -> None:
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._rejected = 0
+
+    async def run(self, fn: Callable[..., T], *args: object) -> T:
+        with self._lock:
+            if self._queued >= self.max_queue:
+                self._rejected += 1
+                raise QueueFullError("El servidor está procesando demasiados archivos; intente nuevamente")
+            self._queued += 1
+        started = False
+
+        def call() -> T:
+            nonlocal started
+            with self._lock:
+                started = True
+                self._queued -= 1
+                self._running += 1
+            try:
+                return fn(*args)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._completed += 1
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+        finally:
+            with self._lock:
+                # cancelled before a thread picked it up
+                if not started:
+                    self._queued -= 1
+                    started = True
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "queued": self._queued,
+                # everything accepted and not finished yet
+                "depth": self._running + self._queued,
+                "completed": self._completed,
+                "rejected": self._rejected,
+            }
+
+
+parse_executor = BoundedExecutor("parse", PARSE_WORKERS, PARSE_QUEUE_MAX)
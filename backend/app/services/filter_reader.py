@@ -1,8 +1,15 @@
 from __future__ import annotations
 
+import csv
+from pathlib import Path
 from typing import Dict, List, Tuple
 
+import numpy as np
 import pandas as pd
+from openpyxl import load_workbook
+
+FILTER_COLUMNS = ("ID_ENTIDAD", "ENTIDAD", "LOCALIDAD", "COMUNA")
+FILTER_SUFFIXES = {".xlsx", ".xlsm", ".csv", ".parquet"}
 
 
 def normalize_id(value) -> int | None:
@@ -26,34 +33,169 @@ def normalize_id(value) -> int | None:
     return None
 
 
-def read_filter_excel(path: str) -> Dict[str, object]:
-    df = pd.read_excel(path, engine="openpyxl")
-    df.columns = [str(c).strip().upper() for c in df.columns]
+def _normalize_column(name: object, position: int) -> str:
+    if name is None or (isinstance(name, float) and np.isnan(name)):
+        name = f"Unnamed: {position}"
+    return str(name).strip().upper()
+
+
+_INT64_LIMIT = 2**63
+
+
+def normalize_ids(series: pd.Series) -> List[int]:
+    # integers and integer text never go through float64, which rounds ids beyond
+    # 2**53; other numbers (12.0 from a spreadsheet) are truncated as before
+    if pd.api.types.is_integer_dtype(series.dtype):
+        return list(dict.fromkeys(series.dropna().astype(np.int64).tolist()))
+    if not pd.api.types.is_float_dtype(series.dtype):
+        text = series.astype("string").str.strip()
+        whole = text.str.fullmatch(r"[+-]?\d+").fillna(False).to_numpy(dtype=bool)
+        parsed = [int(v) for v in text[whole].tolist()]
+        in_range = np.fromiter((-_INT64_LIMIT <= v < _INT64_LIMIT for v in parsed), dtype=bool, count=len(parsed))
+        whole_pos = np.flatnonzero(whole)[in_range]
+        whole_ids = np.array([v for v, ok in zip(parsed, in_range) if ok], dtype=np.int64)
+        series = text[~whole]
+    else:
+        whole_pos = np.empty(0, dtype=np.int64)
+        whole_ids = np.empty(0, dtype=np.int64)
+        whole = np.zeros(len(series), dtype=bool)
+    values = pd.to_numeric(series, errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+    finite = np.isfinite(values) & (np.abs(values) < _INT64_LIMIT)
+    float_pos = np.flatnonzero(~whole)[finite]
+    positions = np.concatenate([whole_pos, float_pos])
+    ids = np.concatenate([whole_ids, values[finite].astype(np.int64)])
+    # back to the order of the file
+    ids = ids[np.argsort(positions, kind="stable")]
+    return list(dict.fromkeys(ids.tolist()))
+
+
+def _text_column(df: pd.DataFrame, col: str | None) -> pd.Series:
+    if not col:
+        return pd.Series("", index=df.index, dtype=object)
+    return df[col].astype(object).where(df[col].notna(), "").astype(str)
 
-    id_col = "ID_ENTIDAD" if "ID_ENTIDAD" in df.columns else None
-    entidad_col = "ENTIDAD" if "ENTIDAD" in df.columns else None
-    localidad_col = "LOCALIDAD" if "LOCALIDAD" in df.columns else None
-    comuna_col = "COMUNA" if "COMUNA" in df.columns else None
 
-    ids: List[int] = []
-    if id_col:
-        for v in df[id_col].tolist():
-            nid = normalize_id(v)
-            if nid is not None:
-                ids.append(nid)
+def _entities(df: pd.DataFrame) -> Tuple[List[int], List[Tuple[str, str, str]]]:
+    ids: List[int] = normalize_ids(df["ID_ENTIDAD"]) if "ID_ENTIDAD" in df.columns else []
 
     names: List[Tuple[str, str, str]] = []
-    if entidad_col:
-        for _, row in df.iterrows():
-            ent = str(row.get(entidad_col, "")).strip()
-            loc = str(row.get(localidad_col, "")) if localidad_col else ""
-            com = str(row.get(comuna_col, "")) if comuna_col else ""
-            if ent:
-                names.append((ent, loc, com))
-
-    return {
-        "rows": int(len(df.index)),
-        "columns": list(df.columns),
-        "ids": list(dict.fromkeys(ids)),
+    if "ENTIDAD" in df.columns:
+        ent = _text_column(df, "ENTIDAD").str.strip()
+        loc = _text_column(df, "LOCALIDAD" if "LOCALIDAD" in df.columns else None)
+        com = _text_column(df, "COMUNA" if "COMUNA" in df.columns else None)
+        mask = (ent != "").to_numpy()
+        names = list(zip(ent[mask].tolist(), loc[mask].tolist(), com[mask].tolist()))
+    return ids, names
+
+
+def _filter_from_frame(
+    df: pd.DataFrame, columns: List[str], rows: int, group_column: str | None = None
+) -> Dict[str, object]:
+    df.columns = [str(c).strip().upper() for c in df.columns]
+
+    ids, names = _entities(df)
+    result: Dict[str, object] = {
+        "rows": int(rows),
+        "columns": columns,
+        "ids": ids,
         "names": names,
     }
+    if group_column:
+        if group_column not in df.columns:
+            raise ValueError(f"El filtro no tiene la columna {group_column}")
+        # entities of every value of the grouping column, in order of appearance
+        keys = _text_column(df, group_column).str.strip()
+        present = keys != ""
+        groups: Dict[str, Dict[str, object]] = {}
+        for key, part in df[present].groupby(keys[present], sort=False):
+            group_ids, group_names = _entities(part)
+            groups[str(key)] = {"ids": group_ids, "names": group_names}
+        result["groups"] = groups
+    return result
+
+
+def _wanted(group_column: str | None) -> set[str]:
+    return set(FILTER_COLUMNS) | ({group_column} if group_column else set())
+
+
+def read_filter_excel(path: str, group_column: str | None = None) -> Dict[str, object]:
+    # read-only openpyxl streams rows, keeping only the filter columns in memory
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        rows_iter = ws.iter_rows(values_only=True)
+        header = next(rows_iter, None) or ()
+        columns = [_normalize_column(name, i) for i, name in enumerate(header)]
+        wanted = {}
+        filter_columns = _wanted(group_column)
+        for i, name in enumerate(columns):
+            if name in filter_columns and name not in wanted:
+                wanted[name] = i
+
+        data: Dict[str, List[object]] = {name: [] for name in wanted}
+        rows = 0
+        pending_blank = 0
+        for row in rows_iter:
+            if not any(v is not None and v != "" for v in row):
+                # trailing blank rows are not counted, like pandas.read_excel
+                pending_blank += 1
+                continue
+            for _ in range(pending_blank):
+                for values in data.values():
+                    values.append(None)
+            rows += pending_blank + 1
+            pending_blank = 0
+            for name, idx in wanted.items():
+                data[name].append(row[idx] if idx < len(row) else None)
+    finally:
+        wb.close()
+
+    return _filter_from_frame(pd.DataFrame(data), columns, rows, group_column)
+
+
+def _sniff_delimiter(sample: str) -> str:
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=",;\t|").delimiter
+    except csv.Error:
+        return ","
+
+
+def read_filter_csv(path: str, group_column: str | None = None) -> Dict[str, object]:
+    last_error: Exception | None = None
+    for encoding in ("utf-8-sig", "latin-1"):
+        try:
+            with open(path, "r", encoding=encoding, newline="") as fh:
+                sep = _sniff_delimiter(fh.read(64 * 1024))
+            header = pd.read_csv(path, sep=sep, nrows=0, encoding=encoding).columns
+            columns = [_normalize_column(name, i) for i, name in enumerate(header)]
+            usecols = [name for name, norm in zip(header, columns) if norm in _wanted(group_column)]
+            df = pd.read_csv(path, sep=sep, usecols=usecols, dtype=str, encoding=encoding)
+            return _filter_from_frame(df, columns, len(df.index), group_column)
+        except UnicodeDecodeError as exc:
+            last_error = exc
+    raise ValueError(f"No se pudo leer el CSV: {last_error}")
+
+
+def read_filter_parquet(path: str, group_column: str | None = None) -> Dict[str, object]:
+    try:
+        import pyarrow.parquet as pq
+    except ImportError as exc:
+        raise ValueError("Para filtros Parquet se requiere el paquete pyarrow") from exc
+
+    parquet = pq.ParquetFile(path)
+    header = parquet.schema_arrow.names
+    columns = [_normalize_column(name, i) for i, name in enumerate(header)]
+    usecols = [name for name, norm in zip(header, columns) if norm in _wanted(group_column)]
+    df = parquet.read(columns=usecols).to_pandas()
+    return _filter_from_frame(df, columns, parquet.metadata.num_rows, group_column)
+
+
+def read_filter(path: str, group_column: str | None = None) -> Dict[str, object]:
+    # with group_column, "groups" maps each value of that column to its ids and names
+    group_column = group_column.strip().upper() if group_column else None
+    suffix = Path(path).suffix.lower()
+    if suffix == ".csv":
+        return read_filter_csv(path, group_column)
+    if suffix == ".parquet":
+        return read_filter_parquet(path, group_column)
+    return read_filter_excel(path, group_column)
@@ -0,0 +1,32 @@
+from __future__ import annotations
+
+import hashlib
+from pathlib import Path
+from typing import Dict, Iterable, Tuple
+
+_hashes: Dict[Tuple[str, int, int], str] = {}
+
+
+def file_sha256(path: Path) -> str:
+    # memoized by size/mtime so unchanged files are hashed only once per process
+    stat = path.stat()
+    key = (str(path), stat.st_size, stat.st_mtime_ns)
+    digest = _hashes.get(key)
+    if digest is None:
+        h = hashlib.sha256()
+        with path.open("rb") as fh:
+            for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        if len(_hashes) > 1024:
+            _hashes.clear()
+        _hashes[key] = digest
+    return digest
+
+
+def strings_sha256(values: Iterable[str]) -> str:
+    h = hashlib.sha256()
+    for value in values:
+        h.update(str(value).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
@@ -0,0 +1,301 @@
+from __future__ import annotations
+
+import sqlite3
+import sys
+import threading
+import unicodedata
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Set, Tuple
+from urllib.parse import quote
+
+from app.config import GPKG_INDEX_PATH, GPKG_PATH
+
+# Sidecar SQLite file with lookup tables derived from the GPKG. The GPKG itself is
+# never written; every table is tagged with the GPKG size/mtime it was built from.
+
+_build_lock = threading.Lock()
+# (index file, layer, kind, gpkg stamp) seen fresh in this process, so the hot path
+# does not open the sidecar on every request
+_fresh: Set[Tuple[str, str, str, str]] = set()
+
+
+def gpkg_stamp(gpkg_path: Path = GPKG_PATH) -> str:
+    stat = gpkg_path.stat()
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def ids_table(layer: str) -> str:
+    return f"ids_{layer}"
+
+
+def names_table(layer: str) -> str:
+    return f"names_{layer}"
+
+
+def rollup_table(layer: str) -> str:
+    return f"rollup_{layer}"
+
+
+def fold_name(value: object) -> str:
+    if value is None:
+        return ""
+    text = unicodedata.normalize("NFKD", str(value).strip().upper())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return " ".join(text.split())
+
+
+def fold_names(names: Iterable[Tuple[str, str, str]]) -> List[Tuple[str, str, str]]:
+    folded = dict.fromkeys(
+        (fold_name(ent), fold_name(loc), fold_name(com)) for ent, loc, com in names
+    )
+    return [key for key in folded if key[0]]
+
+
+def _connect(index_path: Path) -> sqlite3.Connection:
+    con = sqlite3.connect(index_path, isolation_level=None, timeout=60)
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS index_meta ("
+        "layer TEXT NOT NULL, kind TEXT NOT NULL, gpkg_stamp TEXT NOT NULL, rows INTEGER NOT NULL, "
+        "PRIMARY KEY (layer, kind))"
+    )
+    return con
+
+
+def _is_fresh(con: sqlite3.Connection, layer: str, kind: str, stamp: str) -> bool:
+    row = con.execute(
+        "SELECT gpkg_stamp FROM index_meta WHERE layer = ? AND kind = ?", (layer, kind)
+    ).fetchone()
+    return row is not None and row[0] == stamp
+
+
+def _has_index(layer: str, kind: str, gpkg_path: Path, index_path: Path) -> bool:
+    if not index_path.exists():
+        _fresh.clear()
+        return False
+    key = (str(index_path), layer, kind, gpkg_stamp(gpkg_path))
+    if key in _fresh:
+        return True
+    con = _connect(index_path)
+    try:
+        fresh = _is_fresh(con, layer, kind, key[3])
+    finally:
+        con.close()
+    if fresh:
+        _fresh.add(key)
+    return fresh
+
+
+def _build(
+    layer: str,
+    kind: str,
+    table_sql: str,
+    select_sql: Callable[[sqlite3.Connection], str],
+    transform: Callable[[tuple], tuple] | None,
+    gpkg_path: Path,
+    index_path: Path,
+) -> int:
+    stamp = gpkg_stamp(gpkg_path)
+    table = f"{kind}_{layer}"
+    with _build_lock:
+        con = _connect(index_path)
+        src = sqlite3.connect(f"file:{quote(gpkg_path.resolve().as_posix())}?mode=ro", uri=True)
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            # another worker may have finished the same build while we waited for the lock
+            existing = con.execute(
+                "SELECT gpkg_stamp, rows FROM index_meta WHERE layer = ? AND kind = ?", (layer, kind)
+            ).fetchone()
+            if existing is not None and existing[0] == stamp:
+                con.execute("COMMIT")
+                _fresh.add((str(index_path), layer, kind, stamp))
+                return int(existing[1])
+            con.execute(f'DROP TABLE IF EXISTS "{table}"')
+            con.execute(f'CREATE TABLE "{table}" {table_sql} WITHOUT ROWID')
+            cur = src.execute(select_sql(src))
+            placeholders = ", ".join(["?"] * len(cur.description))
+            rows = 0
+            while True:
+                batch = cur.fetchmany(50000)
+                if not batch:
+                    break
+                if transform is not None:
+                    batch = [transform(row) for row in batch]
+                con.executemany(f'INSERT OR IGNORE INTO "{table}" VALUES ({placeholders})', batch)
+                rows += len(batch)
+            con.execute(
+                "INSERT OR REPLACE INTO index_meta VALUES (?, ?, ?, ?)", (layer, kind, stamp, rows)
+            )
+            con.execute("COMMIT")
+            _fresh.add((str(index_path), layer, kind, stamp))
+            return rows
+        except Exception:
+            if con.in_transaction:
+                con.execute("ROLLBACK")
+            raise
+        finally:
+            src.close()
+            con.close()
+
+
+def has_id_index(layer: str, gpkg_path: Path = GPKG_PATH, index_path: Path = GPKG_INDEX_PATH) -> bool:
+    return _has_index(layer, "ids", gpkg_path, index_path)
+
+
+def build_id_index(layer: str, gpkg_path: Path = GPKG_PATH, index_path: Path = GPKG_INDEX_PATH) -> int:
+    return _build(
+        layer,
+        "ids",
+        "(id_entidad INTEGER NOT NULL, fid INTEGER NOT NULL, PRIMARY KEY (id_entidad, fid))",
+        lambda src: f"SELECT CAST(ID_ENTIDAD AS INTEGER), rowid FROM {layer} WHERE ID_ENTIDAD IS NOT NULL",
+        None,
+        gpkg_path,
+        index_path,
+    )
+
+
+def ensure_id_index(layer: str, gpkg_path: Path = GPKG_PATH, index_path: Path = GPKG_INDEX_PATH) -> bool:
+    if has_id_index(layer, gpkg_path, index_path):
+        return True
+    try:
+        build_id_index(layer, gpkg_path, index_path)
+    except sqlite3.Error:
+        return False
+    return True
+
+
+def has_names_index(layer: str, gpkg_path: Path = GPKG_PATH, index_path: Path = GPKG_INDEX_PATH) -> bool:
+    return _has_index(layer, "names", gpkg_path, index_path)
+
+
+def build_names_index(layer: str, gpkg_path: Path = GPKG_PATH, index_path: Path = GPKG_INDEX_PATH) -> int:
+    def select_sql(src: sqlite3.Connection) -> str:
+        columns = {row[1] for row in src.execute(f"PRAGMA table_info({layer})")}
+        parts = [c if c in columns else "NULL" for c in ["ENTIDAD", "LOCALIDAD", "COMUNA", "ID_ENTIDAD"]]
+        return (
+            f"SELECT {parts[0]}, {parts[1]}, {parts[2]}, rowid, CAST({parts[3]} AS INTEGER) "
+            f"FROM {layer} WHERE ENTIDAD IS NOT NULL"
+        )
+
+    def transform(row: tuple) -> tuple:
+        ent, loc, com, fid, id_entidad = row
+        return (fold_name(ent), fold_name(loc), fold_name(com), fid, id_entidad)
+
+    return _build(
+        layer,
+        "names",
+        "(entidad TEXT NOT NULL, localidad TEXT NOT NULL, comuna TEXT NOT NULL, "
+        "fid INTEGER NOT NULL, id_entidad INTEGER, PRIMARY KEY (entidad, localidad, comuna, fid))",
+        select_sql,
+        transform,
+        gpkg_path,
+        index_path,
+    )
+
+
+def ensure_names_index(layer: str, gpkg_path: Path = GPKG_PATH, index_path: Path = GPKG_INDEX_PATH) -> bool:
+    if has_names_index(layer, gpkg_path, index_path):
+        return True
+    try:
+        build_names_index(layer, gpkg_path, index_path)
+    except sqlite3.Error:
+        return False
+    return True
+
+
+def has_rollup_index(layer: str, gpkg_path: Path = GPKG_PATH, index_path: Path = GPKG_INDEX_PATH) -> bool:
+    return _has_index(layer, "rollup", gpkg_path, index_path)
+
+
+def build_rollup_index(
+    layer: str, columns: List[str], gpkg_path: Path = GPKG_PATH, index_path: Path = GPKG_INDEX_PATH
+) -> int:
+    # sums of the variable columns by (REGION, COMUNA): a few hundred rows from which
+    # comuna, region and national totals are added up without reading the layer
+    def select_sql(src: sqlite3.Connection) -> str:
+        present = {row[1] for row in src.execute(f"PRAGMA table_info({layer})")}
+        region = "REGION" if "REGION" in present else "NULL"
+        comuna = "COMUNA" if "COMUNA" in present else "NULL"
+        sums_sql = "".join([f', SUM(COALESCE("{c}", 0))' for c in columns])
+        return (
+            f"SELECT COALESCE({region}, ''), COALESCE({comuna}, ''), COUNT(*){sums_sql} "
+            f"FROM {layer} GROUP BY 1, 2"
+        )
+
+    cols_sql = "".join([f', "{c}" REAL NOT NULL' for c in columns])
+    return _build(
+        layer,
+        "rollup",
+        f"(region TEXT NOT NULL, comuna TEXT NOT NULL, entities INTEGER NOT NULL{cols_sql}, "
+        "PRIMARY KEY (region, comuna))",
+        select_sql,
+        None,
+        gpkg_path,
+        index_path,
+    )
+
+
+def ensure_rollup_index(
+    layer: str, columns: List[str], gpkg_path: Path = GPKG_PATH, index_path: Path = GPKG_INDEX_PATH
+) -> bool:
+    if has_rollup_index(layer, gpkg_path, index_path):
+        return True
+    try:
+        build_rollup_index(layer, columns, gpkg_path, index_path)
+    except sqlite3.Error:
+        return False
+    return True
+
+
+def read_rollup(
+    layer: str,
+    columns: List[str],
+    regions: Iterable[str] | None = None,
+    areas: Iterable[Tuple[str, str]] | None = None,
+    index_path: Path = GPKG_INDEX_PATH,
+) -> Dict[str, float]:
+    # totals of the given (region, comuna) pairs, of whole regions, or of the country
+    sums_sql = ", ".join([f'COALESCE(SUM("{c}"), 0)' for c in columns])
+    sql = f'SELECT {sums_sql} FROM "{rollup_table(layer)}"'
+    params: List[str] = []
+    if areas is not None:
+        pairs = list(dict.fromkeys(areas))
+        if not pairs:
+            return {c: 0.0 for c in columns}
+        sql += f" WHERE (region, comuna) IN (VALUES {', '.join(['(?, ?)'] * len(pairs))})"
+        params = [part for pair in pairs for part in pair]
+    elif regions is not None:
+        names = list(dict.fromkeys(regions))
+        if not names:
+            return {c: 0.0 for c in columns}
+        sql += f" WHERE region IN ({', '.join(['?'] * len(names))})"
+        params = names
+    con = _connect(index_path)
+    try:
+        row = con.execute(sql, params).fetchone()
+    finally:
+        con.close()
+    return {c: float(value or 0) for c, value in zip(columns, row)}
+
+
+def main(argv: List[str]) -> None:
+    from app.services.catalog import catalog
+    from app.services.gpkg_reader import list_layers
+
+    layers = argv or list_layers()
+    for layer in layers:
+        builders = (
+            ("ids", build_id_index),
+            ("nombres", build_names_index),
+            ("comunas", lambda layer: build_rollup_index(layer, catalog.variable_fields(layer))),
+        )
+        for kind, build in builders:
+            try:
+                rows = build(layer)
+            except sqlite3.Error as exc:
+                print(f"{layer}: sin índice de {kind} ({exc})")
+                continue
+            print(f"{layer}: {rows} {kind}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
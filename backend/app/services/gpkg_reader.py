@@ -1,32 +1,407 @@
 from __future__ import annotations
 
 import sqlite3
+import threading
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, Iterator, List, Sequence, Tuple
+from urllib.parse import quote
 
 import pandas as pd
 
-from app.config import GPKG_PATH
+from app.config import GPKG_CACHE_SIZE_KB, GPKG_INDEX_PATH, GPKG_MMAP_SIZE, GPKG_PATH, GPKG_POOL_SIZE
+from app.services.gpkg_index import (
+    ensure_id_index,
+    ensure_names_index,
+    fold_names,
+    gpkg_stamp,
+    ids_table,
+    names_table,
+)
 
+NUMERIC_TYPES = {
+    "integer",
+    "smallinteger",
+    "mediumint",
+    "double",
+    "real",
+    "float",
+}
 
-def list_layers(gpkg_path: Path = GPKG_PATH) -> List[str]:
-    con = sqlite3.connect(gpkg_path)
+# Read-only connections to each GPKG, shared by every thread: a query checks one
+# out and returns it. At most GPKG_POOL_SIZE are open per file and further queries
+# wait for one to come back. Connections keep their page cache, mmap and statement
+# cache between requests; those of an earlier version of the file are closed.
+_idle: Dict[str, List[Tuple[str, sqlite3.Connection]]] = {}
+_open_count: Dict[str, int] = {}
+_pool_cond = threading.Condition()
+
+
+def _open_connection(gpkg_path: Path) -> sqlite3.Connection:
+    uri = f"file:{quote(gpkg_path.resolve().as_posix())}?mode=ro&immutable=1"
+    con = sqlite3.connect(uri, uri=True, cached_statements=256, check_same_thread=False)
+    con.execute(f"PRAGMA mmap_size = {int(GPKG_MMAP_SIZE)}")
+    con.execute(f"PRAGMA cache_size = -{int(GPKG_CACHE_SIZE_KB)}")
+    con.execute("PRAGMA temp_store = MEMORY")
+    con.execute("PRAGMA query_only = 1")
+    return con
+
+
+@contextmanager
+def connection(gpkg_path: Path = GPKG_PATH) -> Iterator[sqlite3.Connection]:
+    # never nest: a thread holding a connection that waits for another can starve the pool
+    key = str(gpkg_path)
+    stamp = gpkg_stamp(gpkg_path)
+    con = None
+    with _pool_cond:
+        while con is None:
+            idle = _idle.setdefault(key, [])
+            while idle and con is None:
+                idle_stamp, idle_con = idle.pop()
+                if idle_stamp == stamp:
+                    con = idle_con
+                else:
+                    idle_con.close()
+                    _open_count[key] -= 1
+            if con is not None or _open_count.get(key, 0) < GPKG_POOL_SIZE:
+                break
+            _pool_cond.wait()
+        if con is None:
+            _open_count[key] = _open_count.get(key, 0) + 1
+    if con is None:
+        try:
+            con = _open_connection(gpkg_path)
+        except BaseException:
+            with _pool_cond:
+                _open_count[key] -= 1
+                _pool_cond.notify()
+            raise
     try:
-        cur = con.cursor()
-        cur.execute("SELECT table_name FROM gpkg_contents ORDER BY table_name")
-        return [row[0] for row in cur.fetchall()]
+        yield con
     finally:
-        con.close()
+        with _pool_cond:
+            _idle[key].append((stamp, con))
+            _pool_cond.notify()
 
 
-def get_table_columns(layer: str, gpkg_path: Path = GPKG_PATH) -> List[Tuple[str, str]]:
-    con = sqlite3.connect(gpkg_path)
+@contextmanager
+def _temp_writes(con: sqlite3.Connection) -> Iterator[sqlite3.Cursor]:
+    # query_only also blocks the temp schema; lift it just while filling filter tables
+    con.execute("PRAGMA query_only = 0")
     try:
-        cur = con.cursor()
-        cur.execute(f"PRAGMA table_info({layer})")
-        return [(row[1], row[2]) for row in cur.fetchall()]
+        yield con.cursor()
+        con.commit()
     finally:
-        con.close()
+        con.execute("PRAGMA query_only = 1")
+
+
+def _attach_index(con: sqlite3.Connection) -> None:
+    attached = {row[1] for row in con.execute("PRAGMA database_list")}
+    if "idx" not in attached:
+        con.execute("ATTACH DATABASE ? AS idx", (str(GPKG_INDEX_PATH),))
+
+
+def _id_filter_source(
+    con: sqlite3.Connection,
+    layer: str,
+    filter_ids: List[int],
+    gpkg_path: Path,
+) -> str:
+    # ids go through a temp table (no SQLite variable limit) and, when the sidecar
+    # index is available, resolve to rowids with an indexed join instead of a scan
+    with _temp_writes(con) as cur:
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS filter_ids (id INTEGER PRIMARY KEY)")
+        cur.execute("DELETE FROM temp.filter_ids")
+        cur.executemany("INSERT OR IGNORE INTO temp.filter_ids VALUES (?)", ((int(i),) for i in filter_ids))
+
+    if gpkg_path == GPKG_PATH and ensure_id_index(layer, gpkg_path):
+        _attach_index(con)
+        return (
+            f'FROM temp.filter_ids f CROSS JOIN idx."{ids_table(layer)}" x ON x.id_entidad = f.id '
+            f"CROSS JOIN {layer} t ON t.rowid = x.fid"
+        )
+    return f"FROM {layer} t WHERE CAST(t.ID_ENTIDAD AS INTEGER) IN (SELECT id FROM temp.filter_ids)"
+
+
+def _names_filter_sources(
+    con: sqlite3.Connection,
+    layer: str,
+    names: List[Tuple[str, str, str]],
+    gpkg_path: Path,
+    match_localidad: bool = True,
+    match_comuna: bool = True,
+) -> List[Tuple[str, List[str]]]:
+    if gpkg_path == GPKG_PATH and ensure_names_index(layer, gpkg_path):
+        # accent-folded keys from the sidecar index, matched with a single indexed join
+        with _temp_writes(con) as cur:
+            cur.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS filter_names ("
+                "entidad TEXT, localidad TEXT, comuna TEXT, PRIMARY KEY (entidad, localidad, comuna))"
+            )
+            cur.execute("DELETE FROM temp.filter_names")
+            cur.executemany("INSERT OR IGNORE INTO temp.filter_names VALUES (?, ?, ?)", fold_names(names))
+        _attach_index(con)
+        conditions = ["x.entidad = f.entidad"]
+        if match_localidad:
+            conditions.append("x.localidad = f.localidad")
+        if match_comuna:
+            conditions.append("x.comuna = f.comuna")
+        return [
+            (
+                f"FROM {layer} t WHERE t.rowid IN (SELECT x.fid FROM temp.filter_names f "
+                f'CROSS JOIN idx."{names_table(layer)}" x ON {" AND ".join(conditions)})',
+                [],
+            )
+        ]
+
+    # fallback without sidecar: OR-ed expression matches, one full scan per chunk
+    unique_names = list(
+        dict.fromkeys(
+            (str(ent).strip().upper(), str(loc or "").strip().upper(), str(com or "").strip().upper())
+            for ent, loc, com in names
+        )
+    )
+    unique_names = [n for n in unique_names if n[0]]
+
+    def build_where(ent: str, loc: str, com: str) -> Tuple[str, List[str]]:
+        conditions = ["UPPER(TRIM(t.ENTIDAD)) = ?"]
+        params = [ent]
+        if match_localidad:
+            conditions.append("UPPER(TRIM(t.LOCALIDAD)) = ?")
+            params.append(loc)
+        if match_comuna:
+            conditions.append("UPPER(TRIM(t.COMUNA)) = ?")
+            params.append(com)
+        return f"({' AND '.join(conditions)})", params
+
+    sources = []
+    chunk_size = 250
+    for i in range(0, len(unique_names), chunk_size):
+        where_parts = []
+        params: List[str] = []
+        for ent, loc, com in unique_names[i : i + chunk_size]:
+            clause, clause_params = build_where(ent, loc, com)
+            where_parts.append(clause)
+            params.extend(clause_params)
+        sources.append((f"FROM {layer} t WHERE " + " OR ".join(where_parts), params))
+    return sources
+
+
+def _grouped_filter_source(
+    con: sqlite3.Connection,
+    layer: str,
+    group_ids: List[List[int]] | None,
+    group_names: List[List[Tuple[str, str, str]]] | None,
+    gpkg_path: Path,
+) -> str:
+    # every (entity, group position) pair goes to one temp table so all groups are
+    # resolved by a single join; f.grp is the position of the group in the input
+    if group_ids:
+        with _temp_writes(con) as cur:
+            cur.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS group_ids (id INTEGER, grp INTEGER, PRIMARY KEY (id, grp))"
+            )
+            cur.execute("DELETE FROM temp.group_ids")
+            cur.executemany(
+                "INSERT OR IGNORE INTO temp.group_ids VALUES (?, ?)",
+                ((int(i), grp) for grp, ids in enumerate(group_ids) for i in ids),
+            )
+        if gpkg_path == GPKG_PATH and ensure_id_index(layer, gpkg_path):
+            _attach_index(con)
+            return (
+                f'FROM temp.group_ids f CROSS JOIN idx."{ids_table(layer)}" x ON x.id_entidad = f.id '
+                f"CROSS JOIN {layer} t ON t.rowid = x.fid"
+            )
+        return f"FROM {layer} t JOIN temp.group_ids f ON f.id = CAST(t.ID_ENTIDAD AS INTEGER)"
+
+    indexed = gpkg_path == GPKG_PATH and ensure_names_index(layer, gpkg_path)
+    with _temp_writes(con) as cur:
+        cur.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS group_names (entidad TEXT, localidad TEXT, comuna TEXT, "
+            "grp INTEGER, PRIMARY KEY (entidad, localidad, comuna, grp))"
+        )
+        cur.execute("DELETE FROM temp.group_names")
+        for grp, names in enumerate(group_names or []):
+            if indexed:
+                keys = fold_names(names)
+            else:
+                keys = [
+                    (str(ent).strip().upper(), str(loc or "").strip().upper(), str(com or "").strip().upper())
+                    for ent, loc, com in names
+                ]
+            cur.executemany(
+                "INSERT OR IGNORE INTO temp.group_names VALUES (?, ?, ?, ?)",
+                ((ent, loc, com, grp) for ent, loc, com in keys if ent),
+            )
+    if indexed:
+        _attach_index(con)
+        return (
+            f'FROM temp.group_names f CROSS JOIN idx."{names_table(layer)}" x '
+            "ON x.entidad = f.entidad AND x.localidad = f.localidad AND x.comuna = f.comuna "
+            f"CROSS JOIN {layer} t ON t.rowid = x.fid"
+        )
+    return (
+        f"FROM {layer} t JOIN temp.group_names f ON f.entidad = UPPER(TRIM(t.ENTIDAD)) "
+        "AND f.localidad = UPPER(TRIM(t.LOCALIDAD)) AND f.comuna = UPPER(TRIM(t.COMUNA))"
+    )
+
+
+def list_layers(gpkg_path: Path = GPKG_PATH) -> List[str]:
+    with connection(gpkg_path) as con:
+        return [row[0] for row in con.execute("SELECT table_name FROM gpkg_contents ORDER BY table_name")]
+
+
+def get_table_columns(layer: str, gpkg_path: Path = GPKG_PATH) -> List[Tuple[str, str]]:
+    with connection(gpkg_path) as con:
+        return [(row[1], row[2]) for row in con.execute(f"PRAGMA table_info({layer})")]
+
+
+def geometry_column(layer: str, gpkg_path: Path = GPKG_PATH) -> str | None:
+    with connection(gpkg_path) as con:
+        row = con.execute(
+            "SELECT column_name FROM gpkg_geometry_columns WHERE table_name = ?", (layer,)
+        ).fetchone()
+    return row[0] if row is not None else None
+
+
+def load_geometries(
+    layer: str,
+    bboxes: List[Tuple[float, float, float, float]],
+    columns: Sequence[str] = (),
+    gpkg_path: Path = GPKG_PATH,
+    limit: int | None = None,
+) -> List[tuple]:
+    # (rowid, geometry blob, *columns) of the features whose envelope meets any
+    # (minx, miny, maxx, maxy), found through the layer's R-tree when it has one;
+    # with a limit, reading stops once there are more than limit features
+    geom = geometry_column(layer, gpkg_path)
+    if geom is None:
+        raise ValueError(f"La capa {layer} no tiene geometría")
+    with connection(gpkg_path) as con:
+        rtree = f"rtree_{layer}_{geom}"
+        has_rtree = con.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (rtree,)).fetchone() is not None
+        cols_sql = "".join([f', t."{c}"' for c in columns])
+        rows: Dict[int, tuple] = {}
+        for minx, miny, maxx, maxy in bboxes:
+            if has_rtree:
+                sql = (
+                    f'SELECT t.rowid, t."{geom}"{cols_sql} FROM "{rtree}" r CROSS JOIN {layer} t ON t.rowid = r.id '
+                    "WHERE r.minx <= ? AND r.maxx >= ? AND r.miny <= ? AND r.maxy >= ?"
+                )
+                params = (maxx, minx, maxy, miny)
+            else:
+                # without an R-tree every feature is a candidate
+                sql = f'SELECT t.rowid, t."{geom}"{cols_sql} FROM {layer} t WHERE t."{geom}" IS NOT NULL'
+                params = ()
+            for row in con.execute(sql, params):
+                rows[row[0]] = row
+                if limit is not None and len(rows) > limit:
+                    break
+            if not has_rtree or (limit is not None and len(rows) > limit):
+                break
+    return [rows[rowid] for rowid in sorted(rows)]
+
+
+def load_geometries_by_rowid(
+    layer: str,
+    rowids: Sequence[int],
+    columns: Sequence[str] = (),
+    gpkg_path: Path = GPKG_PATH,
+) -> List[tuple]:
+    # (rowid, geometry blob, *columns) of the given features, sorted by rowid
+    geom = geometry_column(layer, gpkg_path)
+    if geom is None:
+        raise ValueError(f"La capa {layer} no tiene geometría")
+    with connection(gpkg_path) as con:
+        with _temp_writes(con) as cur:
+            cur.execute("CREATE TEMP TABLE IF NOT EXISTS filter_rowids (fid INTEGER PRIMARY KEY)")
+            cur.execute("DELETE FROM temp.filter_rowids")
+            cur.executemany("INSERT OR IGNORE INTO temp.filter_rowids VALUES (?)", ((int(i),) for i in rowids))
+        cols_sql = "".join([f', t."{c}"' for c in columns])
+        return con.execute(
+            f'SELECT t.rowid, t."{geom}"{cols_sql} FROM temp.filter_rowids f '
+            f"CROSS JOIN {layer} t ON t.rowid = f.fid ORDER BY t.rowid"
+        ).fetchall()
+
+
+def resolve_rowids(
+    layer: str,
+    filter_ids: List[int] | None = None,
+    names: List[Tuple[str, str, str]] | None = None,
+    gpkg_path: Path = GPKG_PATH,
+) -> List[int]:
+    if not filter_ids and not names:
+        return []
+    with connection(gpkg_path) as con:
+        if filter_ids:
+            sources = [(_id_filter_source(con, layer, filter_ids, gpkg_path), [])]
+        else:
+            sources = _names_filter_sources(con, layer, names or [], gpkg_path)
+        rowids: Dict[int, None] = {}
+        for source, params in sources:
+            for (rowid,) in con.execute(f"SELECT t.rowid {source}", params):
+                rowids[rowid] = None
+    return list(rowids)
+
+
+def entity_areas(
+    layer: str,
+    filter_ids: List[int] | None = None,
+    names: List[Tuple[str, str, str]] | None = None,
+    gpkg_path: Path = GPKG_PATH,
+) -> List[Tuple[str, str]]:
+    # distinct (REGION, COMUNA) of the entity set, spelled as in the layer
+    if not filter_ids and not names:
+        return []
+    with connection(gpkg_path) as con:
+        if filter_ids:
+            sources = [(_id_filter_source(con, layer, filter_ids, gpkg_path), [])]
+        else:
+            sources = _names_filter_sources(con, layer, names or [], gpkg_path)
+        areas: Dict[Tuple[str, str], None] = {}
+        for source, params in sources:
+            for region, comuna in con.execute(
+                f"SELECT DISTINCT COALESCE(t.REGION, ''), COALESCE(t.COMUNA, '') {source}", params
+            ):
+                areas[(region, comuna)] = None
+    return list(areas)
+
+
+def entity_areas_grouped(
+    layer: str,
+    group_ids: List[List[int]] | None = None,
+    group_names: List[List[Tuple[str, str, str]]] | None = None,
+    gpkg_path: Path = GPKG_PATH,
+) -> List[List[Tuple[str, str]]]:
+    # entity_areas of every group from a single join
+    groups = group_ids or group_names or []
+    if not any(groups):
+        return [[] for _ in groups]
+    with connection(gpkg_path) as con:
+        source = _grouped_filter_source(con, layer, group_ids, group_names, gpkg_path)
+        areas: List[Dict[Tuple[str, str], None]] = [{} for _ in groups]
+        for grp, region, comuna in con.execute(
+            f"SELECT DISTINCT f.grp, COALESCE(t.REGION, ''), COALESCE(t.COMUNA, '') {source}"
+        ):
+            areas[grp][(region, comuna)] = None
+    return [list(a) for a in areas]
+
+
+def resolve_rowids_grouped(
+    layer: str,
+    group_ids: List[List[int]] | None = None,
+    group_names: List[List[Tuple[str, str, str]]] | None = None,
+    gpkg_path: Path = GPKG_PATH,
+) -> List[List[int]]:
+    groups = group_ids or group_names or []
+    rowids: List[Dict[int, None]] = [{} for _ in groups]
+    if not any(groups):
+        return [[] for _ in groups]
+    with connection(gpkg_path) as con:
+        source = _grouped_filter_source(con, layer, group_ids, group_names, gpkg_path)
+        for grp, rowid in con.execute(f"SELECT f.grp, t.rowid {source}"):
+            rowids[grp][rowid] = None
+    return [list(r) for r in rowids]
 
 
 def load_layer(
@@ -36,23 +411,14 @@ def load_layer(
     gpkg_path: Path = GPKG_PATH,
 ) -> pd.DataFrame:
     select_cols = list(dict.fromkeys(columns))
-    cols_sql = ", ".join([f'"{c}"' for c in select_cols])
-    sql = f"SELECT {cols_sql} FROM {layer}"
+    cols_sql = ", ".join([f't."{c}"' for c in select_cols])
 
-    if filter_ids:
-        placeholders = ",".join(["?"] * len(filter_ids))
-        sql += f" WHERE CAST(ID_ENTIDAD AS INTEGER) IN ({placeholders})"
-        params = filter_ids
-    else:
-        params = None
-
-    con = sqlite3.connect(gpkg_path)
-    try:
-        df = pd.read_sql_query(sql, con, params=params)
-    finally:
-        con.close()
-
-    return df
+    with connection(gpkg_path) as con:
+        if filter_ids:
+            source = _id_filter_source(con, layer, filter_ids, gpkg_path)
+        else:
+            source = f"FROM {layer} t"
+        return pd.read_sql_query(f"SELECT {cols_sql} {source}", con)
 
 
 def load_layer_by_names(
@@ -65,45 +431,77 @@ def load_layer_by_names(
         return pd.DataFrame(columns=list(dict.fromkeys(columns)))
 
     select_cols = list(dict.fromkeys(columns))
-    cols_sql = ", ".join([f'"{c}"' for c in select_cols])
+    cols_sql = ", ".join([f't."{c}"' for c in select_cols])
 
-    has_localidad = "LOCALIDAD" in select_cols
-    has_comuna = "COMUNA" in select_cols
+    with connection(gpkg_path) as con:
+        sources = _names_filter_sources(
+            con,
+            layer,
+            names,
+            gpkg_path,
+            match_localidad="LOCALIDAD" in select_cols,
+            match_comuna="COMUNA" in select_cols,
+        )
+        chunks = [
+            pd.read_sql_query(f"SELECT {cols_sql} {source}", con, params=params)
+            for source, params in sources
+        ]
 
-    def build_where(ent: str, loc: str, com: str) -> Tuple[str, List[str]]:
-        conditions = ['UPPER(TRIM(ENTIDAD)) = ?']
-        params = [ent]
-        if has_localidad:
-            conditions.append('UPPER(TRIM(LOCALIDAD)) = ?')
-            params.append(loc)
-        if has_comuna:
-            conditions.append('UPPER(TRIM(COMUNA)) = ?')
-            params.append(com)
-        return f"({' AND '.join(conditions)})", params
+    if not chunks:
+        return pd.DataFrame(columns=select_cols)
+    return pd.concat(chunks, ignore_index=True)
 
-    con = sqlite3.connect(gpkg_path)
-    try:
-        chunks = []
-        chunk_size = 250
-        for i in range(0, len(names), chunk_size):
-            where_parts = []
-            params: List[str] = []
-            for ent, loc, com in names[i : i + chunk_size]:
-                ent_norm = str(ent).strip().upper()
-                if not ent_norm:
-                    continue
-                loc_norm = str(loc or "").strip().upper()
-                com_norm = str(com or "").strip().upper()
-                clause, clause_params = build_where(ent_norm, loc_norm, com_norm)
-                where_parts.append(clause)
-                params.extend(clause_params)
-            if not where_parts:
-                continue
-            sql = f"SELECT {cols_sql} FROM {layer} WHERE " + " OR ".join(where_parts)
-            chunks.append(pd.read_sql_query(sql, con, params=params))
-
-        if not chunks:
-            return pd.DataFrame(columns=select_cols)
-        return pd.concat(chunks, ignore_index=True)
-    finally:
-        con.close()
+
+def aggregate_layer(
+    layer: str,
+    columns: List[str],
+    filter_ids: List[int] | None = None,
+    names: List[Tuple[str, str, str]] | None = None,
+    gpkg_path: Path = GPKG_PATH,
+) -> Tuple[Dict[str, float], int]:
+    sum_cols = list(dict.fromkeys(columns))
+    sums_sql = "".join([f'SUM(COALESCE(t."{c}", 0)), ' for c in sum_cols])
+    sql = f"SELECT {sums_sql}COUNT(*) "
+
+    var_sum = {c: 0.0 for c in sum_cols}
+    count = 0
+    if not filter_ids and not names:
+        return var_sum, count
+
+    with connection(gpkg_path) as con:
+        if filter_ids:
+            batches = [(_id_filter_source(con, layer, filter_ids, gpkg_path), [])]
+        else:
+            batches = _names_filter_sources(con, layer, names or [], gpkg_path)
+
+        cur = con.cursor()
+        for source, params in batches:
+            row = cur.execute(sql + source, params).fetchone()
+            for col, value in zip(sum_cols, row[:-1]):
+                var_sum[col] += float(value or 0)
+            count += int(row[-1] or 0)
+
+    return var_sum, count
+
+
+def aggregate_layer_grouped(
+    layer: str,
+    columns: List[str],
+    group_ids: List[List[int]] | None = None,
+    group_names: List[List[Tuple[str, str, str]]] | None = None,
+    gpkg_path: Path = GPKG_PATH,
+) -> List[Tuple[Dict[str, float], int]]:
+    # same sums as aggregate_layer for every group, with one GROUP BY query
+    sum_cols = list(dict.fromkeys(columns))
+    groups = group_ids or group_names or []
+    results = [({c: 0.0 for c in sum_cols}, 0) for _ in groups]
+    if not any(groups):
+        return results
+
+    with connection(gpkg_path) as con:
+        source = _grouped_filter_source(con, layer, group_ids, group_names, gpkg_path)
+        sums_sql = "".join([f', SUM(COALESCE(t."{c}", 0))' for c in sum_cols])
+        for row in con.execute(f"SELECT f.grp{sums_sql}, COUNT(*) {source} GROUP BY f.grp"):
+            var_sum = {col: float(value or 0) for col, value in zip(sum_cols, row[1:-1])}
+            results[row[0]] = (var_sum, int(row[-1] or 0))
+    return results
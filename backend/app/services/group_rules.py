@@ -1,9 +1,17 @@
 from __future__ import annotations
 
-from typing import Dict, List, Tuple
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from types import MappingProxyType
+from typing import Dict, Iterable, List, Mapping, Tuple
 
 import pandas as pd
 
+from app.services.fingerprint import file_sha256, strings_sha256
+from app.services.mapping_reader import load_mapping_csv
+
 
 def _unit_from_vars(vars_list: List[str]) -> str | None:
     if any(v.startswith(("n_hog", "n_tenencia", "n_comb", "n_serv_", "n_internet", "n_serv_tel")) for v in vars_list):
@@ -292,3 +300,73 @@ def build_group_specs(mapping_df: pd.DataFrame, available_fields: List[str]) ->
     group_specs = {title: group_specs[title] for title in ordered_titles}
 
     return group_specs, labels
+
+
+@dataclass(frozen=True)
+class GroupPlan:
+    key: str
+    group_specs: Mapping[str, Mapping[str, object]]
+    labels: Mapping[str, str]
+
+
+def _freeze_spec(spec: Dict) -> Mapping[str, object]:
+    frozen = {}
+    for name, value in spec.items():
+        if isinstance(value, list):
+            value = tuple(value)
+        elif isinstance(value, dict):
+            value = MappingProxyType(dict(value))
+        frozen[name] = value
+    return MappingProxyType(frozen)
+
+
+_PLAN_CACHE_SIZE = 32
+_plans: "OrderedDict[Tuple[str, str], GroupPlan]" = OrderedDict()
+_mappings: Dict[str, pd.DataFrame] = {}
+_plans_lock = threading.Lock()
+
+
+def load_group_plan(mapping_path: Path, available_fields: List[str]) -> GroupPlan:
+    # keyed by CSV content and layer schema; a changed CSV on disk hashes differently
+    csv_hash = file_sha256(mapping_path)
+    schema_hash = strings_sha256(available_fields)
+    key = (csv_hash, schema_hash)
+    with _plans_lock:
+        plan = _plans.get(key)
+        if plan is not None:
+            _plans.move_to_end(key)
+            return plan
+
+    mapping_df = _mappings.get(csv_hash)
+    if mapping_df is None:
+        mapping_df = load_mapping_csv(str(mapping_path))
+        with _plans_lock:
+            _mappings.clear()
+            _mappings[csv_hash] = mapping_df
+
+    group_specs, labels = build_group_specs(mapping_df, list(available_fields))
+    plan = GroupPlan(
+        key=f"{csv_hash[:16]}-{schema_hash[:16]}",
+        group_specs=MappingProxyType({title: _freeze_spec(spec) for title, spec in group_specs.items()}),
+        labels=MappingProxyType(dict(labels)),
+    )
+    with _plans_lock:
+        _plans[key] = plan
+        while len(_plans) > _PLAN_CACHE_SIZE:
+            _plans.popitem(last=False)
+    return plan
+
+
+def select_groups(plan: GroupPlan, groups: Iterable[str]) -> Tuple[Dict[str, Mapping[str, object]], List[str]]:
+    # the requested groups found in the plan and the layer columns they need
+    selected_groups = {g: plan.group_specs[g] for g in groups if g in plan.group_specs}
+    if not selected_groups:
+        raise ValueError("No valid groups selected")
+
+    needed_columns = set()
+    for spec in selected_groups.values():
+        needed_columns.update(spec["variables"])
+        denom = spec.get("denominator")
+        if denom in {"n_per", "n_hog", "n_vp"}:
+            needed_columns.add(denom)
+    return selected_groups, sorted(needed_columns)
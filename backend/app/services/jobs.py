@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Generic, Iterator, Sequence, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Identifies this process in the jobs table: a restarted server can reuse the pid
+# (always 1 in a container), never the token.
+_PROCESS_TOKEN = uuid.uuid4().hex
+
+# Background jobs run on a bounded thread pool in the process that accepted them;
+# their status lives in an SQLite file so any worker process can answer a poll.
+#
+#   status  queued -> running -> done | error
+#   stage   name of the stage running now; progress is the share of stages finished
+
+
+class QueueFullError(Exception):
+    pass
+
+
+# Concurrent calls with the same key share a single execution and its result (or
+# exception) instead of each doing the same work.
+class SingleFlight(Generic[T]):
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: Dict[str, Future] = {}
+
+    def do(self, key: str, fn: Callable[[], T]) -> Tuple[T, bool]:
+        # returns (result, shared); shared is True for callers that waited on another
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+        if not leader:
+            return future.result(), True
+        try:
+            result = fn()
+            future.set_result(result)
+            return result, False
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+
+class JobQueue:
+    def __init__(
+        self,
+        path: Path,
+        stages: Sequence[Tuple[str, str]],
+        max_workers: int = 2,
+        max_pending: int = 32,
+        ttl_seconds: float | None = None,
+    ) -> None:
+        self.path = path
+        self.stages = tuple(stages)
+        self.max_pending = max_pending
+        self.ttl_seconds = ttl_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="job")
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._active: Dict[str, str] = {}
+        con = sqlite3.connect(self.path, timeout=30)
+        try:
+            con.execute("PRAGMA journal_mode = WAL")
+        finally:
+            con.close()
+        with self._db() as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "job_id TEXT PRIMARY KEY, status TEXT NOT NULL, stage TEXT, result TEXT, error TEXT, "
+                "pid INTEGER NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL, owner TEXT)"
+            )
+            if "owner" not in {row[1] for row in con.execute("PRAGMA table_info(jobs)")}:
+                con.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+
+    @contextmanager
+    def _db(self) -> Iterator[sqlite3.Connection]:
+        con = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                yield con
+            except BaseException:
+                con.execute("ROLLBACK")
+                raise
+            con.execute("COMMIT")
+        finally:
+            con.close()
+
+    def _update(self, job_id: str, **fields: Any) -> None:
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._db() as con:
+            con.execute(f"UPDATE jobs SET {assignments} WHERE job_id = ?", (*fields.values(), job_id))
+
+    def submit(self, fn: Callable[[Callable[[str], None]], Dict[str, Any]], key: str | None = None) -> str:
+        # fn receives a callback to report the stage it is starting; while a job with
+        # the same key is queued or running its id is returned instead of a new job
+        with self._pending_lock:
+            if key is not None and key in self._active:
+                return self._active[key]
+            if self._pending >= self.max_pending:
+                raise QueueFullError("Hay demasiados reportes en cola; intente nuevamente en unos minutos")
+            self._pending += 1
+            job_id = uuid.uuid4().hex
+            if key is not None:
+                self._active[key] = job_id
+        now = time.time()
+        try:
+            with self._db() as con:
+                if self.ttl_seconds is not None:
+                    con.execute("DELETE FROM jobs WHERE updated_at < ?", (now - self.ttl_seconds,))
+                con.execute(
+                    "INSERT INTO jobs (job_id, status, pid, created_at, updated_at, owner) "
+                    "VALUES (?, 'queued', ?, ?, ?, ?)",
+                    (job_id, os.getpid(), now, now, _PROCESS_TOKEN),
+                )
+            self._executor.submit(self._run, job_id, fn, key)
+        except BaseException:
+            self._release(key)
+            raise
+        return job_id
+
+    def _release(self, key: str | None) -> None:
+        with self._pending_lock:
+            self._pending -= 1
+            if key is not None:
+                self._active.pop(key, None)
+
+    def _run(self, job_id: str, fn: Callable[[Callable[[str], None]], Dict[str, Any]], key: str | None) -> None:
+        try:
+            self._update(job_id, status="running")
+            result = fn(lambda stage: self._update(job_id, stage=stage))
+            self._update(job_id, status="done", stage=None, result=json.dumps(result, ensure_ascii=False))
+        except Exception as exc:
+            logger.exception("Falló el trabajo %s", job_id)
+            self._update(job_id, status="error", error=str(exc))
+        finally:
+            self._release(key)
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def get(self, job_id: str) -> Dict[str, Any]:
+        with self._db() as con:
+            row = con.execute(
+                "SELECT status, stage, result, error, pid, owner FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            raise KeyError(f"job_id not found: {job_id}")
+        status, stage, result, error, pid, owner = row
+        if status in {"queued", "running"} and not _owner_alive(pid, owner):
+            status, error = "error", "El servidor se reinició antes de terminar el reporte"
+            self._update(job_id, status=status, error=error)
+
+        names = [name for name, _ in self.stages]
+        if status == "done":
+            finished = len(names)
+        elif stage in names:
+            finished = names.index(stage)
+        else:
+            finished = 0
+        return {
+            "job_id": job_id,
+            "status": status,
+            "stage": stage,
+            "stage_label": dict(self.stages).get(stage) if stage else None,
+            "progress": finished / len(names) if names else 0.0,
+            "result": json.loads(result) if result else None,
+            "error": error,
+        }
+
+
+def _owner_alive(pid: int, owner: str | None) -> bool:
+    if owner == _PROCESS_TOKEN:
+        return True
+    if pid == os.getpid():
+        # an earlier process that had our pid
+        return False
+    if os.name == "nt":
+        # on Windows os.kill(pid, 0) would terminate the process
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # exists but belongs to someone else, or the platform cannot tell
+        return True
+    return True
+
@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import json
+import math
+import os
+import re
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from app.config import GPKG_PATH, PREVIEW_DIR
+from app.services.catalog import catalog
+from app.services.gpkg_index import gpkg_stamp
+from app.services.gpkg_reader import load_geometries, load_geometries_by_rowid, resolve_rowids
+from app.services.report_cache import entity_set_key
+from app.services.spatial import ENTITY_COLUMNS, Shape, centroid, decode_geometry
+
+# Simplified GeoJSON for the map preview: XYZ tiles of a whole layer (the usual Web
+# Mercator grid over lon/lat coordinates) and the entities of one filter. Vertices
+# are snapped to a grid of about one pixel at the zoom level, so repeated vertices
+# drop out and entities smaller than a pixel become a point; tiles are clipped to
+# their bounds plus a small margin and refuse more than _TILE_MAX_FEATURES
+# entities. Results are written once per GPKG version and then served from disk:
+#
+#   Cache/preview/<versión GPKG>/<capa>/<z>/<x>/<y>.geojson
+#   Cache/preview/<versión GPKG>/<capa>/filtros/<conjunto de entidades>_<z>.geojson
+#
+# Previews of older versions are removed with `python -m app.services.preview`,
+# never while serving, since other workers may still be reading them.
+
+MIN_ZOOM = 5
+MAX_ZOOM = 18
+_TILE_PIXELS = 256
+# pixels kept around a tile so outlines do not show seams at its edges
+_TILE_MARGIN = 4
+_TILE_MAX_FEATURES = 5000
+# pixels across the selection when the filter preview picks its own detail
+_FIT_PIXELS = 1024
+
+
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    n = 2**z
+
+    def lat(row: int) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return (x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y))
+
+
+def tolerance(zoom: int) -> float:
+    # one pixel of a tile at this zoom, in degrees of longitude
+    return 360 / (2**zoom * _TILE_PIXELS)
+
+
+def _snap_ring(ring: np.ndarray, tol: float) -> np.ndarray | None:
+    grid = np.round(ring / tol).astype(np.int64)
+    keep = np.ones(len(grid), dtype=bool)
+    keep[1:] = (grid[1:] != grid[:-1]).any(axis=1)
+    grid = grid[keep]
+    if len(grid) < 4:
+        return None
+    x, y = grid[:-1, 0], grid[:-1, 1]
+    if not (x * np.roll(y, -1) - np.roll(x, -1) * y).any():
+        # collapsed to a line or a single cell
+        return None
+    return grid
+
+
+def _clip_ring(ring: np.ndarray, box: Tuple[float, float, float, float]) -> np.ndarray | None:
+    # Sutherland-Hodgman against each side of the box, one vectorized pass per side
+    minx, miny, maxx, maxy = box
+    points = ring[:-1]
+    for axis, limit, below in ((0, minx, False), (0, maxx, True), (1, miny, False), (1, maxy, True)):
+        if not len(points):
+            return None
+        following = np.roll(points, -1, axis=0)
+        inside = points[:, axis] <= limit if below else points[:, axis] >= limit
+        crosses = inside != np.roll(inside, -1)
+        delta = following[:, axis] - points[:, axis]
+        t = (limit - points[:, axis]) / np.where(crosses, delta, 1.0)
+        merged = np.empty((2 * len(points), 2))
+        merged[0::2] = points
+        merged[1::2] = points + t[:, None] * (following - points)
+        keep = np.empty(2 * len(points), dtype=bool)
+        keep[0::2] = inside
+        keep[1::2] = crosses
+        points = merged[keep]
+    if len(points) < 3:
+        return None
+    return np.vstack([points, points[:1]])
+
+
+def clip(shape: Shape, box: Tuple[float, float, float, float]) -> Shape:
+    minx, miny, maxx, maxy = box
+    polygons = []
+    for rings in shape.polygons:
+        outer = _clip_ring(rings[0], box)
+        if outer is None:
+            continue
+        holes = [hole for hole in (_clip_ring(ring, box) for ring in rings[1:]) if hole is not None]
+        polygons.append([outer, *holes])
+    x, y = shape.points[:, 0], shape.points[:, 1]
+    points = shape.points[(x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy)]
+    return Shape(polygons=polygons, points=points)
+
+
+def simplify(shape: Shape, tol: float) -> Dict[str, Any] | None:
+    decimals = max(0, math.ceil(-math.log10(tol))) + 1
+
+    def coords(grid: np.ndarray) -> List[Any]:
+        return np.round(grid * tol, decimals).tolist()
+
+    polygons = []
+    for rings in shape.polygons:
+        outer = _snap_ring(rings[0], tol)
+        if outer is None:
+            continue
+        holes = [hole for hole in (_snap_ring(ring, tol) for ring in rings[1:]) if hole is not None]
+        polygons.append([coords(ring) for ring in [outer, *holes]])
+    if len(polygons) == 1:
+        return {"type": "Polygon", "coordinates": polygons[0]}
+    if polygons:
+        return {"type": "MultiPolygon", "coordinates": polygons}
+    if shape.is_empty:
+        return None
+
+    # smaller than a pixel: a point keeps the entity visible
+    points = np.asarray([centroid(shape)]) if shape.polygons else shape.points
+    grid = np.unique(np.round(points / tol).astype(np.int64), axis=0)
+    if len(grid) == 1:
+        return {"type": "Point", "coordinates": coords(grid[0])}
+    return {"type": "MultiPoint", "coordinates": coords(grid)}
+
+
+def _collection(
+    rows: List[tuple], shapes: List[Shape], columns: Sequence[str], tol: float, **members: Any
+) -> bytes:
+    features = []
+    for (rowid, _, *values), shape in zip(rows, shapes):
+        geometry = simplify(shape, tol)
+        if geometry is None:
+            continue
+        features.append(
+            {
+                "type": "Feature",
+                "id": rowid,
+                "geometry": geometry,
+                "properties": dict(zip(columns, values)),
+            }
+        )
+    collection = {"type": "FeatureCollection", **members, "features": features}
+    return json.dumps(collection, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _version_dir(gpkg_path: Path) -> Path:
+    return PREVIEW_DIR / re.sub(r"[^0-9A-Za-z_-]+", "_", gpkg_stamp(gpkg_path))
+
+
+def drop_old_versions(gpkg_path: Path = GPKG_PATH) -> List[Path]:
+    current = _version_dir(gpkg_path)
+    removed = []
+    if PREVIEW_DIR.exists():
+        for old in PREVIEW_DIR.iterdir():
+            if old.is_dir() and old != current:
+                shutil.rmtree(old, ignore_errors=True)
+                removed.append(old)
+    return removed
+
+
+def _cached(path: Path, build: Callable[[], bytes]) -> bytes:
+    if path.exists():
+        return path.read_bytes()
+    data = build()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=path.parent)
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+    return data
+
+
+def _entity_columns(layer: str) -> List[str]:
+    fields = {name for name, _ in catalog.columns(layer)}
+    return [column for column in ENTITY_COLUMNS if column in fields]
+
+
+def layer_tile(layer: str, z: int, x: int, y: int, gpkg_path: Path = GPKG_PATH) -> bytes:
+    if not MIN_ZOOM <= z <= MAX_ZOOM:
+        raise ValueError(f"El zoom debe estar entre {MIN_ZOOM} y {MAX_ZOOM}")
+    if not (0 <= x < 2**z and 0 <= y < 2**z):
+        raise ValueError("Tesela fuera de rango")
+    columns = _entity_columns(layer)
+
+    def build() -> bytes:
+        bounds = tile_bounds(z, x, y)
+        rows = load_geometries(layer, [bounds], columns, gpkg_path, limit=_TILE_MAX_FEATURES)
+        if len(rows) > _TILE_MAX_FEATURES:
+            raise ValueError(f"La tesela tiene más de {_TILE_MAX_FEATURES} entidades; use un zoom mayor")
+        margin = _TILE_MARGIN * tolerance(z)
+        box = (bounds[0] - margin, bounds[1] - margin, bounds[2] + margin, bounds[3] + margin)
+        shapes = [clip(decode_geometry(row[1]), box) for row in rows]
+        return _collection(rows, shapes, columns, tolerance(z))
+
+    return _cached(_version_dir(gpkg_path) / layer / str(z) / str(x) / f"{y}.geojson", build)
+
+
+def filter_geojson(
+    layer: str,
+    filter_ids: List[int] | None = None,
+    names: List[Tuple[str, str, str]] | None = None,
+    zoom: int | None = None,
+    gpkg_path: Path = GPKG_PATH,
+) -> bytes:
+    # the filter's entities in one collection, with the bbox of the selection; without
+    # a zoom the detail is chosen so the whole selection spans about _FIT_PIXELS
+    if zoom is not None and not MIN_ZOOM <= zoom <= MAX_ZOOM:
+        raise ValueError(f"El zoom debe estar entre {MIN_ZOOM} y {MAX_ZOOM}")
+    columns = _entity_columns(layer)
+    key = entity_set_key(filter_ids or [], names or []).replace(":", "_")
+
+    def build() -> bytes:
+        rowids = resolve_rowids(layer, filter_ids=filter_ids, names=names, gpkg_path=gpkg_path)
+        rows = load_geometries_by_rowid(layer, rowids, columns, gpkg_path)
+        shapes = [decode_geometry(row[1]) for row in rows]
+        boxes = np.asarray([shape.bbox() for shape in shapes if not shape.is_empty])
+        if not len(boxes):
+            return _collection([], [], columns, tolerance(MAX_ZOOM))
+        bbox = [*boxes[:, :2].min(axis=0).tolist(), *boxes[:, 2:].max(axis=0).tolist()]
+        if zoom is not None:
+            tol = tolerance(zoom)
+        else:
+            tol = max(max(bbox[2] - bbox[0], bbox[3] - bbox[1]) / _FIT_PIXELS, tolerance(MAX_ZOOM))
+        return _collection(rows, shapes, columns, tol, bbox=bbox)
+
+    name = f"{key}_{zoom if zoom is not None else 'auto'}.geojson"
+    return _cached(_version_dir(gpkg_path) / layer / "filtros" / name, build)
+
+
+def main(argv: List[str]) -> None:
+    for path in drop_old_versions():
+        print(f"eliminado: {path}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from app.config import REPORT_CACHE_MAX_BYTES, REPORT_CACHE_MAX_ENTRIES, REPORT_CACHE_PATH
+from app.services.fingerprint import strings_sha256
+
+# Results of /report, shared by every worker through an SQLite file.
+#
+#   aggregates  (dataset version, layer, entity set, columns) -> var_sum, entities_count
+#   reports     aggregate key + (groups, group plan, localidad) -> table model, file
+#               basename and the formats rendered so far ({"docx": path, ...})
+#
+# The rendered files stay in RESULTS_DIR; a format whose file was removed is simply
+# rendered again. Entries are dropped least recently used first, with their files.
+
+
+def entity_set_key(ids: Iterable[int], names: Iterable[Tuple[str, str, str]]) -> str:
+    # the same entities listed in another order or with repeats give the same key
+    ids = sorted({int(i) for i in ids})
+    if ids:
+        return "ids:" + strings_sha256(ids)
+    folded = sorted({tuple(str(part or "").strip().upper() for part in name) for name in names})
+    return "names:" + strings_sha256("\t".join(name) for name in folded)
+
+
+def aggregate_key(version: str, layer: str, columns: Iterable[str], entities: str) -> str:
+    return strings_sha256(["aggregate", version, layer, entities, *sorted(set(columns))])
+
+
+def report_key(
+    agg_key: str, groups: Iterable[str], plan_key: str, localidad: str, references: Iterable[str] = ()
+) -> str:
+    # reports without reference columns keep the keys they had before those existed
+    refs = [f"ref:{level}" for level in sorted(set(references))]
+    return strings_sha256(["report", agg_key, plan_key, localidad.strip(), *groups, *refs])
+
+
+def _artifacts(entry: Dict[str, object]) -> List[Path]:
+    return [Path(str(path)) for path in dict(entry.get("artifacts") or {}).values()]
+
+
+def _size(entry: Dict[str, object]) -> int:
+    return sum(path.stat().st_size for path in _artifacts(entry) if path.exists())
+
+
+class ReportCache:
+    def __init__(self, path: Path, max_entries: int | None = None, max_bytes: int | None = None) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        con = sqlite3.connect(self.path, timeout=30)
+        try:
+            con.execute("PRAGMA journal_mode = WAL")
+        finally:
+            con.close()
+        with self._db() as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS aggregates ("
+                "key TEXT PRIMARY KEY, var_sum TEXT NOT NULL, entities_count INTEGER NOT NULL, "
+                "last_access REAL NOT NULL)"
+            )
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS reports ("
+                "key TEXT PRIMARY KEY, agg_key TEXT NOT NULL, result TEXT NOT NULL, "
+                "size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            con.execute("CREATE INDEX IF NOT EXISTS aggregates_last_access ON aggregates (last_access)")
+            con.execute("CREATE INDEX IF NOT EXISTS reports_last_access ON reports (last_access)")
+
+    @contextmanager
+    def _db(self) -> Iterator[sqlite3.Connection]:
+        con = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                yield con
+            except BaseException:
+                con.execute("ROLLBACK")
+                raise
+            con.execute("COMMIT")
+        finally:
+            con.close()
+
+    def get_aggregate(self, key: str) -> Tuple[Dict[str, float], int] | None:
+        with self._db() as con:
+            row = con.execute(
+                "SELECT var_sum, entities_count FROM aggregates WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            con.execute("UPDATE aggregates SET last_access = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0]), int(row[1])
+
+    def put_aggregate(self, key: str, var_sum: Dict[str, float], entities_count: int) -> None:
+        with self._db() as con:
+            con.execute(
+                "INSERT OR REPLACE INTO aggregates VALUES (?, ?, ?, ?)",
+                (key, json.dumps(var_sum, separators=(",", ":")), int(entities_count), time.time()),
+            )
+
+    def get_report(self, key: str) -> Dict[str, object] | None:
+        with self._db() as con:
+            row = con.execute("SELECT result FROM reports WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            entry = json.loads(row[0])
+            if "artifacts" not in entry:
+                # written by an older version without a table model
+                self._delete(con, key, entry)
+                return None
+            artifacts = {fmt: path for fmt, path in entry["artifacts"].items() if Path(path).exists()}
+            if artifacts != entry["artifacts"]:
+                entry["artifacts"] = artifacts
+                con.execute(
+                    "UPDATE reports SET result = ?, size = ? WHERE key = ?",
+                    (json.dumps(entry, ensure_ascii=False), _size(entry), key),
+                )
+            con.execute("UPDATE reports SET last_access = ? WHERE key = ?", (time.time(), key))
+        return entry
+
+    def put_report(self, key: str, agg_key: str, entry: Dict[str, object]) -> None:
+        with self._db() as con:
+            row = con.execute("SELECT result FROM reports WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                # a concurrent request built the same report; keep only the newest files
+                self._delete(con, key, json.loads(row[0]), keep=_artifacts(entry))
+            con.execute(
+                "INSERT INTO reports VALUES (?, ?, ?, ?, ?)",
+                (key, agg_key, json.dumps(entry, ensure_ascii=False), _size(entry), time.time()),
+            )
+        self.evict()
+
+    def add_artifact(self, key: str, fmt: str, path: Path) -> Dict[str, object] | None:
+        with self._db() as con:
+            row = con.execute("SELECT result FROM reports WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            entry = json.loads(row[0])
+            previous = entry["artifacts"].get(fmt)
+            if previous and Path(previous) != path:
+                Path(previous).unlink(missing_ok=True)
+            entry["artifacts"][fmt] = str(path)
+            con.execute(
+                "UPDATE reports SET result = ?, size = ?, last_access = ? WHERE key = ?",
+                (json.dumps(entry, ensure_ascii=False), _size(entry), time.time(), key),
+            )
+        self.evict()
+        return entry
+
+    def _delete(
+        self, con: sqlite3.Connection, key: str, entry: Dict[str, object], keep: List[Path] | None = None
+    ) -> None:
+        con.execute("DELETE FROM reports WHERE key = ?", (key,))
+        for path in _artifacts(entry):
+            if keep is None or path not in keep:
+                path.unlink(missing_ok=True)
+
+    def evict(self) -> int:
+        removed = 0
+        with self._db() as con:
+            if self.max_entries is not None:
+                count = int(con.execute("SELECT COUNT(*) FROM aggregates").fetchone()[0])
+                if count > self.max_entries:
+                    con.execute(
+                        "DELETE FROM aggregates WHERE key IN "
+                        "(SELECT key FROM aggregates ORDER BY last_access LIMIT ?)",
+                        (count - self.max_entries,),
+                    )
+                    removed += count - self.max_entries
+                count = int(con.execute("SELECT COUNT(*) FROM reports").fetchone()[0])
+                if count > self.max_entries:
+                    for key, payload in con.execute(
+                        "SELECT key, result FROM reports ORDER BY last_access LIMIT ?",
+                        (count - self.max_entries,),
+                    ).fetchall():
+                        self._delete(con, key, json.loads(payload))
+                        removed += 1
+            if self.max_bytes is not None:
+                total = int(con.execute("SELECT COALESCE(SUM(size), 0) FROM reports").fetchone()[0])
+                if total > self.max_bytes:
+                    for key, payload, size in con.execute(
+                        "SELECT key, result, size FROM reports ORDER BY last_access"
+                    ).fetchall():
+                        if total <= self.max_bytes:
+                            break
+                        self._delete(con, key, json.loads(payload))
+                        total -= int(size)
+                        removed += 1
+        return removed
+
+
+report_cache = ReportCache(
+    REPORT_CACHE_PATH, max_entries=REPORT_CACHE_MAX_ENTRIES, max_bytes=REPORT_CACHE_MAX_BYTES
+)
@@ -0,0 +1,426 @@
+from __future__ import annotations
+
+import threading
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+from app.config import JOB_TTL_SECONDS, JOBS_PATH, REPORT_JOB_QUEUE_MAX, REPORT_JOB_WORKERS, VARIABLES_DICT_PATH
+from app.services.aggregation import aggregate_entities, aggregate_entities_grouped
+from app.services.catalog import catalog
+from app.services.filter_reader import read_filter
+from app.services.group_rules import load_group_plan, select_groups
+from app.services.fingerprint import strings_sha256
+from app.services.jobs import JobQueue, SingleFlight
+from app.services.report_cache import aggregate_key, entity_set_key, report_cache, report_key
+from app.services.rollups import reference_sums, reference_sums_grouped, validate_references
+from app.services.reporting import (
+    REPORT_FORMATS,
+    RenderTask,
+    build_tables,
+    combine_tables,
+    render_formats,
+    render_many,
+    report_basename,
+)
+from app.store import store
+from app.store.session_store import ParsedFilter
+
+# Stages of a report, in order, with the label shown while they run.
+STAGES: Tuple[Tuple[str, str], ...] = (
+    ("resolve", "Resolviendo entidades"),
+    ("aggregate", "Sumando variables"),
+    ("tables", "Armando tablas"),
+    ("render", "Generando archivos"),
+)
+
+Progress = Callable[[str], None]
+
+# report_id -> [lock, threads holding or waiting on it]; the entry lives while anyone uses it
+_render_locks: Dict[str, List] = {}
+_render_locks_guard = threading.Lock()
+_entries: SingleFlight[Dict[str, object]] = SingleFlight()
+
+
+@dataclass(frozen=True)
+class ReportInput:
+    layer: str
+    filter_id: str
+    groups: Tuple[str, ...]
+    localidad: str
+    formats: Tuple[str, ...] = REPORT_FORMATS
+    # reference areas (comuna, region, pais) compared in extra columns
+    references: Tuple[str, ...] = ()
+
+
+@dataclass(frozen=True)
+class BatchInput:
+    layer: str
+    filter_id: str
+    groups: Tuple[str, ...]
+    # column of the filter whose values split it into one report each
+    group_column: str = "LOCALIDAD"
+    formats: Tuple[str, ...] = REPORT_FORMATS
+    # a single set of files with the tables of every group instead of one per group
+    combined: bool = False
+    references: Tuple[str, ...] = ()
+
+
+@dataclass
+class _Plan:
+    selected_groups: Dict[str, Dict]
+    labels: Dict[str, str]
+    columns: List[str]
+    key: str
+
+
+@dataclass
+class _Resolved:
+    parsed: ParsedFilter
+    selected_groups: Dict[str, Dict]
+    labels: Dict[str, str]
+    columns: List[str]
+    agg_key: str
+    rep_key: str
+
+
+def _validate_formats(formats: Tuple[str, ...]) -> None:
+    unknown = [fmt for fmt in formats if fmt not in REPORT_FORMATS]
+    if unknown:
+        raise ValueError(f"Formato no soportado: {', '.join(unknown)}")
+
+
+def validate(inp: ReportInput) -> None:
+    if not inp.localidad:
+        raise ValueError("Debe indicar la localidad/sector")
+    _validate_formats(inp.formats)
+    validate_references(inp.references)
+
+
+def validate_batch(inp: BatchInput) -> None:
+    if not inp.group_column.strip():
+        raise ValueError("Debe indicar la columna que separa las localidades")
+    _validate_formats(inp.formats)
+    validate_references(inp.references)
+
+
+def request_key(inp: ReportInput) -> str:
+    # identical requests: same layer, filter content, groups, localidad and formats
+    filter_blob = store.get(inp.filter_id).path.name
+    formats = ",".join(sorted(set(inp.formats)))
+    references = ",".join(sorted(set(inp.references)))
+    return strings_sha256(["request", inp.layer, filter_blob, inp.localidad, formats, references, *inp.groups])
+
+
+def batch_request_key(inp: BatchInput) -> str:
+    filter_blob = store.get(inp.filter_id).path.name
+    formats = ",".join(sorted(set(inp.formats)))
+    references = ",".join(sorted(set(inp.references)))
+    return strings_sha256(
+        [
+            "batch",
+            inp.layer,
+            filter_blob,
+            inp.group_column.strip().upper(),
+            str(inp.combined),
+            formats,
+            references,
+            *inp.groups,
+        ]
+    )
+
+
+def _plan(layer: str, groups: Tuple[str, ...]) -> _Plan:
+    available_fields = catalog.variable_fields(layer)
+
+    if not VARIABLES_DICT_PATH.exists():
+        raise ValueError("No se encontró data/diccionario_variables.csv")
+
+    plan = load_group_plan(VARIABLES_DICT_PATH, available_fields)
+    selected_groups, columns = select_groups(plan, groups)
+    return _Plan(dict(selected_groups), dict(plan.labels), columns, plan.key)
+
+
+def _resolve(inp: ReportInput) -> _Resolved:
+    validate(inp)
+    parsed = store.get_parsed(inp.filter_id)
+    if parsed is None:
+        parsed = store.save_parsed(inp.filter_id, read_filter(str(store.get(inp.filter_id).path)))
+
+    plan = _plan(inp.layer, inp.groups)
+    agg_key = aggregate_key(catalog.version(), inp.layer, plan.columns, _entities_key(parsed))
+    rep_key = report_key(agg_key, list(plan.selected_groups), plan.key, inp.localidad, inp.references)
+    return _Resolved(parsed, plan.selected_groups, plan.labels, plan.columns, agg_key, rep_key)
+
+
+def _entities_key(parsed: ParsedFilter) -> str:
+    # ids when the filter has them, names otherwise; the same for /report and /report/batch
+    return entity_set_key(parsed.ids, parsed.names)
+
+
+def _by_entities(parsed: List[ParsedFilter], fn: Callable[..., List[Any]]) -> List[Any]:
+    # fn(group_ids=..., group_names=...) over the groups, each matched like /report:
+    # by id when it has ids and by name otherwise
+    results: List[Any] = [None] * len(parsed)
+    with_ids = [i for i, p in enumerate(parsed) if p.ids]
+    with_names = [i for i, p in enumerate(parsed) if not p.ids]
+    if with_ids:
+        for i, result in zip(with_ids, fn(group_ids=[list(parsed[i].ids) for i in with_ids], group_names=None)):
+            results[i] = result
+    if with_names:
+        for i, result in zip(with_names, fn(group_ids=None, group_names=[list(parsed[i].names) for i in with_names])):
+            results[i] = result
+    return results
+
+
+@contextmanager
+def _render_lock(report_id: str) -> Iterator[None]:
+    with _render_locks_guard:
+        slot = _render_locks.setdefault(report_id, [threading.Lock(), 0])
+        slot[1] += 1
+    try:
+        with slot[0]:
+            yield
+    finally:
+        with _render_locks_guard:
+            slot[1] -= 1
+            if not slot[1]:
+                del _render_locks[report_id]
+
+
+def _refresh_artifacts(report_id: str, entry: Dict[str, object]) -> Dict[str, object]:
+    # under the render lock: files another caller rendered while this one waited
+    current = report_cache.get_report(report_id) or entry
+    entry["artifacts"].update(current["artifacts"])
+    return current
+
+
+def ensure_artifacts(report_id: str, entry: Dict[str, object], formats: List[str]) -> Dict[str, str]:
+    # renders the formats not generated yet, concurrently, and reuses the files afterwards
+    if any(not entry["artifacts"].get(fmt) for fmt in formats):
+        with _render_lock(report_id):
+            current = _refresh_artifacts(report_id, entry)
+            missing = [fmt for fmt in formats if not entry["artifacts"].get(fmt)]
+            # a caller that waited on the lock usually finds everything rendered
+            if missing:
+                rendered = render_formats(
+                    missing, current["reports"], str(current["localidad"]), str(current["basename"])
+                )
+                for fmt, path in rendered.items():
+                    report_cache.add_artifact(report_id, fmt, path)
+                    entry["artifacts"][fmt] = str(path)
+    return {fmt: str(entry["artifacts"][fmt]) for fmt in formats}
+
+
+def _build_entry(inp: ReportInput, resolved: _Resolved, stage: Progress) -> Dict[str, object]:
+    rep_key = resolved.rep_key
+    parsed = resolved.parsed
+    filter_ids = list(parsed.ids) or None
+    names = None if parsed.ids else list(parsed.names)
+    stage("aggregate")
+    cached = report_cache.get_aggregate(resolved.agg_key)
+    if cached is None:
+        var_sum, entities_count = aggregate_entities(
+            inp.layer, resolved.columns, filter_ids=filter_ids, names=names
+        )
+        report_cache.put_aggregate(resolved.agg_key, var_sum, entities_count)
+    else:
+        var_sum, entities_count = cached
+    references = reference_sums(inp.layer, resolved.columns, inp.references, filter_ids=filter_ids, names=names)
+
+    stage("tables")
+    entry = {
+        "reports": build_tables(var_sum, resolved.selected_groups, resolved.labels, references),
+        "localidad": inp.localidad,
+        # the key keeps files of different cached reports from sharing a name
+        "basename": report_basename(inp.localidad, f"reporte_{rep_key[:8]}_"),
+        "entities_count": entities_count,
+        "artifacts": {},
+    }
+    report_cache.put_report(rep_key, resolved.agg_key, entry)
+    return entry
+
+
+def _stage_callback(progress: Progress | None) -> Progress:
+    def stage(name: str) -> None:
+        if progress is not None:
+            progress(name)
+
+    return stage
+
+
+def _report_summary(reports: List[Dict[str, object]]) -> List[Dict[str, object]]:
+    return [
+        {
+            "group": r["title"],
+            "group_label": r["title"],
+            "total": None,
+            "rows_count": len(r["rows"]),
+            "csv_path": r["csv_path"],
+        }
+        for r in reports
+    ]
+
+
+def run_report(inp: ReportInput, progress: Progress | None = None) -> Dict[str, object]:
+    # returns the fields of ReportResponse; progress(stage) is called as each stage starts
+    stage = _stage_callback(progress)
+
+    stage("resolve")
+    resolved = _resolve(inp)
+    rep_key = resolved.rep_key
+
+    entry = report_cache.get_report(rep_key)
+    if entry is None:
+        # concurrent identical reports wait for a single aggregation
+        entry, shared = _entries.do(rep_key, lambda: _build_entry(inp, resolved, stage))
+        if shared:
+            entry = dict(entry, artifacts=dict(entry["artifacts"]))
+
+    stage("render")
+    combined = ensure_artifacts(rep_key, entry, [fmt for fmt in REPORT_FORMATS if fmt in inp.formats])
+
+    return {
+        "layer": inp.layer,
+        "entities_count": int(entry["entities_count"]),
+        "reports": _report_summary(entry["reports"]),
+        "report_id": rep_key,
+        "downloads": {fmt: f"/report/{rep_key}.{fmt}" for fmt in REPORT_FORMATS},
+        **{f"combined_{fmt}": combined.get(fmt) for fmt in REPORT_FORMATS},
+    }
+
+
+def run_batch(inp: BatchInput, progress: Progress | None = None) -> Dict[str, object]:
+    # one report per value of the grouping column; every group missing from the cache
+    # is aggregated in a single pass and their files are rendered concurrently.
+    # Returns the fields of BatchResponse.
+    stage = _stage_callback(progress)
+
+    stage("resolve")
+    validate_batch(inp)
+    group_column = inp.group_column.strip().upper()
+    grouped = store.get_parsed_groups(inp.filter_id, group_column)
+    if grouped is None:
+        grouped = store.save_parsed_groups(
+            inp.filter_id,
+            group_column,
+            read_filter(str(store.get(inp.filter_id).path), group_column=group_column),
+        )
+    group_filters = grouped.groups
+    if not group_filters:
+        raise ValueError(f"La columna {group_column} del filtro no tiene valores")
+    plan = _plan(inp.layer, inp.groups)
+    version = catalog.version()
+    agg_keys: Dict[str, str] = {}
+    rep_keys: Dict[str, str] = {}
+    for group, parsed in group_filters.items():
+        # the same keys as /report, so a group and a single report of it share the cache
+        agg_keys[group] = aggregate_key(version, inp.layer, plan.columns, _entities_key(parsed))
+        rep_keys[group] = report_key(agg_keys[group], list(plan.selected_groups), plan.key, group, inp.references)
+
+    stage("aggregate")
+    entries: Dict[str, Dict[str, object]] = {}
+    sums: Dict[str, Tuple[Dict[str, float], int]] = {}
+    for group in group_filters:
+        entry = report_cache.get_report(rep_keys[group])
+        if entry is not None:
+            entries[group] = entry
+            continue
+        cached = report_cache.get_aggregate(agg_keys[group])
+        if cached is not None:
+            sums[group] = cached
+    missing = [g for g in group_filters if g not in entries and g not in sums]
+    if missing:
+        results = _by_entities(
+            [group_filters[g] for g in missing],
+            lambda **groups: aggregate_entities_grouped(inp.layer, plan.columns, **groups),
+        )
+        for group, (var_sum, entities_count) in zip(missing, results):
+            report_cache.put_aggregate(agg_keys[group], var_sum, entities_count)
+            sums[group] = (var_sum, entities_count)
+
+    stage("tables")
+    built = list(sums)
+    group_references = _by_entities(
+        [group_filters[g] for g in built],
+        lambda **groups: reference_sums_grouped(inp.layer, plan.columns, inp.references, **groups),
+    )
+    for group, references in zip(built, group_references):
+        var_sum, entities_count = sums[group]
+        rep_key = rep_keys[group]
+        entries[group] = {
+            "reports": build_tables(var_sum, plan.selected_groups, plan.labels, references),
+            "localidad": group,
+            "basename": report_basename(group, f"reporte_{rep_key[:8]}_"),
+            "entities_count": entities_count,
+            "artifacts": {},
+        }
+        report_cache.put_report(rep_key, agg_keys[group], entries[group])
+
+    stage("render")
+    formats = [fmt for fmt in REPORT_FORMATS if fmt in inp.formats]
+    combined: Dict[str, object] | None = None
+    if inp.combined:
+        title = f"Consolidado {group_column.lower()}"
+        combined_key = strings_sha256(["combined", *(rep_keys[g] for g in group_filters)])
+        entry = report_cache.get_report(combined_key)
+        if entry is None:
+            entry = {
+                "reports": combine_tables({g: entries[g]["reports"] for g in group_filters}),
+                "localidad": title,
+                "basename": report_basename(title, f"reporte_{combined_key[:8]}_"),
+                "entities_count": sum(int(entries[g]["entities_count"]) for g in group_filters),
+                "artifacts": {},
+            }
+            report_cache.put_report(combined_key, "batch", entry)
+        paths = ensure_artifacts(combined_key, entry, formats)
+        combined = {
+            "report_id": combined_key,
+            "downloads": {fmt: f"/report/{combined_key}.{fmt}" for fmt in REPORT_FORMATS},
+            **{f"combined_{fmt}": paths.get(fmt) for fmt in REPORT_FORMATS},
+        }
+    else:
+        pending = [g for g in group_filters if any(not entries[g]["artifacts"].get(fmt) for fmt in formats)]
+        with ExitStack() as stack:
+            # the same locks as ensure_artifacts, taken in key order so two batches
+            # sharing groups cannot wait on each other
+            for group in sorted(pending, key=rep_keys.get):
+                stack.enter_context(_render_lock(rep_keys[group]))
+            tasks: List[RenderTask] = []
+            owners: List[str] = []
+            for group in pending:
+                entry = entries[group]
+                current = _refresh_artifacts(rep_keys[group], entry)
+                for fmt in formats:
+                    if not entry["artifacts"].get(fmt):
+                        tasks.append((fmt, current["reports"], group, str(current["basename"])))
+                        owners.append(group)
+            for (fmt, *_), group, path in zip(tasks, owners, render_many(tasks)):
+                report_cache.add_artifact(rep_keys[group], fmt, path)
+                entries[group]["artifacts"][fmt] = str(path)
+
+    return {
+        "layer": inp.layer,
+        "group_column": group_column,
+        "groups": [
+            {
+                "group": group,
+                "entities_count": int(entries[group]["entities_count"]),
+                "reports": _report_summary(entries[group]["reports"]),
+                "report_id": rep_keys[group],
+                "downloads": {fmt: f"/report/{rep_keys[group]}.{fmt}" for fmt in REPORT_FORMATS},
+                **{f"combined_{fmt}": entries[group]["artifacts"].get(fmt) for fmt in REPORT_FORMATS},
+            }
+            for group in group_filters
+        ],
+        "combined": combined,
+    }
+
+
+report_jobs = JobQueue(
+    JOBS_PATH,
+    STAGES,
+    max_workers=REPORT_JOB_WORKERS,
+    max_pending=REPORT_JOB_QUEUE_MAX,
+    ttl_seconds=JOB_TTL_SECONDS,
+)
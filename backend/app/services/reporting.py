@@ -1,17 +1,29 @@
 from __future__ import annotations
 
+import logging
+import math
+import multiprocessing
 import random
 import re
+import threading
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from copy import deepcopy
 from datetime import datetime
-from typing import Dict, List
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
 
 import pandas as pd
 from docx import Document
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 from docx.oxml import OxmlElement
 from docx.oxml.ns import qn
+from openpyxl import Workbook
 
-from app.config import RESULTS_DIR
+from app.config import RENDER_WORKERS, RESULTS_DIR
+
+logger = logging.getLogger(__name__)
 
 
 def _format_n(value: float) -> int | float:
@@ -204,6 +216,67 @@ def _table_df(row_dicts: List[Dict[str, object]], category_col: str | None = Non
     return df_rows, cols, display_cols, df_out
 
 
+def _row_cols(row_dicts: List[Dict[str, object]], category_col: str | None = None) -> tuple[list[str], list[str]]:
+    # same columns, in the same order, as _table_cols on pd.DataFrame(row_dicts)
+    keys = list(dict.fromkeys(k for row in row_dicts for k in row))
+    cols = [c for c in keys if c not in {"is_total", "is_subtotal", "code"}]
+    if category_col and category_col in cols:
+        cols = [category_col] + [c for c in cols if c != category_col]
+    return cols, [_display_col(c) for c in cols]
+
+
+def _is_missing(value: object) -> bool:
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def _cell_texts(values: List[object]) -> List[str]:
+    # text of each cell as pandas would print it: a numeric column holding a float or
+    # a missing value is a float column, so its integers read "3.0"
+    present = [v for v in values if not _is_missing(v)]
+    numeric = bool(present) and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in present)
+    as_float = numeric and (len(present) < len(values) or any(isinstance(v, float) for v in present))
+    return [
+        "" if _is_missing(v) else str(float(v)) if as_float else str(v)
+        for v in values
+    ]
+
+
+def _append_run(paragraph_el, text: str, bold: bool) -> None:
+    run = OxmlElement("w:r")
+    if bold:
+        rpr = OxmlElement("w:rPr")
+        rpr.append(OxmlElement("w:b"))
+        run.append(rpr)
+    run.text = text
+    paragraph_el.append(run)
+
+
+def _add_docx_table(
+    doc_ref: Document,
+    row_dicts: List[Dict[str, object]],
+    category_col: str | None = None,
+):
+    # python-docx builds the styled header row; data rows are copies of its empty
+    # cells filled in directly, instead of table.add_row().cells + add_run per cell
+    cols, display_cols = _row_cols(row_dicts, category_col)
+    table = doc_ref.add_table(rows=1, cols=len(cols))
+    table.style = "Table Grid"
+    header = table.rows[0]._tr
+    template = deepcopy(header)
+    for tc, col in zip(header.tc_lst, display_cols):
+        _append_run(tc.p_lst[0], col, bold=True)
+
+    texts = [_cell_texts([row.get(col) for row in row_dicts]) for col in cols]
+    tbl = table._tbl
+    for i, row in enumerate(row_dicts):
+        tr = deepcopy(template)
+        is_total = bool(row.get("is_total", False))
+        for tc, col_texts in zip(tr.tc_lst, texts):
+            _append_run(tc.p_lst[0], col_texts[i], is_total)
+        tbl.append(tr)
+    return tbl
+
+
 def _add_seq_field(paragraph, label: str) -> None:
     run = paragraph.add_run()
     fld_begin = OxmlElement("w:fldChar")
@@ -243,16 +316,49 @@ def _add_source_line(doc_ref: Document) -> None:
     run.italic = True
 
 
-def build_reports(
+def _add_reference(
+    rows: List[Dict[str, object]],
+    spec: Dict,
+    ref_sum: Dict[str, float],
+    column: str,
+) -> None:
+    # share of each row in a reference area, with the same denominator as "Porcentaje"
+    category_col = spec.get("category_col")
+    denominator = spec.get("denominator", "sum")
+    values = {code: float(ref_sum.get(code, 0.0)) for code in spec["variables"]}
+
+    def fill(row: Dict[str, object], denom: float) -> None:
+        value = denom if row["is_total"] else values[row["code"]]
+        row[column] = _format_pct((value / denom) * 100) if denom > 0 else ""
+
+    if denominator == "by_category" and category_col:
+        categories: Dict[object, float] = {}
+        for row in rows:
+            if not row["is_total"]:
+                cat = row.get(category_col, "")
+                categories[cat] = categories.get(cat, 0.0) + values[row["code"]]
+        for row in rows:
+            fill(row, categories.get(row.get(category_col, ""), 0.0))
+        return
+
+    if denominator in ref_sum:
+        denom_value = float(ref_sum.get(denominator, 0.0))
+    elif denominator == "sum":
+        denom_value = sum(values[row["code"]] for row in rows if not row["is_total"])
+    else:
+        denom_value = 0.0
+    for row in rows:
+        fill(row, denom_value)
+
+
+def build_tables(
     var_sum: Dict[str, float],
     group_specs: Dict[str, Dict],
     labels: Dict[str, str],
-    localidad: str,
-    output_prefix: str,
-) -> Dict[str, object]:
+    references: Dict[str, Dict[str, float]] | None = None,
+) -> List[Dict[str, object]]:
+    # references: {column label: sums of a reference area}, e.g. {"% comuna": {...}}
     reports = []
-    loc_slug = _safe_filename(localidad)
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
 
     for group_title, spec in group_specs.items():
         vars_list = spec["variables"]
@@ -333,6 +439,9 @@ def build_reports(
                     }
                 )
 
+        for column, ref_sum in (references or {}).items():
+            _add_reference(rows, spec, ref_sum, column)
+
         reports.append(
             {
                 "title": group_title,
@@ -343,161 +452,333 @@ def build_reports(
             }
         )
 
-    # consolidated outputs
-    combined_csv = RESULTS_DIR / f"{output_prefix}{loc_slug}_{timestamp}.csv"
-    combined_xlsx = RESULTS_DIR / f"{output_prefix}{loc_slug}_{timestamp}.xlsx"
-    combined_html = RESULTS_DIR / f"{output_prefix}{loc_slug}_{timestamp}.html"
-    combined_docx = RESULTS_DIR / f"{output_prefix}{loc_slug}_{timestamp}.docx"
+    return reports
+
+
+def _category_entries(rep: Dict[str, object]) -> List[Dict[str, object]]:
+    # one table per category of a by-category group, with its subtotal row
+    category_col = rep.get("category_col")
+    if not category_col:
+        return []
+    rows = rep["rows"]
+    categories = [cat for cat in sorted({r.get(category_col, "") for r in rows}) if cat]
+    return [
+        {
+            "title": f"{rep['title']} - {cat}",
+            "rows": [
+                r
+                for r in rows
+                if r.get(category_col) == cat or (r.get("is_subtotal") and r.get(category_col) == cat)
+            ],
+            "category_col": category_col,
+            "denominator": rep.get("denominator"),
+            "localidad": rep.get("localidad"),
+        }
+        for cat in categories
+    ]
+
+
+def _scope(rep: Dict[str, object]) -> Dict[str, object]:
+    # tables of a combined batch report carry their own localidad
+    return {"Localidad": rep["localidad"]} if rep.get("localidad") else {}
+
 
+def _combined_df(reports: List[Dict[str, object]]) -> pd.DataFrame:
     all_rows = []
     for rep in reports:
         for row in rep["rows"]:
-            out = {"Variable": rep["title"], **{k: v for k, v in row.items() if k not in {"is_total", "is_subtotal"}}}
+            out = {
+                **_scope(rep),
+                "Variable": rep["title"],
+                **{k: v for k, v in row.items() if k not in {"is_total", "is_subtotal"}},
+            }
             all_rows.append(out)
 
     combined_df = pd.DataFrame(all_rows)
-    combined_df_out = combined_df.rename(columns={"n": "Frecuencia"})
-    combined_df_out.to_csv(combined_csv, index=False)
-
-    with pd.ExcelWriter(combined_xlsx, engine="openpyxl") as writer:
-        combined_df_out.to_excel(writer, index=False, sheet_name="Consolidado")
-        used_sheet_names: set[str] = {"Consolidado"}
-
-        def unique_sheet_name(base: str) -> str:
-            name = _safe_filename(base)[:31] or "Tabla"
-            if name not in used_sheet_names:
-                used_sheet_names.add(name)
-                return name
-            counter = 2
-            while True:
-                suffix = f"_{counter}"
-                trimmed = name[: 31 - len(suffix)]
-                candidate = f"{trimmed}{suffix}"
-                if candidate not in used_sheet_names:
-                    used_sheet_names.add(candidate)
-                    return candidate
-                counter += 1
-
-        table_entries: List[Dict[str, object]] = []
-        for rep in reports:
-            table_entries.append(
-                {
-                    "title": rep["title"],
-                    "rows": rep["rows"],
-                    "category_col": rep.get("category_col"),
-                }
-            )
-            category_col = rep.get("category_col")
-            if category_col:
-                categories = [
-                    cat
-                    for cat in sorted({r.get(category_col, "") for r in rep["rows"]})
-                    if cat
-                ]
-                for cat in categories:
-                    sub_rows = [
-                        r
-                        for r in rep["rows"]
-                        if r.get(category_col) == cat
-                        or (r.get("is_subtotal") and r.get(category_col) == cat)
-                    ]
-                    table_entries.append(
-                        {
-                            "title": f"{rep['title']} - {cat}",
-                            "rows": sub_rows,
-                            "category_col": rep.get("category_col"),
-                        }
-                    )
-
-        for idx, entry in enumerate(table_entries, start=1):
-            sheet_name = unique_sheet_name(str(entry["title"]))
-            _, _, _, df_out = _table_df(entry["rows"], entry.get("category_col"))
-            df_out.to_excel(writer, index=False, sheet_name=sheet_name, startrow=1)
-            ws = writer.sheets[sheet_name]
-            ws.cell(row=1, column=1, value=f"Tabla {idx}. {entry['title']} - {localidad}")
+    return combined_df.rename(columns={"n": "Frecuencia"})
+
+
+def render_csv(reports: List[Dict[str, object]], localidad: str, path: Path) -> Path:
+    _combined_df(reports).to_csv(path, index=False)
+    return path
+
+
+def _xlsx_values(row_dicts: List[Dict[str, object]], cols: List[str]) -> Iterator[List[object]]:
+    for row in row_dicts:
+        yield [None if _is_missing(row.get(col)) else row.get(col) for col in cols]
+
+
+def render_xlsx(reports: List[Dict[str, object]], localidad: str, path: Path) -> Path:
+    # write-only workbook: every sheet is streamed to disk as its rows are appended
+    wb = Workbook(write_only=True)
+    used_sheet_names: set[str] = {"Consolidado"}
+
+    def unique_sheet_name(base: str) -> str:
+        name = _safe_filename(base)[:31] or "Tabla"
+        if name not in used_sheet_names:
+            used_sheet_names.add(name)
+            return name
+        counter = 2
+        while True:
+            suffix = f"_{counter}"
+            trimmed = name[: 31 - len(suffix)]
+            candidate = f"{trimmed}{suffix}"
+            if candidate not in used_sheet_names:
+                used_sheet_names.add(candidate)
+                return candidate
+            counter += 1
+
+    all_rows = [
+        {
+            **_scope(rep),
+            "Variable": rep["title"],
+            **{k: v for k, v in row.items() if k not in {"is_total", "is_subtotal"}},
+        }
+        for rep in reports
+        for row in rep["rows"]
+    ]
+    cols = list(dict.fromkeys(k for row in all_rows for k in row))
+    ws = wb.create_sheet("Consolidado")
+    ws.append([_display_col(c) for c in cols])
+    for values in _xlsx_values(all_rows, cols):
+        ws.append(values)
+
+    table_entries: List[Dict[str, object]] = []
+    for rep in reports:
+        table_entries.append(
+            {
+                "title": rep["title"],
+                "rows": rep["rows"],
+                "category_col": rep.get("category_col"),
+                "localidad": rep.get("localidad"),
+            }
+        )
+        table_entries.extend(_category_entries(rep))
+
+    for idx, entry in enumerate(table_entries, start=1):
+        ws = wb.create_sheet(unique_sheet_name(str(entry["title"])))
+        cols, display_cols = _row_cols(entry["rows"], entry.get("category_col"))
+        ws.append([f"Tabla {idx}. {entry['title']} - {entry.get('localidad') or localidad}"])
+        ws.append(display_cols)
+        for values in _xlsx_values(entry["rows"], cols):
+            ws.append(values)
+
+    wb.save(path)
+    return path
+
 
+def render_html(reports: List[Dict[str, object]], localidad: str, path: Path) -> Path:
     html_parts = ["<h1>Reporte consolidado</h1>"]
     for rep in reports:
-        html_parts.append(f"<h2>{rep['title']}</h2>")
+        scope = f" - {rep['localidad']}" if rep.get("localidad") else ""
+        html_parts.append(f"<h2>{rep['title']}{scope}</h2>")
         _, _, _, df_out = _table_df(rep["rows"], rep.get("category_col"))
         html_parts.append(df_out.to_html(index=False))
-    combined_html.write_text("\n".join(html_parts), encoding="utf-8")
+    path.write_text("\n".join(html_parts), encoding="utf-8")
+    return path
 
+
+def render_docx(reports: List[Dict[str, object]], localidad: str, path: Path) -> Path:
     try:
         doc = Document()
         doc.add_heading("Reporte consolidado", level=1)
 
-        def add_table(
-            doc_ref: Document,
-            row_dicts: List[Dict[str, object]],
-            category_col: str | None = None,
-        ) -> None:
-            df_rows, cols, display_cols, _ = _table_df(row_dicts, category_col)
-            table = doc_ref.add_table(rows=1, cols=len(cols))
-            table.style = "Table Grid"
-            hdr = table.rows[0].cells
-            for idx, col in enumerate(display_cols):
-                run = hdr[idx].paragraphs[0].add_run(col)
-                run.bold = True
-            for _, row in df_rows.iterrows():
-                cells = table.add_row().cells
-                is_total = bool(row.get("is_total", False))
-                for idx, col in enumerate(cols):
-                    text = "" if pd.isna(row[col]) else str(row[col])
-                    run = cells[idx].paragraphs[0].add_run(text)
-                    if is_total:
-                        run.bold = True
-
         # Seccion 1: solo tablas
         doc.add_heading("Sección 1: Tablas", level=1)
+        tables = []
         for rep in reports:
-            _add_table_caption(doc, rep["title"], localidad)
-            add_table(doc, rep["rows"], rep.get("category_col"))
+            _add_table_caption(doc, rep["title"], rep.get("localidad") or localidad)
+            tables.append(_add_docx_table(doc, rep["rows"], rep.get("category_col")))
             _add_source_line(doc)
 
         # Seccion 2: narrativa + tablas
         doc.add_heading("Sección 2: Tablas con narrativa", level=1)
-        for rep in reports:
-            category_col = rep.get("category_col")
-            rows = rep["rows"]
-            if category_col:
-                categories = [
-                    cat
-                    for cat in sorted({r.get(category_col, "") for r in rows})
-                    if cat
-                ]
-                for cat in categories:
-                    sub_rows = [
-                        r
-                        for r in rows
-                        if r.get(category_col) == cat
-                        or (r.get("is_subtotal") and r.get(category_col) == cat)
-                    ]
-                    title = f"{rep['title']} - {cat}"
-                    doc.add_paragraph(
-                        _build_narrative(
-                            sub_rows,
-                            title,
-                            rep.get("denominator"),
-                        )
-                    )
-                    _add_table_caption(doc, title, localidad)
-                    add_table(doc, sub_rows, rep.get("category_col"))
-                    _add_source_line(doc)
-            else:
-                doc.add_paragraph(_build_narrative(rows, rep["title"], rep.get("denominator")))
-                _add_table_caption(doc, rep["title"], localidad)
-                add_table(doc, rows, rep.get("category_col"))
+        body = doc.element.body
+        for rep, table in zip(reports, tables):
+            for entry in _category_entries(rep) or [rep]:
+                doc.add_paragraph(_build_narrative(entry["rows"], entry["title"], rep.get("denominator")))
+                _add_table_caption(doc, entry["title"], entry.get("localidad") or localidad)
+                if entry is rep:
+                    # same rows as in Seccion 1
+                    body.insert_element_before(deepcopy(table), "w:sectPr")
+                else:
+                    _add_docx_table(doc, entry["rows"], rep.get("category_col"))
                 _add_source_line(doc)
-        doc.save(combined_docx)
+        doc.save(path)
     except Exception:
-        combined_docx = RESULTS_DIR / f"{output_prefix}{loc_slug}_{timestamp}_docx_error.txt"
-        combined_docx.write_text("Error generando DOCX. Use el HTML o XLSX.")
-
-    return {
-        "reports": reports,
-        "combined_csv": str(combined_csv),
-        "combined_html": str(combined_html),
-        "combined_docx": str(combined_docx),
-        "combined_xlsx": str(combined_xlsx),
+        path = path.with_name(f"{path.stem}_docx_error.txt")
+        path.write_text("Error generando DOCX. Use el HTML o XLSX.")
+    return path
+
+
+REPORT_FORMATS = ("csv", "xlsx", "html", "docx")
+
+RENDERERS: Dict[str, Callable[[List[Dict[str, object]], str, Path], Path]] = {
+    "csv": render_csv,
+    "xlsx": render_xlsx,
+    "html": render_html,
+    "docx": render_docx,
+}
+
+
+def report_basename(localidad: str, output_prefix: str) -> str:
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return f"{output_prefix}{_safe_filename(localidad)}_{timestamp}"
+
+
+def render_format(
+    fmt: str,
+    reports: List[Dict[str, object]],
+    localidad: str,
+    basename: str,
+    output_dir: Path = RESULTS_DIR,
+) -> Path:
+    path = output_dir / f"{basename}.{fmt}"
+    # written under a temporary name so a concurrent download never sees a partial file
+    tmp_path = output_dir / f".{uuid.uuid4().hex}_{path.name}"
+    written = RENDERERS[fmt](reports, localidad, tmp_path)
+    if written != tmp_path:
+        target = output_dir / written.name.replace(tmp_path.stem, path.stem, 1)
+        written.replace(target)
+        return target
+    tmp_path.replace(path)
+    return path
+
+
+# DOCX and XLSX are CPU bound and go to worker processes; CSV and HTML run on threads.
+_PROCESS_FORMATS = {"docx", "xlsx"}
+_thread_pool = ThreadPoolExecutor(max_workers=len(REPORT_FORMATS), thread_name_prefix="render")
+_process_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+
+
+def _get_process_pool() -> ProcessPoolExecutor | None:
+    global _process_pool
+    if RENDER_WORKERS <= 0:
+        return None
+    with _pool_lock:
+        if _process_pool is None:
+            # spawn: forking a multi-threaded server process is not safe
+            _process_pool = ProcessPoolExecutor(
+                max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _process_pool
+
+
+def _reset_process_pool(pool: ProcessPoolExecutor) -> None:
+    global _process_pool
+    with _pool_lock:
+        if _process_pool is pool:
+            _process_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+# (format, table model, localidad, basename) of one file to render
+RenderTask = Tuple[str, List[Dict[str, object]], str, str]
+
+
+def render_many(tasks: List[RenderTask], output_dir: Path = RESULTS_DIR) -> List[Path]:
+    # renders every task concurrently; paths are returned in task order
+    if len(tasks) <= 1:
+        return [render_format(*task, output_dir) for task in tasks]
+
+    pool = _get_process_pool()
+    futures: List[Tuple[Future, ProcessPoolExecutor | None]] = []
+    for task in tasks:
+        if pool is not None and task[0] in _PROCESS_FORMATS:
+            try:
+                futures.append((pool.submit(render_format, *task, output_dir), pool))
+                continue
+            except (BrokenProcessPool, RuntimeError):
+                _reset_process_pool(pool)
+                pool = None
+        futures.append((_thread_pool.submit(render_format, *task, output_dir), None))
+
+    rendered: List[Path] = []
+    for task, (future, used_pool) in zip(tasks, futures):
+        try:
+            rendered.append(future.result())
+        except BrokenProcessPool:
+            logger.warning("Proceso de renderizado interrumpido; se genera %s en el proceso actual", task[0])
+            _reset_process_pool(used_pool)
+            rendered.append(render_format(*task, output_dir))
+    return rendered
+
+
+def render_formats(
+    formats: Iterable[str],
+    reports: List[Dict[str, object]],
+    localidad: str,
+    basename: str,
+    output_dir: Path = RESULTS_DIR,
+) -> Dict[str, Path]:
+    formats = list(dict.fromkeys(formats))
+    paths = render_many([(fmt, reports, localidad, basename) for fmt in formats], output_dir)
+    return dict(zip(formats, paths))
+
+
+def build_reports(
+    var_sum: Dict[str, float],
+    group_specs: Dict[str, Dict],
+    labels: Dict[str, str],
+    localidad: str,
+    output_prefix: str,
+    formats: Iterable[str] = REPORT_FORMATS,
+    output_dir: Path = RESULTS_DIR,
+    references: Dict[str, Dict[str, float]] | None = None,
+) -> Dict[str, object]:
+    reports = build_tables(var_sum, group_specs, labels, references)
+    basename = report_basename(localidad, output_prefix)
+    rendered = render_formats(
+        [fmt for fmt in REPORT_FORMATS if fmt in formats], reports, localidad, basename, output_dir
+    )
+    result: Dict[str, object] = {"reports": reports}
+    for fmt in REPORT_FORMATS:
+        result[f"combined_{fmt}"] = str(rendered[fmt]) if fmt in rendered else None
+    return result
+
+
+def combine_tables(group_reports: Dict[str, List[Dict[str, object]]]) -> List[Dict[str, object]]:
+    # tables of every group one after the other, each captioned with its own group
+    return [{**rep, "localidad": group} for group, reports in group_reports.items() for rep in reports]
+
+
+def build_batch_reports(
+    group_sums: Dict[str, Dict[str, float]],
+    group_specs: Dict[str, Dict],
+    labels: Dict[str, str],
+    output_prefix: str,
+    formats: Iterable[str] = REPORT_FORMATS,
+    combined: bool = False,
+    title: str = "Consolidado",
+    output_dir: Path = RESULTS_DIR,
+    group_references: Dict[str, Dict[str, Dict[str, float]]] | None = None,
+) -> Dict[str, object]:
+    # build_reports for many localidades at once: one set of files per group, or a
+    # single combined set, all rendered concurrently
+    formats = [fmt for fmt in REPORT_FORMATS if fmt in formats]
+    group_references = group_references or {}
+    group_reports = {
+        group: build_tables(var_sum, group_specs, labels, group_references.get(group))
+        for group, var_sum in group_sums.items()
+    }
+    groups: Dict[str, Dict[str, object]] = {
+        group: {"reports": reports, **{f"combined_{fmt}": None for fmt in REPORT_FORMATS}}
+        for group, reports in group_reports.items()
     }
+    result: Dict[str, object] = {"groups": groups, "combined": None}
+
+    if combined:
+        basename = report_basename(title, output_prefix)
+        rendered = render_formats(formats, combine_tables(group_reports), title, basename, output_dir)
+        result["combined"] = {f"combined_{fmt}": str(rendered[fmt]) if fmt in rendered else None for fmt in REPORT_FORMATS}
+        return result
+
+    tasks: List[RenderTask] = []
+    for n, (group, reports) in enumerate(group_reports.items(), start=1):
+        # the position keeps groups whose names slugify alike from sharing files
+        basename = report_basename(group, f"{output_prefix}{n:03d}_")
+        tasks.extend((fmt, reports, group, basename) for fmt in formats)
+    for (fmt, _, group, _), path in zip(tasks, render_many(tasks, output_dir)):
+        groups[group][f"combined_{fmt}"] = str(path)
+    return result
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+from typing import Dict, Iterable, List, Tuple
+
+from app.services.catalog import catalog
+from app.services.gpkg_index import ensure_rollup_index, read_rollup
+from app.services.gpkg_reader import entity_areas, entity_areas_grouped
+
+# Reference areas a report can be compared with, and the column they add next to
+# the local frequencies. An entity set that spans several comunas (or regions) is
+# compared with all of them together.
+REFERENCE_LABELS: Dict[str, str] = {
+    "comuna": "% comuna",
+    "region": "% región",
+    "pais": "% país",
+}
+
+
+def validate_references(levels: Iterable[str]) -> None:
+    unknown = [level for level in levels if level not in REFERENCE_LABELS]
+    if unknown:
+        raise ValueError(f"Referencia no soportada: {', '.join(unknown)}")
+
+
+def _levels(layer: str, levels: Iterable[str]) -> List[str]:
+    levels = [level for level in REFERENCE_LABELS if level in set(levels)]
+    if levels and not ensure_rollup_index(layer, catalog.variable_fields(layer)):
+        raise ValueError(f"No se pudieron calcular los totales de referencia de {layer}")
+    return levels
+
+
+def _area_sums(
+    layer: str,
+    columns: List[str],
+    levels: List[str],
+    areas: List[Tuple[str, str]],
+    country: Dict[str, float] | None = None,
+) -> Dict[str, Dict[str, float]]:
+    sums: Dict[str, Dict[str, float]] = {}
+    for level in levels:
+        if level == "comuna":
+            sums[REFERENCE_LABELS[level]] = read_rollup(layer, columns, areas=areas)
+        elif level == "region":
+            sums[REFERENCE_LABELS[level]] = read_rollup(layer, columns, regions=[region for region, _ in areas])
+        else:
+            sums[REFERENCE_LABELS[level]] = country if country is not None else read_rollup(layer, columns)
+    return sums
+
+
+def reference_sums(
+    layer: str,
+    columns: List[str],
+    levels: Iterable[str],
+    filter_ids: List[int] | None = None,
+    names: List[Tuple[str, str, str]] | None = None,
+) -> Dict[str, Dict[str, float]]:
+    # {column label: sums of the reference area}, read from the rollup in the sidecar
+    levels = _levels(layer, levels)
+    if not levels:
+        return {}
+    areas = entity_areas(layer, filter_ids=filter_ids, names=names) if levels != ["pais"] else []
+    return _area_sums(layer, columns, levels, areas)
+
+
+def reference_sums_grouped(
+    layer: str,
+    columns: List[str],
+    levels: Iterable[str],
+    group_ids: List[List[int]] | None = None,
+    group_names: List[List[Tuple[str, str, str]]] | None = None,
+) -> List[Dict[str, Dict[str, float]]]:
+    # reference_sums of every group, with the areas of all groups resolved in one query
+    groups = group_ids or group_names or []
+    levels = _levels(layer, levels) if groups else []
+    if not levels:
+        return [{} for _ in groups]
+    if levels != ["pais"]:
+        group_areas = entity_areas_grouped(layer, group_ids=group_ids, group_names=group_names)
+    else:
+        group_areas = [[] for _ in groups]
+    country = read_rollup(layer, columns) if "pais" in levels else None
+    return [_area_sums(layer, columns, levels, areas, country) for areas in group_areas]
@@ -0,0 +1,406 @@
+from __future__ import annotations
+
+import ast
+import re
+import struct
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from app.config import GPKG_PATH
+from app.services.gpkg_reader import load_geometries
+
+# Geometry of GPKG features, decoded straight from the blobs (GeoPackage header +
+# WKB) into numpy coordinate arrays, and the spatial selection of entities:
+# R-tree candidates first, then exact tests on the coordinates.
+#
+#   polygons  [[outer ring, hole, ...], ...], each ring an (n, 2) closed array
+#   points    (k, 2) array
+#
+# Coordinates are used as stored (EPSG:4326 lon/lat in the census cartography);
+# query geometries must be in the same system.
+
+PREDICATES = ("intersects", "centroid")
+ENTITY_COLUMNS = ("ID_ENTIDAD", "ENTIDAD", "LOCALIDAD", "COMUNA")
+
+_ENVELOPE_SIZES = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}
+# edges x points evaluated at once by the vectorized tests
+_CHUNK = 1 << 21
+# points closer than this to a boundary are on it (degrees, about 0.1 mm)
+_EPSILON = 1e-9
+# step off a shared edge to see which side each polygon covers (degrees, about 1 cm)
+_PROBE = 1e-7
+
+
+@dataclass
+class Shape:
+    polygons: List[List[np.ndarray]] = field(default_factory=list)
+    points: np.ndarray = field(default_factory=lambda: np.empty((0, 2)))
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.polygons and not len(self.points)
+
+    def vertices(self) -> np.ndarray:
+        parts = [ring for polygon in self.polygons for ring in polygon] + [self.points]
+        return np.concatenate(parts) if parts else np.empty((0, 2))
+
+    def bbox(self) -> Tuple[float, float, float, float]:
+        coords = self.vertices()
+        return (
+            float(coords[:, 0].min()),
+            float(coords[:, 1].min()),
+            float(coords[:, 0].max()),
+            float(coords[:, 1].max()),
+        )
+
+
+def _read_wkb(buf: memoryview, offset: int, shape: Shape) -> int:
+    endian = "<" if buf[offset] == 1 else ">"
+    (gtype,) = struct.unpack_from(f"{endian}I", buf, offset + 1)
+    offset += 5
+    dims = 2
+    # EWKB flags and ISO 1000/2000/3000 codes for Z, M and ZM
+    if gtype & 0x80000000:
+        dims += 1
+    if gtype & 0x40000000:
+        dims += 1
+    gtype &= 0x0FFFFFFF
+    if gtype >= 1000:
+        dims += 2 if gtype // 1000 == 3 else 1
+        gtype %= 1000
+    dtype = np.dtype(f"{endian}f8")
+
+    def coords(count: int) -> np.ndarray:
+        nonlocal offset
+        array = np.frombuffer(buf, dtype=dtype, count=count * dims, offset=offset).reshape(count, dims)
+        offset += count * dims * 8
+        return array[:, :2].astype(np.float64)
+
+    def count() -> int:
+        nonlocal offset
+        (value,) = struct.unpack_from(f"{endian}I", buf, offset)
+        offset += 4
+        return value
+
+    if gtype == 1:
+        point = coords(1)
+        if not np.isnan(point).any():
+            shape.points = np.concatenate([shape.points, point])
+    elif gtype == 3:
+        rings = [coords(count()) for _ in range(count())]
+        rings = [ring for ring in rings if len(ring) >= 4]
+        if rings:
+            shape.polygons.append(rings)
+    elif gtype in {4, 6, 7}:
+        for _ in range(count()):
+            offset = _read_wkb(buf, offset, shape)
+    elif gtype == 2:
+        coords(count())
+    elif gtype == 5:
+        for _ in range(count()):
+            offset = _read_wkb(buf, offset, shape)
+    else:
+        raise ValueError(f"Tipo de geometría WKB no soportado: {gtype}")
+    return offset
+
+
+def decode_geometry(blob: bytes | None) -> Shape:
+    # GeoPackage binary: "GP", version, flags, srs_id, optional envelope, then WKB.
+    # Lines are skipped: the census layers are polygons and points.
+    shape = Shape()
+    if not blob:
+        return shape
+    buf = memoryview(blob)
+    if bytes(buf[:2]) != b"GP":
+        _read_wkb(buf, 0, shape)
+        return shape
+    flags = buf[3]
+    if flags & 0x10:
+        return shape
+    envelope = _ENVELOPE_SIZES.get((flags >> 1) & 0x07)
+    if envelope is None:
+        raise ValueError("Encabezado de geometría GPKG inválido")
+    _read_wkb(buf, 8 + envelope, shape)
+    return shape
+
+
+def _ring(coordinates: Any) -> np.ndarray:
+    ring = np.asarray([[float(c[0]), float(c[1])] for c in coordinates], dtype=np.float64)
+    if len(ring) and not np.array_equal(ring[0], ring[-1]):
+        ring = np.vstack([ring, ring[:1]])
+    if len(ring) < 4:
+        raise ValueError("Cada anillo del polígono necesita al menos 3 vértices")
+    return ring
+
+
+def _geojson_polygons(obj: Dict[str, Any]) -> List[List[np.ndarray]]:
+    kind = obj.get("type")
+    if kind == "FeatureCollection":
+        return [p for feature in obj.get("features", []) for p in _geojson_polygons(feature)]
+    if kind == "Feature":
+        return _geojson_polygons(obj.get("geometry") or {})
+    if kind == "GeometryCollection":
+        return [p for geometry in obj.get("geometries", []) for p in _geojson_polygons(geometry)]
+    if kind == "Polygon":
+        return [[_ring(ring) for ring in obj["coordinates"]]]
+    if kind == "MultiPolygon":
+        return [[_ring(ring) for ring in polygon] for polygon in obj["coordinates"]]
+    raise ValueError(f"Geometría GeoJSON no soportada: {kind}")
+
+
+_WKT_NUMBER = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+_WKT_POSITION = re.compile(rf"({_WKT_NUMBER})\s+({_WKT_NUMBER})(?:\s+{_WKT_NUMBER}){{0,2}}")
+
+
+def _wkt_polygons(text: str) -> List[List[np.ndarray]]:
+    text = re.sub(r"^\s*SRID=\d+;", "", text.strip(), flags=re.IGNORECASE)
+    match = re.match(r"\s*(MULTIPOLYGON|POLYGON)\s*(?:ZM|Z|M)?\s*(\(.*\))\s*$", text, re.IGNORECASE | re.DOTALL)
+    if match is None:
+        raise ValueError("WKT no soportado: se espera POLYGON o MULTIPOLYGON")
+    # "(x y, x y)" -> "((x, y), (x, y))", read as a Python literal
+    body = _WKT_POSITION.sub(r"(\1, \2)", match.group(2))
+    try:
+        nested = ast.literal_eval(body.replace("(", "[").replace(")", "]"))
+    except (SyntaxError, ValueError) as exc:
+        raise ValueError("WKT mal formado") from exc
+    if match.group(1).upper() == "POLYGON":
+        nested = [nested]
+    return [[_ring(ring) for ring in polygon] for polygon in nested]
+
+
+def parse_query_geometry(
+    bbox: List[float] | None = None,
+    geojson: Dict[str, Any] | None = None,
+    wkt: str | None = None,
+) -> List[List[np.ndarray]]:
+    # the query area as polygons, from exactly one of the three inputs
+    given = [value for value in (bbox, geojson, wkt) if value]
+    if len(given) != 1:
+        raise ValueError("Indique solo uno de bbox, geojson o wkt")
+    if bbox:
+        if len(bbox) != 4:
+            raise ValueError("bbox debe ser [minx, miny, maxx, maxy]")
+        minx, miny, maxx, maxy = (float(v) for v in bbox)
+        if minx > maxx or miny > maxy:
+            raise ValueError("bbox debe ser [minx, miny, maxx, maxy]")
+        return [[_ring([(minx, miny), (maxx, miny), (maxx, maxy), (minx, maxy)])]]
+    polygons = _geojson_polygons(geojson) if geojson else _wkt_polygons(str(wkt))
+    if not polygons:
+        raise ValueError("La geometría de búsqueda está vacía")
+    return polygons
+
+
+def _edges(rings: List[np.ndarray]) -> np.ndarray:
+    # (n, 4) array of x1, y1, x2, y2
+    return np.concatenate([np.hstack([ring[:-1], ring[1:]]) for ring in rings])
+
+
+def points_in_polygon(points: np.ndarray, rings: List[np.ndarray]) -> np.ndarray:
+    # even-odd ray casting against every ring at once, so holes are excluded
+    inside = np.zeros(len(points), dtype=bool)
+    if not len(points):
+        return inside
+    x1, y1, x2, y2 = (col[None, :] for col in _edges(rings).T)
+    step = max(1, _CHUNK // x1.shape[1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for start in range(0, len(points), step):
+            px = points[start : start + step, 0:1]
+            py = points[start : start + step, 1:2]
+            crosses = (y1 > py) != (y2 > py)
+            hits = crosses & (px < x1 + (py - y1) * (x2 - x1) / (y2 - y1))
+            inside[start : start + step] = (np.count_nonzero(hits, axis=1) % 2) == 1
+    return inside
+
+
+def _on_boundary(points: np.ndarray, rings: List[np.ndarray]) -> np.ndarray:
+    x1, y1, x2, y2 = (col[None, :] for col in _edges(rings).T)
+    dx, dy = x2 - x1, y2 - y1
+    length2 = dx * dx + dy * dy
+    on = np.zeros(len(points), dtype=bool)
+    step = max(1, _CHUNK // x1.shape[1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for start in range(0, len(points), step):
+            px = points[start : start + step, 0:1]
+            py = points[start : start + step, 1:2]
+            t = np.clip(np.nan_to_num(((px - x1) * dx + (py - y1) * dy) / length2), 0.0, 1.0)
+            dist2 = (px - x1 - t * dx) ** 2 + (py - y1 - t * dy) ** 2
+            on[start : start + step] = (dist2 <= _EPSILON * _EPSILON).any(axis=1)
+    return on
+
+
+def _points_in_polygons(points: np.ndarray, polygons: List[List[np.ndarray]], strict: bool = False) -> np.ndarray:
+    # strict leaves out points on a boundary, so features that only touch do not count
+    inside = np.zeros(len(points), dtype=bool)
+    for rings in polygons:
+        hits = points_in_polygon(points, rings)
+        if strict and hits.any():
+            idx = np.flatnonzero(hits)
+            hits[idx[_on_boundary(points[idx], rings)]] = False
+        inside |= hits
+    return inside
+
+
+def _edges_cross(a: np.ndarray, b: np.ndarray) -> bool:
+    # proper crossing between any edge of a and any edge of b
+    bx1, by1, bx2, by2 = (col[None, :] for col in b.T)
+    step = max(1, _CHUNK // len(b))
+    for start in range(0, len(a), step):
+        ax1, ay1, ax2, ay2 = (col[:, None] for col in a[start : start + step].T)
+        d1 = (bx2 - bx1) * (ay1 - by1) - (by2 - by1) * (ax1 - bx1)
+        d2 = (bx2 - bx1) * (ay2 - by1) - (by2 - by1) * (ax2 - bx1)
+        d3 = (ax2 - ax1) * (by1 - ay1) - (ay2 - ay1) * (bx1 - ax1)
+        d4 = (ax2 - ax1) * (by2 - ay1) - (ay2 - ay1) * (bx2 - ax1)
+        if np.any((d1 * d2 < 0) & (d3 * d4 < 0)):
+            return True
+    return False
+
+
+def _edge_pieces(edges: np.ndarray, points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # midpoints of the edges split at the points lying on them, with the unit normal
+    # of their edge
+    x1, y1, x2, y2 = (col[:, None] for col in edges.T)
+    dx, dy = x2 - x1, y2 - y1
+    length2 = dx * dx + dy * dy
+    px, py = points[None, :, 0], points[None, :, 1]
+    keep = length2[:, 0] > 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        unit = np.hstack([-dy, dx]) / np.sqrt(length2)
+    mids: List[np.ndarray] = []
+    normals: List[np.ndarray] = []
+    step = max(1, _CHUNK // max(1, len(points)))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for start in range(0, len(edges), step):
+            rows = slice(start, start + step)
+            t = ((px - x1[rows]) * dx[rows] + (py - y1[rows]) * dy[rows]) / length2[rows]
+            dist2 = (px - x1[rows] - t * dx[rows]) ** 2 + (py - y1[rows] - t * dy[rows]) ** 2
+            splits = (dist2 <= _EPSILON * _EPSILON) & (t > 0) & (t < 1)
+            split = splits.any(axis=1) & keep[rows]
+            whole = ~splits.any(axis=1) & keep[rows]
+            chunk = edges[rows]
+            mids.append((chunk[whole, :2] + chunk[whole, 2:]) / 2)
+            normals.append(unit[rows][whole])
+            for row in np.flatnonzero(split):
+                ts = np.concatenate([[0.0], np.sort(t[row][splits[row]]), [1.0]])
+                halves = (ts[:-1] + ts[1:]) / 2
+                mids.append(chunk[row, :2] + halves[:, None] * (chunk[row, 2:] - chunk[row, :2]))
+                normals.append(np.repeat(unit[start + row][None, :], len(halves), axis=0))
+    if not mids:
+        return np.empty((0, 2)), np.empty((0, 2))
+    return np.concatenate(mids), np.concatenate(normals)
+
+
+def _interiors_overlap(a: List[List[np.ndarray]], b: List[List[np.ndarray]]) -> bool:
+    # for polygons with no vertex strictly inside the other and no proper crossing,
+    # whose boundaries touch: they may run along each other or pass through the
+    # other polygon between shared vertices
+    a_rings = [ring for rings in a for ring in rings]
+    b_rings = [ring for rings in b for ring in rings]
+    shared = []
+    for rings, other, other_rings in ((a_rings, b, b_rings), (b_rings, a, a_rings)):
+        mids, normals = _edge_pieces(_edges(rings), np.concatenate(other_rings))
+        on = _on_boundary(mids, other_rings)
+        if (_points_in_polygons(mids[~on], other)).any():
+            return True
+        shared.append((mids[on], normals[on]))
+    # a piece of boundary both share: look at either side of it
+    mids, normals = shared[0]
+    for side in (1, -1):
+        probes = mids + side * _PROBE * normals
+        if (_points_in_polygons(probes, a) & _points_in_polygons(probes, b)).any():
+            return True
+    return False
+
+
+def centroid(shape: Shape) -> Tuple[float, float]:
+    # centroid of the outer ring of the largest polygon, or the first point
+    best: Tuple[float, float, float] | None = None
+    for rings in shape.polygons:
+        x, y = rings[0][:-1, 0], rings[0][:-1, 1]
+        xn, yn = np.roll(x, -1), np.roll(y, -1)
+        cross = x * yn - xn * y
+        area = cross.sum() / 2
+        if area == 0:
+            cx, cy = float(x.mean()), float(y.mean())
+        else:
+            cx = float(((x + xn) * cross).sum() / (6 * area))
+            cy = float(((y + yn) * cross).sum() / (6 * area))
+        if best is None or abs(area) > best[0]:
+            best = (abs(area), cx, cy)
+    if best is not None:
+        return best[1], best[2]
+    return float(shape.points[0, 0]), float(shape.points[0, 1])
+
+
+def select_features(
+    shapes: List[Shape], query: List[List[np.ndarray]], predicate: str = "intersects"
+) -> np.ndarray:
+    # boolean mask over shapes
+    if predicate not in PREDICATES:
+        raise ValueError(f"Predicado no soportado: {predicate}")
+    selected = np.zeros(len(shapes), dtype=bool)
+    live = [i for i, shape in enumerate(shapes) if not shape.is_empty]
+    if not live:
+        return selected
+
+    if predicate == "centroid":
+        centroids = np.asarray([centroid(shapes[i]) for i in live], dtype=np.float64)
+        selected[live] = _points_in_polygons(centroids, query)
+        return selected
+
+    # 1) one vectorized pass over the vertices of every candidate
+    vertices = [shapes[i].vertices() for i in live]
+    owners = np.repeat(np.asarray(live), [len(v) for v in vertices])
+    selected[owners[_points_in_polygons(np.concatenate(vertices), query, strict=True)]] = True
+
+    # 2) the rest only intersect if the query reaches into them, their edges cross or
+    #    their boundaries meet with area on the same side
+    query_rings = [ring for rings in query for ring in rings]
+    query_vertices = np.concatenate(query_rings)
+    query_edges = _edges(query_rings)
+    rest = [i for i in live if not selected[i] and shapes[i].polygons]
+    if not rest:
+        return selected
+    # boundaries can only meet where a vertex of one lies on the other: theirs on the
+    # query boundary, or a query vertex within their bbox
+    touching = np.zeros(len(shapes), dtype=bool)
+    vertices = [shapes[i].vertices() for i in rest]
+    owners = np.repeat(np.asarray(rest), [len(v) for v in vertices])
+    touching[owners[_on_boundary(np.concatenate(vertices), query_rings)]] = True
+    boxes = np.asarray([shapes[i].bbox() for i in rest])
+    qx, qy = query_vertices[:, 0:1].T, query_vertices[:, 1:2].T
+    near = (
+        (qx >= boxes[:, 0:1] - _EPSILON)
+        & (qx <= boxes[:, 2:3] + _EPSILON)
+        & (qy >= boxes[:, 1:2] - _EPSILON)
+        & (qy <= boxes[:, 3:4] + _EPSILON)
+    )
+    touching[np.asarray(rest)[near.any(axis=1)]] = True
+
+    for i in rest:
+        shape = shapes[i]
+        if _points_in_polygons(query_vertices, shape.polygons, strict=True).any():
+            selected[i] = True
+        elif _edges_cross(_edges([ring for rings in shape.polygons for ring in rings]), query_edges):
+            selected[i] = True
+        elif touching[i] and _interiors_overlap(query, shape.polygons):
+            selected[i] = True
+    return selected
+
+
+def spatial_entities(
+    layer: str,
+    query: List[List[np.ndarray]],
+    predicate: str = "intersects",
+    gpkg_path: Path = GPKG_PATH,
+) -> pd.DataFrame:
+    # entity columns of the features of the layer selected by the query area
+    bboxes = [Shape(polygons=[rings]).bbox() for rings in query]
+    rows = load_geometries(layer, bboxes, ENTITY_COLUMNS, gpkg_path)
+    shapes = [decode_geometry(row[1]) for row in rows]
+    mask = select_features(shapes, query, predicate)
+    selected = [row[2:] for row, keep in zip(rows, mask) if keep]
+    return pd.DataFrame(selected, columns=list(ENTITY_COLUMNS))
@@ -1,6 +1,7 @@
 from pathlib import Path
 
+from app.config import UPLOAD_MAX_BYTES, UPLOAD_TTL_SECONDS
 from app.store.session_store import SessionStore
 
 BASE_DIR = Path(__file__).resolve().parent / "data"
-store = SessionStore(BASE_DIR)
+store = SessionStore(BASE_DIR, ttl_seconds=UPLOAD_TTL_SECONDS, max_bytes=UPLOAD_MAX_BYTES)
@@ -1,9 +1,16 @@
 from __future__ import annotations
 
+import hashlib
+import json
+import sqlite3
+import threading
+import time
 import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict
+from typing import Any, BinaryIO, Dict, Iterator, Tuple
 
 
 @dataclass
@@ -11,23 +18,370 @@ class StoredFile:
     file_id: str
     filename: str
     path: Path
+    content_hash: str | None = None
+
+
+@dataclass(frozen=True)
+class ParsedFilter:
+    rows: int
+    columns: Tuple[str, ...]
+    ids: Tuple[int, ...]
+    names: Tuple[Tuple[str, str, str], ...]
+
+    @classmethod
+    def from_info(cls, info: Dict[str, Any]) -> "ParsedFilter":
+        names = dict.fromkeys(
+            (str(ent).strip(), str(loc or "").strip(), str(com or "").strip())
+            for ent, loc, com in info.get("names", [])
+        )
+        return cls(
+            rows=int(info.get("rows", 0)),
+            columns=tuple(str(c) for c in info.get("columns", [])),
+            ids=tuple(dict.fromkeys(int(i) for i in info.get("ids", []))),
+            names=tuple(n for n in names if n[0]),
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "rows": self.rows,
+            "columns": list(self.columns),
+            "ids": list(self.ids),
+            "names": [list(n) for n in self.names],
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ParsedFilter":
+        return cls(
+            rows=int(data["rows"]),
+            columns=tuple(data["columns"]),
+            ids=tuple(int(i) for i in data["ids"]),
+            names=tuple((n[0], n[1], n[2]) for n in data["names"]),
+        )
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, text: str) -> "ParsedFilter":
+        return cls.from_dict(json.loads(text))
+
+
+# A filter split by the values of one of its columns, as /report/batch uses it.
+# by_ids tells whether the file has ID_ENTIDAD (groups then match by id, not name).
+@dataclass(frozen=True)
+class GroupedFilter:
+    by_ids: bool
+    groups: Dict[str, ParsedFilter]
+
+    @classmethod
+    def from_info(cls, info: Dict[str, Any]) -> "GroupedFilter":
+        return cls(
+            by_ids=bool(info.get("ids")),
+            groups={str(key): ParsedFilter.from_info(value) for key, value in info.get("groups", {}).items()},
+        )
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {"by_ids": self.by_ids, "groups": {key: p.to_dict() for key, p in self.groups.items()}},
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+
+    @classmethod
+    def from_json(cls, text: str) -> "GroupedFilter":
+        data = json.loads(text)
+        return cls(
+            by_ids=bool(data["by_ids"]),
+            groups={key: ParsedFilter.from_dict(value) for key, value in data["groups"].items()},
+        )
+
+
+# Streams an upload to a temporary file, hashing it on the way, and registers it
+# on commit.
+class UploadWriter:
+    def __init__(self, store: "SessionStore", filename: str, suffix: str) -> None:
+        self.store = store
+        self.filename = filename
+        self.suffix = suffix
+        self._tmp_path = store.base_dir / f"{uuid.uuid4()}{suffix}.part"
+        self._fh: BinaryIO | None = self._tmp_path.open("wb")
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.stored: StoredFile | None = None
+
+    def write(self, chunk: bytes) -> None:
+        if self._fh is None:
+            raise ValueError("upload already closed")
+        self._fh.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+    def commit(self) -> StoredFile:
+        if self.stored is not None:
+            return self.stored
+        if self._fh is None:
+            raise ValueError("upload already closed")
+        self._fh.close()
+        self._fh = None
+        self.stored = self.store._register(
+            self.filename, self._tmp_path, self.suffix, self._hash.hexdigest(), self.size
+        )
+        return self.stored
+
+    def abort(self) -> None:
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        self._tmp_path.unlink(missing_ok=True)
+
+    def __enter__(self) -> "UploadWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if self.stored is None:
+            self.abort()
+
+
+_FILES_CACHE_SIZE = 1024
+# parsed filters hold every id and name of the file
+_PARSED_CACHE_SIZE = 64
 
 
 class SessionStore:
-    def __init__(self, base_dir: Path) -> None:
+    # Uploads are content-addressed: identical bytes (and suffix) are stored once as a
+    # blob named <sha256><suffix>, with its parsed filter next to it. Every upload
+    # still gets its own file_id pointing at the blob, and blobs are reference
+    # counted so they are deleted together with their last upload.
+    #
+    # An SQLite index next to the files lets every worker process resolve a file_id.
+    # Uploads expire after ttl_seconds without use and the least recently used ones
+    # are dropped once the blobs exceed max_bytes. last_access is only written when
+    # it is older than a hundredth of the TTL, not on every get().
+    #
+    # Each process keeps the most recently used uploads and parsed filters in memory.
+
+    def __init__(self, base_dir: Path, ttl_seconds: float | None = None, max_bytes: int | None = None) -> None:
         self.base_dir = base_dir
         self.base_dir.mkdir(parents=True, exist_ok=True)
-        self._files: Dict[str, StoredFile] = {}
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.index_path = base_dir / "index.sqlite"
+        self._touch_seconds = ttl_seconds / 100 if ttl_seconds is not None else 60.0
+        self._files: "OrderedDict[str, StoredFile]" = OrderedDict()
+        self._parsed: "OrderedDict[str, ParsedFilter]" = OrderedDict()
+        self._grouped: "OrderedDict[Tuple[str, str], GroupedFilter]" = OrderedDict()
+        self._lock = threading.Lock()
+        con = sqlite3.connect(self.index_path, timeout=30)
+        try:
+            con.execute("PRAGMA journal_mode = WAL")
+        finally:
+            con.close()
+        with self._db() as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS uploads ("
+                "file_id TEXT PRIMARY KEY, filename TEXT NOT NULL, name TEXT NOT NULL, "
+                "size INTEGER NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            con.execute("CREATE INDEX IF NOT EXISTS uploads_last_access ON uploads (last_access)")
+            con.execute("CREATE INDEX IF NOT EXISTS uploads_name ON uploads (name)")
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS blobs ("
+                "name TEXT PRIMARY KEY, content_hash TEXT, size INTEGER NOT NULL, refcount INTEGER NOT NULL)"
+            )
+            # uploads stored before deduplication become single-reference blobs
+            con.execute(
+                "INSERT OR IGNORE INTO blobs (name, content_hash, size, refcount) "
+                "SELECT name, NULL, size, COUNT(*) FROM uploads "
+                "WHERE name NOT IN (SELECT name FROM blobs) GROUP BY name"
+            )
+
+    def _recall(self, cache: OrderedDict, key: Any) -> Any:
+        with self._lock:
+            value = cache.get(key)
+            if value is not None:
+                cache.move_to_end(key)
+            return value
+
+    def _remember(self, cache: OrderedDict, key: Any, value: Any, size: int) -> None:
+        with self._lock:
+            cache[key] = value
+            cache.move_to_end(key)
+            while len(cache) > size:
+                cache.popitem(last=False)
+
+    @contextmanager
+    def _db(self) -> Iterator[sqlite3.Connection]:
+        # BEGIN IMMEDIATE so blob refcounts are read and updated atomically across workers
+        con = sqlite3.connect(self.index_path, timeout=30, isolation_level=None)
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                yield con
+            except BaseException:
+                con.execute("ROLLBACK")
+                raise
+            con.execute("COMMIT")
+        finally:
+            con.close()
+
+    def begin_upload(self, filename: str, suffix: str) -> UploadWriter:
+        return UploadWriter(self, filename, suffix)
+
+    def save_stream(self, filename: str, stream: BinaryIO, suffix: str, chunk_size: int = 1024 * 1024) -> StoredFile:
+        with self.begin_upload(filename, suffix) as upload:
+            for chunk in iter(lambda: stream.read(chunk_size), b""):
+                upload.write(chunk)
+            return upload.commit()
 
     def save_upload(self, filename: str, content: bytes, suffix: str) -> StoredFile:
+        with self.begin_upload(filename, suffix) as upload:
+            upload.write(content)
+            return upload.commit()
+
+    def _register(self, filename: str, tmp_path: Path, suffix: str, content_hash: str, size: int) -> StoredFile:
         file_id = str(uuid.uuid4())
-        path = self.base_dir / f"{file_id}{suffix}"
-        path.write_bytes(content)
-        stored = StoredFile(file_id=file_id, filename=filename, path=path)
-        self._files[file_id] = stored
+        name = f"{content_hash}{suffix}"
+        path = self.base_dir / name
+        now = time.time()
+        with self._db() as con:
+            row = con.execute("SELECT refcount FROM blobs WHERE name = ?", (name,)).fetchone()
+            if row is not None and path.exists():
+                tmp_path.unlink(missing_ok=True)
+                con.execute("UPDATE blobs SET refcount = refcount + 1 WHERE name = ?", (name,))
+            else:
+                tmp_path.replace(path)
+                con.execute(
+                    "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, 1)", (name, content_hash, size)
+                )
+            con.execute(
+                "INSERT INTO uploads VALUES (?, ?, ?, ?, ?, ?)",
+                (file_id, filename, name, size, now, now),
+            )
+        stored = StoredFile(file_id=file_id, filename=filename, path=path, content_hash=content_hash)
+        self._remember(self._files, file_id, stored, _FILES_CACHE_SIZE)
+        self.evict()
         return stored
 
     def get(self, file_id: str) -> StoredFile:
-        if file_id not in self._files:
+        con = sqlite3.connect(self.index_path, timeout=30)
+        try:
+            row = con.execute(
+                "SELECT u.filename, u.name, b.content_hash, u.last_access FROM uploads u "
+                "LEFT JOIN blobs b ON b.name = u.name WHERE u.file_id = ?",
+                (file_id,),
+            ).fetchone()
+        finally:
+            con.close()
+        path = self.base_dir / row[1] if row is not None else None
+        if path is None or not path.exists():
+            self._forget(file_id)
             raise KeyError(f"file_id not found: {file_id}")
-        return self._files[file_id]
+        now = time.time()
+        if now - row[3] > self._touch_seconds:
+            with self._db() as con:
+                con.execute("UPDATE uploads SET last_access = ? WHERE file_id = ?", (now, file_id))
+        stored = self._recall(self._files, file_id)
+        if stored is None:
+            stored = StoredFile(file_id=file_id, filename=row[0], path=path, content_hash=row[2])
+            self._remember(self._files, file_id, stored, _FILES_CACHE_SIZE)
+        return stored
+
+    def _forget(self, file_id: str) -> None:
+        with self._lock:
+            self._files.pop(file_id, None)
+
+    def _delete(self, con: sqlite3.Connection, file_id: str, name: str) -> int:
+        # returns the bytes freed, which is 0 while other uploads share the blob
+        con.execute("DELETE FROM uploads WHERE file_id = ?", (file_id,))
+        self._forget(file_id)
+        con.execute("UPDATE blobs SET refcount = refcount - 1 WHERE name = ?", (name,))
+        row = con.execute("SELECT refcount, size FROM blobs WHERE name = ?", (name,)).fetchone()
+        if row is not None and row[0] > 0:
+            return 0
+        con.execute("DELETE FROM blobs WHERE name = ?", (name,))
+        (self.base_dir / name).unlink(missing_ok=True)
+        self._parsed_path(name).unlink(missing_ok=True)
+        for path in self.base_dir.glob(f"{name}.*.groups.json"):
+            path.unlink(missing_ok=True)
+        with self._lock:
+            self._parsed.pop(name, None)
+            for key in [key for key in self._grouped if key[0] == name]:
+                del self._grouped[key]
+        return int(row[1]) if row is not None else 0
+
+    def evict(self, now: float | None = None) -> int:
+        now = time.time() if now is None else now
+        removed = 0
+        with self._db() as con:
+            if self.ttl_seconds is not None:
+                expired = con.execute(
+                    "SELECT file_id, name FROM uploads WHERE last_access < ?", (now - self.ttl_seconds,)
+                ).fetchall()
+                for file_id, name in expired:
+                    self._delete(con, file_id, name)
+                    removed += 1
+            if self.max_bytes is not None:
+                total = int(con.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0])
+                if total > self.max_bytes:
+                    for file_id, name in con.execute(
+                        "SELECT file_id, name FROM uploads ORDER BY last_access"
+                    ).fetchall():
+                        if total <= self.max_bytes:
+                            break
+                        total -= self._delete(con, file_id, name)
+                        removed += 1
+        # leftovers from interrupted uploads
+        for part in self.base_dir.glob("*.part"):
+            try:
+                if part.stat().st_mtime < now - 24 * 3600:
+                    part.unlink()
+            except OSError:
+                pass
+        return removed
+
+    def _parsed_path(self, name: str) -> Path:
+        return self.base_dir / f"{name}.filter.json"
+
+    def save_parsed(self, file_id: str, info: Dict[str, Any]) -> ParsedFilter:
+        stored = self.get(file_id)
+        parsed = ParsedFilter.from_info(info)
+        self._parsed_path(stored.path.name).write_text(parsed.to_json(), encoding="utf-8")
+        self._remember(self._parsed, stored.path.name, parsed, _PARSED_CACHE_SIZE)
+        return parsed
+
+    def get_parsed(self, file_id: str) -> ParsedFilter | None:
+        # shared by every upload of the same content
+        name = self.get(file_id).path.name
+        parsed = self._recall(self._parsed, name)
+        if parsed is not None:
+            return parsed
+        path = self._parsed_path(name)
+        if not path.exists():
+            return None
+        parsed = ParsedFilter.from_json(path.read_text(encoding="utf-8"))
+        self._remember(self._parsed, name, parsed, _PARSED_CACHE_SIZE)
+        return parsed
+
+    def _grouped_path(self, name: str, group_column: str) -> Path:
+        column = hashlib.sha256(group_column.encode("utf-8")).hexdigest()[:16]
+        return self.base_dir / f"{name}.{column}.groups.json"
+
+    def save_parsed_groups(self, file_id: str, group_column: str, info: Dict[str, Any]) -> GroupedFilter:
+        stored = self.get(file_id)
+        grouped = GroupedFilter.from_info(info)
+        self._grouped_path(stored.path.name, group_column).write_text(grouped.to_json(), encoding="utf-8")
+        self._remember(self._grouped, (stored.path.name, group_column), grouped, _PARSED_CACHE_SIZE)
+        return grouped
+
+    def get_parsed_groups(self, file_id: str, group_column: str) -> GroupedFilter | None:
+        # like get_parsed, per grouping column
+        name = self.get(file_id).path.name
+        grouped = self._recall(self._grouped, (name, group_column))
+        if grouped is not None:
+            return grouped
+        path = self._grouped_path(name, group_column)
+        if not path.exists():
+            return None
+        grouped = GroupedFilter.from_json(path.read_text(encoding="utf-8"))
+        self._remember(self._grouped, (name, group_column), grouped, _PARSED_CACHE_SIZE)
+        return grouped
@@ -0,0 +1,13 @@
+from __future__ import annotations
+
+import pandas as pd
+
+from app.services.filter_reader import normalize_ids
+
+
+def test_ids_beyond_float_precision():
+    text = pd.Series(["12345678901234567", " 7 ", "7.0", "x", None, "3"], dtype=object)
+    assert normalize_ids(text) == [12345678901234567, 7, 3]
+    cells = pd.Series([12345678901234567, 5.0, None, "8"], dtype=object)
+    assert normalize_ids(cells) == [12345678901234567, 5, 8]
+    assert normalize_ids(pd.Series([12345678901234567, None], dtype="Int64")) == [12345678901234567]
@@ -0,0 +1,27 @@
+from __future__ import annotations
+
+import numpy as np
+
+from app.services.preview import clip
+from app.services.spatial import Shape, parse_query_geometry
+
+
+def _area(ring: np.ndarray) -> float:
+    x, y = ring[:-1, 0], ring[:-1, 1]
+    return abs(float((x * np.roll(y, -1) - np.roll(x, -1) * y).sum())) / 2
+
+
+def test_clip_to_tile_box():
+    square = Shape(polygons=parse_query_geometry(bbox=[0, 0, 4, 4]))
+    clipped = clip(square, (1, 1, 2, 3))
+    assert len(clipped.polygons) == 1
+    assert _area(clipped.polygons[0][0]) == 2
+    assert np.array_equal(clipped.polygons[0][0][0], clipped.polygons[0][0][-1])
+
+
+def test_clip_drops_outside_parts():
+    triangle = Shape(polygons=parse_query_geometry(wkt="POLYGON((0 0, 4 0, 0 4, 0 0))"))
+    assert _area(clip(triangle, (1, 1, 3, 3)).polygons[0][0]) == 2
+    assert clip(triangle, (3, 3, 5, 5)).is_empty
+    points = Shape(points=np.array([[0.5, 0.5], [3.0, 3.0]]))
+    assert clip(points, (0, 0, 1, 1)).points.tolist() == [[0.5, 0.5]]
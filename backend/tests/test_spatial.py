@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import pytest
+
+from app.services.spatial import Shape, parse_query_geometry, select_features
+
+# unit squares at the origin and at census-like lon/lat, where float error matters
+ORIGINS = [(0.0, 0.0, 1.0), (-70.6372819, -33.4512377, 0.0013371)]
+
+
+def _box(origin, x0, y0, x1, y1):
+    ox, oy, size = origin
+    return parse_query_geometry(bbox=[ox + x0 * size, oy + y0 * size, ox + x1 * size, oy + y1 * size])
+
+
+def _selected(origin, query, feature, predicate="intersects"):
+    shape = Shape(polygons=_box(origin, *feature))
+    return bool(select_features([shape], _box(origin, *query), predicate)[0])
+
+
+@pytest.mark.parametrize("origin", ORIGINS)
+@pytest.mark.parametrize(
+    "feature, expected",
+    [
+        ((0, 0, 1, 1), True),  # identical polygons
+        ((0, 0, 2, 1), True),  # shares three edges, half of it overlaps
+        ((0, -1, 0.5, 1), True),  # collinear overlap along the left edge
+        ((0.2, 0.2, 0.8, 0.8), True),  # inside
+        ((-1, -1, 2, 2), True),  # contains the query
+        ((1, 0, 2, 1), False),  # neighbour sharing an edge
+        ((1, 0.5, 2, 3), False),  # neighbour sharing part of an edge
+        ((1, 1, 2, 2), False),  # corner contact
+        ((3, 3, 4, 4), False),  # apart
+    ],
+)
+def test_intersects_needs_common_area(origin, feature, expected):
+    assert _selected(origin, (0, 0, 1, 1), feature) is expected
+
+
+@pytest.mark.parametrize("origin", ORIGINS)
+def test_strip_crossing_edge_to_edge(origin):
+    assert _selected(origin, (0, 0.4, 2, 0.6), (0, 0, 2, 1))
+
+
+def test_hole_and_notch_boundaries():
+    hole = parse_query_geometry(
+        geojson={
+            "type": "Polygon",
+            "coordinates": [[[0, 0], [3, 0], [3, 3], [0, 3]], [[1, 1], [2, 1], [2, 2], [1, 2]]],
+        }
+    )
+    notch = parse_query_geometry(wkt="POLYGON((0 0, 2 0, 2 1, 1 1, 1 2, 0 2, 0 0))")
+    fills_hole = Shape(polygons=parse_query_geometry(bbox=[1, 1, 2, 2]))
+    over_hole = Shape(polygons=parse_query_geometry(bbox=[0.5, 1, 2, 2]))
+    arm = Shape(polygons=parse_query_geometry(bbox=[0, 1, 1, 2]))
+    assert list(select_features([fills_hole, over_hole], hole)) == [False, True]
+    assert list(select_features([fills_hole, arm], notch)) == [False, True]
+
+
+def test_centroid_predicate():
+    query = parse_query_geometry(bbox=[0, 0, 1, 1])
+    shapes = [Shape(polygons=parse_query_geometry(bbox=b)) for b in ([0.5, 0.5, 1.2, 1.2], [0.8, 0.8, 2, 2])]
+    assert list(select_features(shapes, query, "centroid")) == [True, False]
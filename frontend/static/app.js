@@ -3,6 +3,7 @@ const layerSelect = document.getElementById("layerSelect");
 const loadVarsBtn = document.getElementById("loadVarsBtn");
 const filterInput = document.getElementById("filterInput");
 const filterMeta = document.getElementById("filterMeta");
+const filterPreview = document.getElementById("filterPreview");
 let localityInput = document.getElementById("localityInput");
 const groupsList = document.getElementById("groupsList");
 const searchBox = document.getElementById("searchBox");
@@ -185,9 +186,68 @@ filterInput.addEventListener("change", async (event) => {
   state.filterId = data.filter_id;
   filterMeta.textContent = `Filtro cargado: ${data.rows} filas`;
   setStatus("Filtro listo");
+  renderPreview();
 });
 
+const SVG_NS = "http://www.w3.org/2000/svg";
+
+async function renderPreview() {
+  // outline of the entities the filter matched, to check them before the report
+  const layer = layerSelect.value;
+  if (!filterPreview || !state.filterId || !layer) return;
+  const res = await fetch(
+    `/preview/${encodeURIComponent(layer)}/filter/${encodeURIComponent(state.filterId)}.geojson`
+  );
+  if (!res.ok) {
+    filterPreview.hidden = true;
+    return;
+  }
+  const data = await res.json();
+  filterPreview.innerHTML = "";
+  if (!data.bbox || !data.features.length) {
+    filterPreview.hidden = false;
+    filterPreview.innerHTML = '<div class="empty">Ninguna entidad del filtro está en la capa.</div>';
+    return;
+  }
+
+  const [minx, miny, maxx, maxy] = data.bbox;
+  const pad = Math.max(maxx - minx, maxy - miny) * 0.05 || 0.001;
+  const svg = document.createElementNS(SVG_NS, "svg");
+  // y grows downwards in SVG, so latitudes are negated
+  svg.setAttribute(
+    "viewBox",
+    `${minx - pad} ${-maxy - pad} ${maxx - minx + 2 * pad} ${maxy - miny + 2 * pad}`
+  );
+  const ring = (coords) => "M" + coords.map(([x, y]) => `${x},${-y}`).join("L") + "Z";
+  data.features.forEach((feature) => {
+    const geom = feature.geometry;
+    const polygons =
+      geom.type === "Polygon" ? [geom.coordinates] : geom.type === "MultiPolygon" ? geom.coordinates : [];
+    const points = geom.type === "Point" ? [geom.coordinates] : geom.type === "MultiPoint" ? geom.coordinates : [];
+    const title = document.createElementNS(SVG_NS, "title");
+    const props = feature.properties || {};
+    title.textContent = [props.ENTIDAD, props.LOCALIDAD, props.COMUNA].filter(Boolean).join(" · ");
+    if (polygons.length) {
+      const path = document.createElementNS(SVG_NS, "path");
+      path.setAttribute("d", polygons.map((rings) => rings.map(ring).join("")).join(""));
+      path.appendChild(title);
+      svg.appendChild(path);
+    }
+    points.forEach(([x, y]) => {
+      const dot = document.createElementNS(SVG_NS, "circle");
+      dot.setAttribute("cx", x);
+      dot.setAttribute("cy", -y);
+      dot.setAttribute("r", pad / 5);
+      dot.appendChild(title.cloneNode(true));
+      svg.appendChild(dot);
+    });
+  });
+  filterPreview.appendChild(svg);
+  filterPreview.hidden = false;
+}
+
 loadVarsBtn.addEventListener("click", loadVariables);
+layerSelect.addEventListener("change", renderPreview);
 searchBox.addEventListener("input", renderGroups);
 
 selectAllBtn.addEventListener("click", () => {
@@ -218,8 +278,18 @@ runBtn.addEventListener("click", async () => {
     return;
   }
 
+  // a second click while running would only queue the same report again
+  runBtn.disabled = true;
+  try {
+    await generateReport(layer, selected, localidad);
+  } finally {
+    runBtn.disabled = false;
+  }
+});
+
+async function generateReport(layer, selected, localidad) {
   setStatus("Generando reportes...");
-  const res = await fetch("/report", {
+  const res = await fetch("/report/jobs", {
     method: "POST",
     headers: { "Content-Type": "application/json" },
     body: JSON.stringify({
@@ -227,20 +297,70 @@ runBtn.addEventListener("click", async () => {
       filter_id: state.filterId,
       groups: selected,
       localidad,
+      formats: ["docx"],
     }),
   });
 
   if (!res.ok) {
     const err = await res.text();
     setStatus("Error al generar");
-    results.innerHTML = `<div class="empty">${err}</div>`;
+    showError(err);
     return;
   }
 
-  const data = await res.json();
-  renderResults(data);
+  const job = await waitForJob((await res.json()).job_id);
+  if (!job || job.status !== "done") {
+    setStatus("Error al generar");
+    showError(job ? job.error : "Se perdió la conexión con el servidor");
+    return;
+  }
+
+  renderResults(job.result);
   setStatus("Reportes listos");
-});
+}
+
+function showError(message) {
+  // server text goes in as text, never as markup
+  const box = document.createElement("div");
+  box.className = "empty";
+  box.textContent = message;
+  results.replaceChildren(box);
+}
+
+const JOB_POLL_MS = 1000;
+const JOB_TIMEOUT_MS = 30 * 60 * 1000;
+
+async function waitForJob(jobId) {
+  // polls the job until it finishes; returns null if the server stops answering
+  // and an error once JOB_TIMEOUT_MS has passed
+  const deadline = Date.now() + JOB_TIMEOUT_MS;
+  let failures = 0;
+  while (true) {
+    if (Date.now() > deadline) {
+      return { status: "error", error: "El reporte tardó demasiado; intenta de nuevo" };
+    }
+    await new Promise((resolve) => setTimeout(resolve, JOB_POLL_MS));
+    let job;
+    try {
+      const res = await fetch(`/report/jobs/${jobId}`);
+      if (!res.ok) {
+        throw new Error(await res.text());
+      }
+      job = await res.json();
+      failures = 0;
+    } catch (error) {
+      console.error(error);
+      failures += 1;
+      if (failures >= 5) return null;
+      continue;
+    }
+    if (job.status === "done" || job.status === "error") {
+      return job;
+    }
+    const pct = Math.round((job.progress || 0) * 100);
+    setStatus(`Generando reportes: ${job.stage_label || "en cola"} (${pct}%)`);
+  }
+}
 
 function renderResults(data) {
   results.innerHTML = "";
@@ -249,9 +369,14 @@ function renderResults(data) {
 
   const combined = document.createElement("div");
   combined.className = "result-card";
+  const downloads = data.downloads || {};
+  const links = ["docx", "xlsx", "html", "csv"]
+    .filter((fmt) => downloads[fmt])
+    .map((fmt) => `<a href="${downloads[fmt]}" download>${fmt.toUpperCase()}</a>`)
+    .join(" · ");
   combined.innerHTML = `
     <div class="group-title">Salida consolidada</div>
-    <div class="group-meta">XLSX: <code>${data.combined_xlsx}</code></div>
+    <div class="group-meta">Descargar: ${links}</div>
     <div class="group-meta">DOCX: <code>${data.combined_docx}</code></div>
     <div class="group-meta">Sugerencia: abrir el DOCX y copiar a Word.</div>
   `;